@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# Offline benchmark of the mirror/CI pipelines on synthetic repositories.
+#
+# usage: bench.py run [--size small|medium|large] [--repeat N] [--stages ...]
+#        bench.py compare <base-revision> <new-revision>
+#        bench.py list
+#        bench.py list-stages
+#
+# A synthetic repository with history is generated by gen-repo.py and
+# pushed to a local bare "forge" repository in rounds, replaying its
+# commits.  Every round runs the repos.bash-style stages (sync, regen,
+# smart-merge) and the gentoo-ci.bash-style stages (scan, sort, borked).
+# Then the breakage introduced in the history is bisected, and a pull
+# request from the forge is checked like the PR worker does.
+#
+# Only smart-merge (repos/smart-merge.bash), sort (sort-output.xsl),
+# borked (pkgcheck2borked.py) and pr-diff (pull-request/pkgcheckdiff.py)
+# run the code used in production.  The other stages are stand-ins:
+# they run the same git/pmaint/pkgcheck commands as the corresponding
+# step of repos.bash, gentoo-ci.bash, bisect-borked.bash or
+# pull-requests-worker.bash, but not those scripts, which need sudo,
+# bwrap, the network and the production layout.  Changes to these
+# scripts themselves are not measured by them (see STAGES).
+#
+# Wall time, CPU time, I/O bytes and peak RSS of every stage are
+# obtained via wait4().  Results are appended to the results file
+# (BENCH_RESULTS, bench-results.jsonl by default), keyed by the revision
+# of this repository, so that runs can be compared across revisions.
+# Stages needing tools that are not installed (pmaint, pkgcheck,
+# xsltproc, pkgcheck2html) are skipped.  PKGCHECK_RESULT_PARSER_GIT
+# points to the pkgcheck2html checkout, as in repo-mirror-ci.conf.
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {
+    "small": dict(categories=10, packages=10, versions=2, commits=60),
+    "medium": dict(categories=50, packages=40, versions=2, commits=300),
+    "large": dict(categories=150, packages=130, versions=3, commits=1000),
+}
+
+# stage -> what it runs, None for the production code itself, or
+# the script step it stands in for
+STAGES = {
+    "sync": "git pull in repos.bash",
+    "regen": "pmaint regen in repos.bash (without the sandbox)",
+    "smart-merge": None,
+    "scan": "pkgcheck scan in gentoo-ci.bash (without the sandbox)",
+    "sort": None,
+    "borked": None,
+    "bisect": "bisect-borked.bash (git bisect run of a pkgcheck probe)",
+    "pr-merge": "clone and merge in pull-requests-worker.bash",
+    "pr-regen": "pmaint regen in pull-requests-worker.bash",
+    "pr-scan": "post- and pre-merge scans in pull-requests-worker.bash",
+    "pr-diff": None,
+}
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "bench",
+    "GIT_AUTHOR_EMAIL": "bench@example.org",
+    "GIT_COMMITTER_NAME": "bench",
+    "GIT_COMMITTER_EMAIL": "bench@example.org",
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "GIT_CONFIG_GLOBAL": "/dev/null",
+    "EDITOR": "cat",
+}
+
+PORTAGE_REPOS_CONF = """\
+[DEFAULT]
+main-repo = gentoo
+
+[gentoo]
+location = {location}
+"""
+
+
+class SkipStage(Exception):
+    pass
+
+
+class Bench:
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.parser_dir = os.environ.get(
+            "PKGCHECK_RESULT_PARSER_GIT", os.path.join(SCRIPT_DIR, "pkgcheck2html")
+        )
+        # (pkgcheckdiff.py uses it too)
+        self.env = dict(
+            os.environ, PKGCHECK_RESULT_PARSER_GIT=self.parser_dir, **GIT_ENV
+        )
+        self.logdir = os.path.join(workdir, "logs")
+        os.makedirs(self.logdir)
+        self.results = {}
+
+    def path(self, *p):
+        return os.path.join(self.workdir, *p)
+
+    def call(self, cmd, cwd=None, stdout=None):
+        """Run an unmeasured setup command."""
+        subprocess.check_call(
+            cmd,
+            cwd=cwd or self.workdir,
+            env=self.env,
+            stdout=stdout if stdout is not None else subprocess.DEVNULL,
+        )
+
+    def output(self, cmd, cwd=None):
+        return subprocess.check_output(
+            cmd, cwd=cwd or self.workdir, env=self.env, text=True
+        ).strip()
+
+    def measure(self, stage, cmd, cwd=None, stdout=None):
+        """Run cmd, adding its resource usage to the stage results."""
+        if stage not in self.args.stages:
+            return 0
+        log = open(os.path.join(self.logdir, f"{stage}.log"), "a")
+        with log:
+            log.write(f"$ {' '.join(cmd)}\n")
+            log.flush()
+            start = time.monotonic()
+            proc = subprocess.Popen(
+                cmd,
+                cwd=cwd or self.workdir,
+                env=self.env,
+                stdout=stdout if stdout is not None else log,
+                stderr=log,
+            )
+            _, wstatus, ru = os.wait4(proc.pid, 0)
+            wall = time.monotonic() - start
+        proc.returncode = os.waitstatus_to_exitcode(wstatus)
+
+        r = self.results.setdefault(
+            stage,
+            dict(
+                wall=0.0,
+                utime=0.0,
+                stime=0.0,
+                read_bytes=0,
+                write_bytes=0,
+                maxrss_kb=0,
+                runs=0,
+                failed=0,
+            ),
+        )
+        r["wall"] += wall
+        r["utime"] += ru.ru_utime
+        r["stime"] += ru.ru_stime
+        # block counts are in 512-byte units
+        r["read_bytes"] += ru.ru_inblock * 512
+        r["write_bytes"] += ru.ru_oublock * 512
+        r["maxrss_kb"] = max(r["maxrss_kb"], ru.ru_maxrss)
+        r["runs"] += 1
+        if proc.returncode != 0:
+            r["failed"] += 1
+            print(
+                f"{stage}: exited with {proc.returncode}, see {log.name}",
+                file=sys.stderr,
+            )
+        return proc.returncode
+
+    def skip(self, stage, reason):
+        if stage in self.args.stages and stage not in self.results:
+            self.results[stage] = {"skipped": reason}
+
+    def setup(self):
+        size = dict(SIZES[self.args.size])
+        self.call(
+            [
+                sys.executable,
+                os.path.join(SCRIPT_DIR, "bench/gen-repo.py"),
+                f"--categories={size['categories']}",
+                f"--packages={size['packages']}",
+                f"--versions={size['versions']}",
+                f"--commits={size['commits']}",
+                # break the repo in the replayed part of the history
+                f"--break-at={size['commits'] * 3 // 4}",
+                f"--seed={self.args.seed}",
+                self.path("upstream"),
+            ]
+        )
+        self.commits = self.output(
+            ["git", "rev-list", "--reverse", "HEAD"], cwd=self.path("upstream")
+        ).split()
+        self.broken_commit = self.commits[size["commits"] * 3 // 4]
+        self.broken_pkg = "/".join(
+            self.output(
+                ["git", "show", "--format=", "--name-only", self.broken_commit],
+                cwd=self.path("upstream"),
+            ).split("/")[:2]
+        )
+
+        # the forge starts with the first half of the history
+        self.base = len(self.commits) // 2
+        self.call(
+            ["git", "init", "-q", "--bare", "-b", "master", self.path("forge.git")]
+        )
+        self.push_forge(self.commits[self.base])
+        self.call(["git", "clone", "-q", self.path("forge.git"), self.path("sync")])
+        self.call(["git", "init", "-q", "-b", "master", self.path("mirror")])
+        self.call(
+            [
+                os.path.join(SCRIPT_DIR, "repos/smart-merge.bash"),
+                self.path("sync"),
+                self.path("mirror"),
+                "master",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+
+        # pkgcore configuration using the mirror as ::gentoo
+        config = self.path("etc/portage")
+        os.makedirs(config)
+        with open(os.path.join(config, "repos.conf"), "w") as f:
+            f.write(PORTAGE_REPOS_CONF.format(location=self.path("mirror")))
+        open(os.path.join(config, "make.conf"), "w").close()
+        os.symlink(
+            self.path("mirror/profiles/default/linux/amd64"),
+            os.path.join(config, "make.profile"),
+        )
+        self.config = config
+
+    @staticmethod
+    def regen_cmd(config):
+        jobs = str(os.cpu_count())
+        return ["pmaint", "--config", config, "regen", "-t", jobs, "gentoo"]
+
+    @staticmethod
+    def scan_cmd(config):
+        return ["pkgcheck", "--config", config, "scan", "--reporter", "XmlReporter"]
+
+    def push_forge(self, commit):
+        self.call(
+            [
+                "git",
+                "push",
+                "-q",
+                "-f",
+                self.path("forge.git"),
+                f"{commit}:refs/heads/master",
+            ],
+            cwd=self.path("upstream"),
+        )
+
+    def round(self, commit):
+        """Replay commits up to the given one, then run the CI stages."""
+        self.push_forge(commit)
+
+        # repos.bash
+        self.measure(
+            "sync", ["git", "pull", "-q", "--ff-only"], cwd=self.path("sync")
+        )
+        if shutil.which("pmaint"):
+            self.measure("regen", self.regen_cmd(self.config))
+        else:
+            self.skip("regen", "pmaint not installed")
+        self.measure(
+            "smart-merge",
+            [
+                os.path.join(SCRIPT_DIR, "repos/smart-merge.bash"),
+                self.path("sync"),
+                self.path("mirror"),
+                "master",
+            ],
+        )
+
+        # gentoo-ci.bash
+        if shutil.which("pkgcheck"):
+            with open(self.path("output.xml.tmp"), "w") as out:
+                self.measure(
+                    "scan",
+                    self.scan_cmd(self.config),
+                    cwd=self.path("mirror"),
+                    stdout=out,
+                )
+        else:
+            self.skip("scan", "pkgcheck not installed")
+            return
+
+        if shutil.which("xsltproc"):
+            with open(self.path("output.xml"), "w") as out:
+                self.measure(
+                    "sort",
+                    [
+                        "xsltproc",
+                        os.path.join(SCRIPT_DIR, "sort-output.xsl"),
+                        self.path("output.xml.tmp"),
+                    ],
+                    stdout=out,
+                )
+        else:
+            self.skip("sort", "xsltproc not installed")
+            shutil.copy(self.path("output.xml.tmp"), self.path("output.xml"))
+
+        pkgcheck2borked = os.path.join(self.parser_dir, "pkgcheck2borked.py")
+        if os.path.exists(pkgcheck2borked):
+            self.measure(
+                "borked",
+                [
+                    pkgcheck2borked,
+                    "-x",
+                    os.path.join(self.parser_dir, "excludes.json"),
+                    "-o",
+                    self.path("borked.list"),
+                    self.path("output.xml"),
+                ],
+            )
+        else:
+            self.skip("borked", "pkgcheck2html not checked out")
+
+    def bisect(self):
+        """Bisect the breakage introduced in the replayed history."""
+        self.call(["git", "clone", "-q", self.path("upstream"), self.path("bisect")])
+        if shutil.which("pkgcheck"):
+            config = self.path("etc/portage-bisect")
+            shutil.copytree(self.config, config, symlinks=True)
+            with open(os.path.join(config, "repos.conf"), "w") as f:
+                f.write(PORTAGE_REPOS_CONF.format(location=self.path("bisect")))
+            probe = (
+                f"pkgcheck --config {config} scan --exit error "
+                f"-s pkg,ver {self.broken_pkg}"
+            )
+        else:
+            # just measure the bisection itself
+            probe = "! grep -rqs --include='*.ebuild' '^die ' " + self.broken_pkg
+
+        self.measure(
+            "bisect",
+            [
+                "sh",
+                "-c",
+                'git bisect start "$1" "$2" && git bisect run sh -c "$3"'
+                ' && git bisect reset',
+                "sh",
+                self.commits[-1],
+                self.commits[self.base],
+                probe,
+            ],
+            cwd=self.path("bisect"),
+        )
+
+    def pull_request(self):
+        """Check a pull request from the forge, like the PR worker."""
+        # create the PR: bump a few packages on top of forge master
+        pr_src = self.path("pr-src")
+        self.call(["git", "clone", "-q", self.path("forge.git"), pr_src])
+        ebuilds = sorted(
+            self.output(["git", "ls-files", "*.ebuild"], cwd=pr_src).split()
+        )
+        pkgs = []
+        for e in ebuilds[:: max(1, len(ebuilds) // 5)][:5]:
+            pkg, name = os.path.split(e)
+            shutil.copy(
+                os.path.join(pr_src, e),
+                os.path.join(pr_src, pkg, name[: -len(".ebuild")] + "-r1.ebuild"),
+            )
+            pkgs.append(pkg)
+        self.call(["git", "add", "-A"], cwd=pr_src)
+        self.call(["git", "commit", "-q", "-m", "bump packages"], cwd=pr_src)
+        self.call(
+            ["git", "push", "-q", self.path("forge.git"), "HEAD:refs/pull/1/head"],
+            cwd=pr_src,
+        )
+
+        pr = self.path("pr")
+        self.measure(
+            "pr-merge",
+            [
+                "sh",
+                "-c",
+                'git clone -q -s "$1" "$2" && cd "$2" && '
+                'git fetch -q "$3" refs/pull/1/head:refs/pull/1 && '
+                "git tag pre-merge && git merge -q -m merge refs/pull/1",
+                "sh",
+                self.path("sync"),
+                pr,
+                self.path("forge.git"),
+            ],
+        )
+
+        config = self.path("etc/portage-pr")
+        shutil.copytree(self.config, config, symlinks=True)
+        with open(os.path.join(config, "repos.conf"), "w") as f:
+            f.write(PORTAGE_REPOS_CONF.format(location=pr))
+
+        if shutil.which("pmaint"):
+            self.measure("pr-regen", self.regen_cmd(config))
+        else:
+            self.skip("pr-regen", "pmaint not installed")
+
+        if not shutil.which("pkgcheck"):
+            self.skip("pr-scan", "pkgcheck not installed")
+            self.skip("pr-diff", "pkgcheck not installed")
+            return
+        scan = self.scan_cmd(config)
+        with open(self.path("pr-post.xml"), "w") as out:
+            self.measure("pr-scan", scan + pkgs, cwd=pr, stdout=out)
+        self.call(["git", "checkout", "-q", "pre-merge"], cwd=pr)
+        with open(self.path("pr-pre.xml"), "w") as out:
+            self.measure("pr-scan", scan + pkgs, cwd=pr, stdout=out)
+        if not os.path.exists(os.path.join(self.parser_dir, "pkgcheck2borked.py")):
+            self.skip("pr-diff", "pkgcheck2html not checked out")
+            return
+        self.measure(
+            "pr-diff",
+            [
+                sys.executable,
+                os.path.join(SCRIPT_DIR, "pull-request/pkgcheckdiff.py"),
+                "-o",
+                self.path("pr-diff.json"),
+                "--post",
+                self.path("pr-post.xml"),
+                "--pre",
+                self.path("pr-pre.xml"),
+            ],
+        )
+
+    def run(self):
+        self.setup()
+        rounds = self.args.rounds
+        replay = self.commits[self.base + 1 :]
+        for i in range(1, rounds + 1):
+            self.round(replay[len(replay) * i // rounds - 1])
+        self.bisect()
+        self.pull_request()
+        return self.results
+
+
+def revision():
+    rev = subprocess.check_output(
+        ["git", "describe", "--always", "--dirty"], cwd=SCRIPT_DIR, text=True
+    )
+    return rev.strip()
+
+
+def results_path(args):
+    return args.results or os.environ.get("BENCH_RESULTS", "bench-results.jsonl")
+
+
+def load_results(args):
+    try:
+        with open(results_path(args)) as f:
+            return [json.loads(l) for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def print_stages(stages):
+    print(
+        f"{'stage':12} {'runs':>4} {'wall':>8} {'cpu':>8} {'read':>9} "
+        f"{'written':>9} {'maxrss':>8}"
+    )
+    for name, standin in STAGES.items():
+        r = stages.get(name)
+        if r is None:
+            continue
+        label = name + ("*" if standin else "")
+        if "skipped" in r:
+            print(f"{label:12} skipped: {r['skipped']}")
+            continue
+        print(
+            f"{label:12} {r['runs']:4} {r['wall']:8.2f} "
+            f"{r['utime'] + r['stime']:8.2f} {r['read_bytes'] >> 20:7}MB "
+            f"{r['write_bytes'] >> 20:7}MB {r['maxrss_kb'] >> 10:6}MB"
+            + (f" ({r['failed']} failed)" if r["failed"] else "")
+        )
+    print("* stand-in for a script step, see bench.py list-stages")
+
+
+def cmd_run(args):
+    rev = revision()
+    for i in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix="repo-mirror-ci-bench.")
+        try:
+            stages = Bench(workdir, args).run()
+        finally:
+            if args.keep:
+                print(f"work directory kept in {workdir}", file=sys.stderr)
+            else:
+                shutil.rmtree(workdir)
+
+        record = {
+            "revision": rev,
+            "date": datetime.datetime.now(datetime.UTC).isoformat(),
+            "size": args.size,
+            "seed": args.seed,
+            "rounds": args.rounds,
+            "stages": stages,
+        }
+        with open(results_path(args), "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+        print(f"== {rev} ({args.size}, run {i + 1}/{args.repeat}) ==")
+        print_stages(stages)
+    return 0
+
+
+def median_stages(records):
+    """Return stage -> (median wall, median cpu, max maxrss) for records."""
+    ret = {}
+    for name in STAGES:
+        rs = [
+            r["stages"][name]
+            for r in records
+            if "wall" in r["stages"].get(name, {})
+        ]
+        if rs:
+            ret[name] = (
+                statistics.median(r["wall"] for r in rs),
+                statistics.median(r["utime"] + r["stime"] for r in rs),
+                max(r["maxrss_kb"] for r in rs),
+            )
+    return ret
+
+
+def cmd_compare(args):
+    records = [r for r in load_results(args) if r["size"] == args.size]
+
+    def select(rev):
+        return [r for r in records if r["revision"].startswith(rev)]
+
+    base = median_stages(select(args.base))
+    new = median_stages(select(args.new))
+    if not base or not new:
+        print(f"no {args.size} results for both revisions", file=sys.stderr)
+        return 1
+
+    print(f"{'stage':12} {'wall':>17} {'change':>7} {'cpu':>17} {'maxrss':>15}")
+    regressions = 0
+    for name in STAGES:
+        if name not in base or name not in new:
+            continue
+        (bw, bc, bm), (nw, nc, nm) = base[name], new[name]
+        change = (nw - bw) / bw * 100 if bw else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = " !"
+            regressions += 1
+        print(
+            f"{name:12} {bw:8.2f} {nw:8.2f} {change:+6.1f}% {bc:8.2f} {nc:8.2f} "
+            f"{bm >> 10:6}MB {nm >> 10:6}MB{flag}"
+        )
+    return 1 if regressions else 0
+
+
+def cmd_list(args):
+    for r in load_results(args):
+        total = sum(s.get("wall", 0) for s in r["stages"].values())
+        print(f"{r['date'][:19]} {r['revision']:24} {r['size']:7} {total:8.2f}s")
+    return 0
+
+
+def cmd_list_stages(args):
+    for name, standin in STAGES.items():
+        what = f"stand-in for {standin}" if standin else "the production code"
+        print(f"{name:12} {what}")
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--results", help="results file (default: $BENCH_RESULTS)")
+    subp = argp.add_subparsers(dest="command", required=True)
+
+    p = subp.add_parser("run", help="run the benchmark")
+    p.add_argument("--size", choices=sorted(SIZES), default="small")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--rounds", type=int, default=3, help="replay rounds")
+    p.add_argument("--repeat", type=int, default=1, help="number of runs")
+    p.add_argument(
+        "--stages",
+        type=lambda x: x.split(","),
+        default=list(STAGES),
+        help="comma-separated stages to measure",
+    )
+    p.add_argument("--keep", action="store_true", help="keep the work directory")
+
+    p = subp.add_parser("compare", help="compare two revisions")
+    p.add_argument("--size", choices=sorted(SIZES), default="small")
+    p.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="wall time increase (%%) reported as regression",
+    )
+    p.add_argument("base")
+    p.add_argument("new")
+
+    subp.add_parser("list", help="list stored results")
+    subp.add_parser("list-stages", help="list the stages and what they run")
+
+    args = argp.parse_args()
+    return {
+        "run": cmd_run,
+        "compare": cmd_compare,
+        "list": cmd_list,
+        "list-stages": cmd_list_stages,
+    }[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+# Local stand-in for the GitHub and Codeberg (Forgejo) APIs, covering
+# the endpoints used by the pull request scripts.
+#
+# usage: fake-forge.py [--port N] [--prs N] [--latency MS] [--rate-limit N] ...
+#
+# The GitHub API is served under /github and the Forgejo one under
+# /codeberg/api/v1, i.e. the scripts are pointed to it via:
+#
+#   GITHUB_API_URL=http://127.0.0.1:<port>/github
+#   CODEBERG_API_URL=http://127.0.0.1:<port>/codeberg/api/v1
+#
+# Both forges start with the given number of open PRs, some of them
+# with statuses and labels already.  Lists are paginated like the real
+# forges do (Link headers, X-Total-Count on Forgejo, except for the
+# team list that lacks the Link header there too).
+#
+# Control endpoints (not counted as requests):
+#
+#   GET  /_stats             request counts per forge and endpoint
+#   POST /_reset             reset the request counts
+#   POST /_push?count=N      push new commits to N random open PRs
+#   POST /_comments?count=N  add N comments by other users and one
+#                            earlier CI report of ours to every open PR
+
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+GITHUB_PREFIX = "/github"
+CODEBERG_PREFIX = "/codeberg/api/v1"
+
+
+def fake_sha(*args):
+    return hashlib.sha1(repr(args).encode()).hexdigest()
+
+
+def fmt_date(t, forge):
+    s = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t))
+    return s + ("Z" if forge == "github" else "+00:00")
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class Forge:
+    """State of one forge: a single repository with its PRs."""
+
+    def __init__(self, name, args, owner, repo, ci_user):
+        self.name = name
+        self.owner = owner
+        self.repo = repo
+        self.ci_user = ci_user
+        self.rng = random.Random(f"{args.seed}/{name}")
+        self.rate_limit = args.rate_limit
+        self.rate_window = args.rate_window
+        self.max_page = 100 if name == "github" else 50
+        self.lock = threading.Lock()
+        self.ids = iter(range(1, 1 << 62))
+        self.time = 1700000000
+
+        self.labels = [
+            {"id": next(self.ids), "name": name}
+            for name in ("noci", "priority-ci", "bug", "enhancement")
+        ]
+        self.prs = {}
+        self.statuses = {}
+        self.comments = {}
+        self.teams = {}
+        self.org_members = {f"dev{i}" for i in range(20)}
+        for i in range(args.prs):
+            self.add_pr(args)
+        self.reset_stats()
+
+    def tick(self):
+        self.time += self.rng.randint(60, 600)
+        return self.time
+
+    def add_pr(self, args):
+        number = 1000 + len(self.prs)
+        labels = []
+        if self.rng.random() < args.noci:
+            labels.append(self.labels[0])
+        if self.rng.random() < args.priority:
+            labels.append(self.labels[1])
+        pr = {
+            "number": number,
+            "title": f"pkg-{number}: version bump",
+            "author": f"user{self.rng.randrange(200)}",
+            "labels": labels,
+            "sha": fake_sha(self.name, number, 0),
+            "created": self.tick(),
+            "updated": self.time,
+            "state": "open",
+        }
+        self.prs[number] = pr
+
+        # foreign CI and our earlier results
+        if self.rng.random() < 0.3:
+            self.add_status(pr["sha"], "success", "other-ci", "other-bot")
+        r = self.rng.random()
+        if r < args.processed:
+            self.add_status(pr["sha"], "success", "gentoo-ci", self.ci_user)
+        elif r < args.processed + 0.1:
+            self.add_status(pr["sha"], "pending", "gentoo-ci", self.ci_user)
+
+    def push(self, count):
+        open_prs = [pr for pr in self.prs.values() if pr["state"] == "open"]
+        for pr in self.rng.sample(open_prs, min(count, len(open_prs))):
+            pr["sha"] = fake_sha(self.name, pr["number"], self.tick())
+            pr["updated"] = self.time
+
+    def add_comments(self, count):
+        for pr in self.prs.values():
+            if pr["state"] != "open":
+                continue
+            for i in range(count):
+                self.add_comment(pr["number"], f"user{self.rng.randrange(200)}", "LGTM")
+            self.add_comment(
+                pr["number"],
+                self.ci_user,
+                "## Pull request CI report\n\n*Report generated at: earlier*\n",
+            )
+
+    def add_comment(self, number, user, body):
+        comment = {
+            "id": next(self.ids),
+            "pr": int(number),
+            "body": body,
+            "user": user,
+            "created": self.tick(),
+        }
+        self.comments[comment["id"]] = comment
+        return comment
+
+    def add_status(self, sha, state, context, creator, description="", url=""):
+        status = {
+            "id": next(self.ids),
+            "state": state,
+            "context": context,
+            "description": description,
+            "target_url": url,
+            "creator": creator,
+            "created": self.tick(),
+        }
+        # newest first, like both forges return them
+        self.statuses.setdefault(sha, []).insert(0, status)
+        return status
+
+    def reset_stats(self):
+        self.requests = 0
+        self.endpoints = {}
+        self.window_start = time.time()
+        self.window_requests = 0
+
+    def count(self, endpoint):
+        """Count a request, raising RateLimitExceeded over the limit."""
+        now = time.time()
+        if now - self.window_start >= self.rate_window:
+            self.window_start = now
+            self.window_requests = 0
+        self.requests += 1
+        self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+        self.window_requests += 1
+        if self.rate_limit and self.window_requests > self.rate_limit:
+            raise RateLimitExceeded()
+
+    def rate_headers(self):
+        if not self.rate_limit:
+            return {}
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(
+                max(0, self.rate_limit - self.window_requests)
+            ),
+            "X-RateLimit-Reset": str(int(self.window_start + self.rate_window)),
+        }
+
+    # JSON representations
+
+    def repo_url(self, base):
+        return f"{base}/repos/{self.owner}/{self.repo}"
+
+    def user(self, login):
+        return {"login": login, "id": int(fake_sha(login)[:8], 16), "type": "User"}
+
+    def j_repo(self, base):
+        return {
+            "id": 1,
+            "name": self.repo,
+            "full_name": f"{self.owner}/{self.repo}",
+            "owner": self.user(self.owner),
+            "url": self.repo_url(base),
+            "default_branch": "master",
+        }
+
+    def j_pr(self, base, pr):
+        url = self.repo_url(base)
+        return {
+            "id": pr["number"],
+            "number": pr["number"],
+            "state": pr["state"],
+            "title": pr["title"],
+            "user": self.user(pr["author"]),
+            "labels": pr["labels"],
+            "url": f"{url}/pulls/{pr['number']}",
+            "issue_url": f"{url}/issues/{pr['number']}",
+            "head": {
+                "sha": pr["sha"],
+                "ref": f"pr-{pr['number']}",
+                "label": f"{pr['author']}:pr-{pr['number']}",
+            },
+            "base": {"sha": fake_sha("master"), "ref": "master", "label": "master"},
+            "created_at": fmt_date(pr["created"], self.name),
+            "updated_at": fmt_date(pr["updated"], self.name),
+        }
+
+    def j_commit(self, base, sha):
+        return {
+            "sha": sha,
+            "url": f"{self.repo_url(base)}/commits/{sha}",
+            "commit": {"message": "commit"},
+            "files": [],
+        }
+
+    def j_status(self, base, sha, status):
+        return {
+            "id": status["id"],
+            "state": status["state"],
+            # Forgejo
+            "status": status["state"],
+            "context": status["context"],
+            "description": status["description"],
+            "target_url": status["target_url"],
+            "creator": self.user(status["creator"]),
+            "url": f"{self.repo_url(base)}/statuses/{sha}",
+            "created_at": fmt_date(status["created"], self.name),
+        }
+
+    def j_comment(self, base, comment):
+        url = self.repo_url(base)
+        return {
+            "id": comment["id"],
+            "body": comment["body"],
+            "user": self.user(comment["user"]),
+            "url": f"{url}/issues/comments/{comment['id']}",
+            "issue_url": f"{url}/issues/{comment['pr']}",
+            "created_at": fmt_date(comment["created"], self.name),
+            "updated_at": fmt_date(comment["created"], self.name),
+        }
+
+    def j_team(self, base, team):
+        return {
+            "id": team["id"],
+            "name": team["name"],
+            "description": team["description"],
+            "url": f"{base}/teams/{team['id']}",
+        }
+
+    # endpoints: (method, pattern, handler(self, base, body, *groups))
+
+    def get_repo(self, base, body):
+        return self.j_repo(base)
+
+    def list_pulls(self, base, body, state="open"):
+        return [
+            self.j_pr(base, pr)
+            for pr in self.prs.values()
+            if state == "all" or pr["state"] == state
+        ]
+
+    def get_pull(self, base, body, number):
+        return self.j_pr(base, self.pr(number))
+
+    def patch_pull(self, base, body, number):
+        pr = self.pr(number)
+        if "title" in body:
+            pr["title"] = body["title"]
+        if "labels" in body:
+            pr["labels"] = [l for l in self.labels if l["id"] in body["labels"]]
+        pr["updated"] = self.tick()
+        return self.j_pr(base, pr)
+
+    def pull_commits(self, base, body, number):
+        return [self.j_commit(base, self.pr(number)["sha"])]
+
+    def pull_files(self, base, body, number):
+        self.pr(number)
+        return [{"filename": f"cat/pkg-{number}/pkg-{number}-1.ebuild"}]
+
+    def get_commit(self, base, body, sha):
+        return self.j_commit(base, sha)
+
+    def list_statuses(self, base, body, sha):
+        return [self.j_status(base, sha, s) for s in self.statuses.get(sha, [])]
+
+    def create_status(self, base, body, sha):
+        status = self.add_status(
+            sha,
+            body["state"],
+            body.get("context") or "default",
+            self.ci_user,
+            body.get("description") or "",
+            body.get("target_url") or "",
+        )
+        return self.j_status(base, sha, status)
+
+    def list_comments(self, base, body, number):
+        self.pr(number)
+        return [
+            self.j_comment(base, c)
+            for c in self.comments.values()
+            if c["pr"] == int(number)
+        ]
+
+    def create_comment(self, base, body, number):
+        self.pr(number)
+        return self.j_comment(
+            base, self.add_comment(number, self.ci_user, body["body"])
+        )
+
+    def get_comment(self, base, body, comment_id):
+        return self.j_comment(base, self.comment(comment_id))
+
+    def edit_comment(self, base, body, comment_id):
+        comment = self.comment(comment_id)
+        comment["body"] = body["body"]
+        return self.j_comment(base, comment)
+
+    def delete_comment(self, base, body, comment_id):
+        self.comment(comment_id)
+        del self.comments[int(comment_id)]
+
+    def list_labels(self, base, body):
+        return self.labels
+
+    def list_teams(self, base, body, org):
+        return [self.j_team(base, t) for t in self.teams.values()]
+
+    def create_team(self, base, body, org):
+        team = {
+            "id": next(self.ids),
+            "name": body["name"],
+            "description": body.get("description", ""),
+            "members": set(),
+        }
+        self.teams[team["id"]] = team
+        return self.j_team(base, team)
+
+    def delete_team(self, base, body, team_id):
+        self.team(team_id)
+        del self.teams[int(team_id)]
+
+    def team_members(self, base, body, team_id):
+        return [self.user(m) for m in sorted(self.team(team_id)["members"])]
+
+    def team_add_member(self, base, body, team_id, login):
+        self.team(team_id)["members"].add(login)
+
+    def team_remove_member(self, base, body, team_id, login):
+        self.team(team_id)["members"].discard(login)
+
+    def team_repos(self, base, body, team_id):
+        self.team(team_id)
+        return [self.j_repo(base)]
+
+    def list_org_members(self, base, body, org):
+        return [self.user(m) for m in sorted(self.org_members)]
+
+    def remove_org_member(self, base, body, org, login):
+        self.org_members.discard(login)
+        for team in self.teams.values():
+            team["members"].discard(login)
+
+    def pr(self, number):
+        try:
+            return self.prs[int(number)]
+        except (KeyError, ValueError):
+            raise NotFound()
+
+    def comment(self, comment_id):
+        try:
+            return self.comments[int(comment_id)]
+        except (KeyError, ValueError):
+            raise NotFound()
+
+    def team(self, team_id):
+        try:
+            return self.teams[int(team_id)]
+        except (KeyError, ValueError):
+            raise NotFound()
+
+
+REPO = r"/repos/[^/]+/[^/]+"
+
+ROUTES = [
+    ("GET", REPO, Forge.get_repo),
+    ("GET", REPO + r"/pulls", Forge.list_pulls),
+    ("GET", REPO + r"/pulls/(\d+)", Forge.get_pull),
+    ("PATCH", REPO + r"/pulls/(\d+)", Forge.patch_pull),
+    ("GET", REPO + r"/pulls/(\d+)/commits", Forge.pull_commits),
+    ("GET", REPO + r"/pulls/(\d+)/files", Forge.pull_files),
+    ("GET", REPO + r"/commits/(\w+)", Forge.get_commit),
+    ("GET", REPO + r"/commits/(\w+)/statuses", Forge.list_statuses),
+    ("GET", REPO + r"/statuses/(\w+)", Forge.list_statuses),
+    ("POST", REPO + r"/statuses/(\w+)", Forge.create_status),
+    ("GET", REPO + r"/issues/(\d+)/comments", Forge.list_comments),
+    ("POST", REPO + r"/issues/(\d+)/comments", Forge.create_comment),
+    ("GET", REPO + r"/issues/comments/(\d+)", Forge.get_comment),
+    ("PATCH", REPO + r"/issues/comments/(\d+)", Forge.edit_comment),
+    ("DELETE", REPO + r"/issues/comments/(\d+)", Forge.delete_comment),
+    ("GET", REPO + r"/labels", Forge.list_labels),
+    ("GET", r"/orgs/([^/]+)/teams/?", Forge.list_teams),
+    ("POST", r"/orgs/([^/]+)/teams/?", Forge.create_team),
+    ("GET", r"/orgs/([^/]+)/members", Forge.list_org_members),
+    ("DELETE", r"/orgs/([^/]+)/members/([^/]+)", Forge.remove_org_member),
+    ("DELETE", r"/teams/(\d+)", Forge.delete_team),
+    ("GET", r"/teams/(\d+)/members", Forge.team_members),
+    ("PUT", r"/teams/(\d+)/members/([^/]+)", Forge.team_add_member),
+    ("DELETE", r"/teams/(\d+)/members/([^/]+)", Forge.team_remove_member),
+    ("GET", r"/teams/(\d+)/repos", Forge.team_repos),
+]
+
+ROUTES = [(m, re.compile(p + "$"), h) for m, p, h in ROUTES]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, code, data, headers={}):
+        payload = json.dumps(data).encode() if data is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def control(self, method, path, query):
+        forges = self.server.forges
+        if method == "GET" and path == "/_stats":
+            self.send_json(
+                200,
+                {
+                    name: {"requests": f.requests, "endpoints": f.endpoints}
+                    for name, f in forges.items()
+                },
+            )
+        elif method == "POST" and path == "/_reset":
+            for f in forges.values():
+                with f.lock:
+                    f.reset_stats()
+            self.send_json(200, {})
+        elif method == "POST" and path == "/_push":
+            count = int(query.get("count", ["1"])[0])
+            for f in forges.values():
+                with f.lock:
+                    f.push(count)
+            self.send_json(200, {})
+        elif method == "POST" and path == "/_comments":
+            count = int(query.get("count", ["1"])[0])
+            for f in forges.values():
+                with f.lock:
+                    f.add_comments(count)
+            self.send_json(200, {})
+        else:
+            self.send_json(404, {"message": "Not Found"})
+
+    def paginate(self, forge, items, url, query):
+        """Return the requested page of items and the headers for it."""
+        if forge.name == "github":
+            per_page = int(query.get("per_page", ["30"])[0])
+        else:
+            per_page = int(query.get("limit", ["30"])[0])
+        per_page = max(1, min(per_page, forge.max_page))
+        page = max(1, int(query.get("page", ["1"])[0]))
+        last = max(1, -(-len(items) // per_page))
+
+        headers = {}
+        links = []
+        for rel, p in (("next", page + 1), ("last", last)):
+            if p <= last and page < last:
+                q = dict(query, page=[str(p)])
+                links.append(
+                    f'<{url}?{urllib.parse.urlencode(q, doseq=True)}>; rel="{rel}"'
+                )
+        # Codeberg does not provide the Link header for the list of teams
+        if links and not (forge.name == "codeberg" and "/teams" in url):
+            headers["Link"] = ", ".join(links)
+        if forge.name == "codeberg":
+            headers["X-Total-Count"] = str(len(items))
+        return items[(page - 1) * per_page : page * per_page], headers
+
+    def dispatch(self, method):
+        time.sleep(self.server.latency)
+        parsed = urllib.parse.urlsplit(self.path)
+        path = parsed.path
+        query = urllib.parse.parse_qs(parsed.query)
+        if path.startswith("/_"):
+            return self.control(method, path, query)
+
+        for prefix, name in ((GITHUB_PREFIX, "github"), (CODEBERG_PREFIX, "codeberg")):
+            if path.startswith(prefix + "/"):
+                forge = self.server.forges[name]
+                base = f"http://{self.headers['Host']}{prefix}"
+                path = path[len(prefix) :]
+                break
+        else:
+            return self.send_json(404, {"message": "Not Found"})
+
+        for route_method, pattern, handler in ROUTES:
+            m = pattern.match(path)
+            if m is not None and route_method == method:
+                break
+        else:
+            return self.send_json(404, {"message": "Not Found"})
+
+        try:
+            body = self.read_body()
+            with forge.lock:
+                forge.count(f"{method} {pattern.pattern[:-1]}")
+                args = m.groups()
+                if handler is Forge.list_pulls:
+                    args = (query.get("state", ["open"])[0],)
+                data = handler(forge, base, body, *args)
+                headers = forge.rate_headers()
+        except RateLimitExceeded:
+            if forge.name == "github":
+                return self.send_json(
+                    403, {"message": "API rate limit exceeded"}, forge.rate_headers()
+                )
+            return self.send_json(429, {"message": "rate limited"})
+        except NotFound:
+            return self.send_json(404, {"message": "Not Found"})
+        except (KeyError, ValueError) as e:
+            return self.send_json(422, {"message": f"invalid request: {e!r}"})
+
+        if data is None:
+            self.send_json(204, None, headers)
+        elif isinstance(data, list):
+            data, page_headers = self.paginate(
+                forge, data, base + path, query
+            )
+            self.send_json(200, data, dict(headers, **page_headers))
+        else:
+            self.send_json(201 if method == "POST" else 200, data, headers)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--host", default="127.0.0.1")
+    argp.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    argp.add_argument("--prs", type=int, default=100, help="open PRs per forge")
+    argp.add_argument("--latency", type=float, default=0, help="per request (ms)")
+    argp.add_argument(
+        "--rate-limit", type=int, default=0, help="requests per window (0: none)"
+    )
+    argp.add_argument("--rate-window", type=float, default=3600, help="seconds")
+    argp.add_argument(
+        "--processed", type=float, default=0.5, help="share of PRs checked already"
+    )
+    argp.add_argument("--noci", type=float, default=0.03, help="share labelled noci")
+    argp.add_argument(
+        "--priority", type=float, default=0.05, help="share labelled priority-ci"
+    )
+    argp.add_argument("--github-repo", default="gentoo/gentoo")
+    argp.add_argument("--github-user", default="gentoo-repo-qa-bot")
+    argp.add_argument("--codeberg-repo", default="gentoo/gentoo")
+    argp.add_argument("--codeberg-user", default="gentoo-bot")
+    argp.add_argument("--seed", type=int, default=0)
+    argp.add_argument("-v", "--verbose", action="store_true")
+    args = argp.parse_args()
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.latency = args.latency / 1000
+    server.verbose = args.verbose
+    server.forges = {
+        "github": Forge("github", args, *args.github_repo.split("/"), args.github_user),
+        "codeberg": Forge(
+            "codeberg", args, *args.codeberg_repo.split("/"), args.codeberg_user
+        ),
+    }
+
+    host, port = server.server_address[:2]
+    print(f"listening on http://{host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
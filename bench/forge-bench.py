@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Benchmark the pull request scanning and reporting scripts against
+# the local stand-in forge (fake-forge.py).
+#
+# usage: forge-bench.py [--sizes 10,100,1000] [--latency MS]
+#                       [--baseline FILE] [--update-baseline]
+#
+# For every number of open PRs, the following steps are run against
+# a fresh forge, counting the API requests and the wall time:
+#
+#   scan-cold  scan-pull-requests.py with an empty PR database
+#   scan-warm  scan-pull-requests.py again, after 10% of PRs were updated
+#   report     report-pull-request.py for the first queued PR, which
+#              has COMMENTS comments by others and an earlier report
+#   report-2   report-pull-request.py again (editing the cached comment)
+#   status     set-pull-request-status.py for the same PR
+#
+# The reports and statuses are run for both forges.
+#
+# Requests per open PR (or per call, for the single-PR steps) are
+# compared against the baseline file (forge-baseline.json next to this
+# script by default), failing if any of them increased.  Note that
+# PyGithub spaces requests (writes in particular) itself, which dominates
+# the wall time on GitHub.
+
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PR_DIR = os.path.join(os.path.dirname(BENCH_DIR), "pull-request")
+
+GITHUB_USERNAME = "gentoo-repo-qa-bot"
+CODEBERG_USERNAME = "gentoo-bot"
+
+# steps whose requests scale with the number of open PRs
+PER_PR_STEPS = ("scan-cold", "scan-warm")
+# comments by others on every PR before the reports (besides our own)
+COMMENTS = 5
+
+
+class FakeForge:
+    def __init__(self, prs, latency):
+        self.proc = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(BENCH_DIR, "fake-forge.py"),
+                f"--prs={prs}",
+                f"--latency={latency}",
+                f"--github-user={GITHUB_USERNAME}",
+                f"--codeberg-user={CODEBERG_USERNAME}",
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        line = self.proc.stdout.readline()
+        if not line.startswith("listening on "):
+            self.proc.kill()
+            raise RuntimeError("fake-forge.py failed to start")
+        self.url = line.split()[-1]
+
+    def control(self, method, path):
+        req = urllib.request.Request(self.url + path, method=method)
+        with urllib.request.urlopen(req) as f:
+            return json.load(f)
+
+    def head(self, forge_name, prid):
+        """Return the head of the PR (counted as a request)."""
+        prefix = {"github": "/github", "codeberg": "/codeberg/api/v1"}[forge_name]
+        with urllib.request.urlopen(
+            f"{self.url}{prefix}/repos/gentoo/gentoo/pulls/{prid}"
+        ) as f:
+            return json.load(f)["head"]["sha"]
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def run_step(forge, env, cmd):
+    """Run cmd, return (stdout, wall time, requests per forge)."""
+    forge.control("POST", "/_reset")
+    start = time.monotonic()
+    out = subprocess.run(
+        [sys.executable, *cmd], env=env, stdout=subprocess.PIPE, text=True, check=True
+    ).stdout
+    wall = time.monotonic() - start
+    stats = forge.control("GET", "/_stats")
+    return out, wall, {k: v["requests"] for k, v in stats.items()}
+
+
+def bench(prs, args, tmpdir):
+    forge = FakeForge(prs, args.latency)
+    try:
+        for name in ("github", "codeberg"):
+            with open(os.path.join(tmpdir, f"{name}-token"), "w") as f:
+                f.write("token\n")
+        env = dict(
+            os.environ,
+            GITHUB_API_URL=forge.url + "/github",
+            GITHUB_USERNAME=GITHUB_USERNAME,
+            GITHUB_TOKEN_FILE=os.path.join(tmpdir, "github-token"),
+            GITHUB_REPO="gentoo/gentoo",
+            CODEBERG_API_URL=forge.url + "/codeberg/api/v1",
+            CODEBERG_USERNAME=CODEBERG_USERNAME,
+            CODEBERG_TOKEN_FILE=os.path.join(tmpdir, "codeberg-token"),
+            CODEBERG_REPO="gentoo/gentoo",
+            PULL_REQUEST_DB=os.path.join(tmpdir, "state.pickle"),
+            PULL_REQUEST_REQUEUE=os.path.join(tmpdir, "requeue"),
+            PULL_REQUEST_COMMENT_DB=os.path.join(tmpdir, "comments.pickle"),
+            PULL_REQUEST_CLOSED=os.path.join(tmpdir, "closed.json"),
+            # print the whole queue
+            PULL_REQUEST_BATCH_SIZE=str(2 * prs),
+            GENTOO_CI_URI_PREFIX="https://example.org/gentoo-ci",
+        )
+        for f in ("state.pickle", "requeue", "comments.pickle", "closed.json"):
+            if os.path.exists(os.path.join(tmpdir, f)):
+                os.unlink(os.path.join(tmpdir, f))
+
+        results = {}
+        scan = [os.path.join(PR_DIR, "scan-pull-requests.py")]
+        out, wall, reqs = run_step(forge, env, scan)
+        results["scan-cold"] = (wall, reqs)
+        forge.control("POST", f"/_push?count={max(1, prs // 10)}")
+        out, wall, reqs = run_step(forge, env, scan)
+        results["scan-warm"] = (wall, reqs)
+
+        borked = os.path.join(tmpdir, "borked.list")
+        with open(borked, "w") as f:
+            f.write("cat/pkg-1\n")
+        pre_borked = os.path.join(tmpdir, "pre-borked.list")
+        open(pre_borked, "w").close()
+
+        # the first queued PR of each forge
+        queue = out.split()
+        forge.control("POST", f"/_comments?count={COMMENTS}")
+        first = {}
+        for pr_key in queue:
+            first.setdefault(pr_key.split("/")[0], pr_key)
+        for forge_name, pr_key in sorted(first.items()):
+            report = [
+                os.path.join(PR_DIR, "report-pull-request.py"),
+                forge_name,
+                pr_key.split("/")[1],
+                "hash",
+                borked,
+                pre_borked,
+                forge.head(forge_name, pr_key.split("/")[1]),
+            ]
+            status = [
+                os.path.join(PR_DIR, "set-pull-request-status.py"),
+                pr_key,
+                "error",
+                "benchmark",
+            ]
+            results[f"report/{forge_name}"] = run_step(forge, env, report)[1:]
+            results[f"report-2/{forge_name}"] = run_step(forge, env, report)[1:]
+            # the status is set for the PR being processed, whose head
+            # is in the db
+            with open(env["PULL_REQUEST_DB"], "rb") as f:
+                db = pickle.load(f)
+            db[pr_key] = forge.head(forge_name, pr_key.split("/")[1])
+            with open(env["PULL_REQUEST_DB"], "wb") as f:
+                pickle.dump(db, f)
+            results[f"status/{forge_name}"] = run_step(forge, env, status)[1:]
+        return results
+    finally:
+        forge.close()
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument(
+        "--sizes",
+        type=lambda x: [int(n) for n in x.split(",")],
+        default=[10, 100, 1000],
+        help="comma-separated numbers of open PRs",
+    )
+    argp.add_argument("--latency", type=float, default=0, help="per request (ms)")
+    argp.add_argument(
+        "--baseline", default=os.path.join(BENCH_DIR, "forge-baseline.json")
+    )
+    argp.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the results as the new baseline",
+    )
+    args = argp.parse_args()
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    current = {}
+    failed = False
+    print(
+        f"{'prs':>5} {'step':17} {'wall':>8} {'github':>7} {'codeberg':>8} "
+        f"{'per PR':>7} {'baseline':>8}"
+    )
+    with tempfile.TemporaryDirectory(prefix="forge-bench.") as tmpdir:
+        for prs in args.sizes:
+            for step, (wall, reqs) in bench(prs, args, tmpdir).items():
+                total = sum(reqs.values())
+                # both forges have the given number of open PRs
+                per_pr = total / (2 * prs) if step in PER_PR_STEPS else total
+                current.setdefault(step, {})[str(prs)] = round(per_pr, 3)
+                base = baseline.get(step, {}).get(str(prs))
+                flag = ""
+                if base is not None and per_pr > base + 1e-3:
+                    flag = " !"
+                    failed = True
+                print(
+                    f"{prs:5} {step:17} {wall:8.2f} {reqs['github']:7} "
+                    f"{reqs['codeberg']:8} {per_pr:7.2f} "
+                    f"{'-' if base is None else f'{base:.2f}':>8}{flag}"
+                )
+
+    if args.update_baseline:
+        for step, values in current.items():
+            baseline.setdefault(step, {}).update(values)
+        with open(args.baseline + ".tmp", "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.rename(args.baseline + ".tmp", args.baseline)
+        return 0
+
+    if failed:
+        print("requests per PR increased over the baseline", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
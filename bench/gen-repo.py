@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# Generate a synthetic ebuild repository with git history, for benchmarks.
+#
+# usage: gen-repo.py [options] <directory>
+#
+# The repository is named "gentoo" and contains the given number
+# of categories and packages, chains of eclasses inheriting one another,
+# a single profile and a history of commits replaying a realistic mix
+# of version bumps, removals, new packages, eclass and metadata changes.
+# With --break-at, the given commit introduces a global-scope failure,
+# to be found by bisection.
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+
+DEVELOPERS = [f"dev{i}" for i in range(20)]
+USE_FLAGS = [f"flag{i}" for i in range(30)]
+
+# (operation, weight) of replayed commits
+OPERATIONS = (
+    ("bump", 50),
+    ("drop", 20),
+    ("metadata", 15),
+    ("new", 10),
+    ("eclass", 5),
+)
+
+EBUILD = """\
+# Copyright 2024 Gentoo Authors
+# Distributed under the terms of the GNU General Public License v2
+
+EAPI=8
+
+inherit {eclass}
+
+DESCRIPTION="Synthetic package {pn}"
+HOMEPAGE="https://example.org/{pn}"
+
+LICENSE="MIT"
+SLOT="0"
+KEYWORDS="{keywords}"
+IUSE="{iuse}"
+
+RDEPEND="{rdepend}"
+{extra}"""
+
+ECLASS = """\
+# Copyright 2024 Gentoo Authors
+# Distributed under the terms of the GNU General Public License v2
+
+# @ECLASS: {name}.eclass
+# @MAINTAINER:
+# bench@example.org
+# @SUPPORTED_EAPIS: 8
+# @BLURB: Synthetic eclass {name}
+# @DESCRIPTION:
+# Revision {revision}.
+
+if [[ -z ${{_{guard}_ECLASS}} ]]; then
+_{guard}_ECLASS=1
+
+{inherit}
+IUSE+=" {flag}"
+
+{name}_src_configure() {{
+	default
+}}
+
+fi
+
+EXPORT_FUNCTIONS src_configure
+"""
+
+METADATA_XML = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE pkgmetadata SYSTEM "https://www.gentoo.org/dtd/metadata.dtd">
+<pkgmetadata>
+	<maintainer type="person">
+		<email>{dev}@example.org</email>
+	</maintainer>
+	<longdescription>{desc}</longdescription>
+</pkgmetadata>
+"""
+
+
+class Generator:
+    def __init__(self, path, args):
+        self.path = path
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.time = 1700000000
+        # cat/pn -> list of versions
+        self.packages = {}
+        self.eclasses = []
+        self.eclass_revisions = {}
+
+    def write(self, relpath, data):
+        path = os.path.join(self.path, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(data)
+
+    def git(self, *args, env=None):
+        subprocess.check_call(["git", *args], cwd=self.path, env=env)
+
+    def commit(self, msg, paths):
+        dev = self.rng.choice(DEVELOPERS)
+        self.time += self.rng.randint(60, 3600)
+        env = dict(
+            os.environ,
+            GIT_AUTHOR_NAME=dev,
+            GIT_AUTHOR_EMAIL=f"{dev}@example.org",
+            GIT_AUTHOR_DATE=f"{self.time} +0000",
+            GIT_COMMITTER_NAME=dev,
+            GIT_COMMITTER_EMAIL=f"{dev}@example.org",
+            GIT_COMMITTER_DATE=f"{self.time} +0000",
+        )
+        self.git("add", "-A", "--", *paths)
+        self.git("commit", "-q", "--no-gpg-sign", "-m", msg, env=env)
+
+    def write_eclass(self, name):
+        revision = self.eclass_revisions.get(name, 0) + 1
+        self.eclass_revisions[name] = revision
+        chain, depth = name.rsplit("-d", 1)
+        parent = f"{chain}-d{int(depth) - 1}" if int(depth) > 0 else None
+        self.write(
+            f"eclass/{name}.eclass",
+            ECLASS.format(
+                name=name,
+                guard=name.upper().replace("-", "_"),
+                inherit=f"inherit {parent}" if parent else "",
+                flag=self.rng.choice(USE_FLAGS),
+                revision=revision,
+            ),
+        )
+        return f"eclass/{name}.eclass"
+
+    def write_ebuild(self, pkg, version, broken=False):
+        cat, pn = pkg.split("/")
+        others = self.rng.sample(
+            sorted(self.packages), min(3, len(self.packages))
+        )
+        deps = [x for x in others[: self.rng.randint(0, 3)] if x != pkg]
+        path = f"{pkg}/{pn}-{version}.ebuild"
+        self.write(
+            path,
+            EBUILD.format(
+                pn=pn,
+                eclass=self.rng.choice(self.eclasses),
+                keywords=self.rng.choice(("amd64", "~amd64")),
+                iuse=" ".join(self.rng.sample(USE_FLAGS, self.rng.randint(0, 4))),
+                rdepend=" ".join(deps),
+                extra='\ndie "broken in global scope"\n' if broken else "",
+            ),
+        )
+        return path
+
+    def write_metadata(self, pkg):
+        path = f"{pkg}/metadata.xml"
+        self.write(
+            path,
+            METADATA_XML.format(
+                dev=self.rng.choice(DEVELOPERS),
+                desc=f"Revision {self.rng.randint(0, 1 << 30)}",
+            ),
+        )
+        return path
+
+    def new_version(self, versions):
+        major, minor = versions[-1].split(".") if versions else ("0", "0")
+        if self.rng.random() < 0.2:
+            return f"{int(major) + 1}.0"
+        return f"{major}.{int(minor) + 1}"
+
+    def initial(self):
+        a = self.args
+        categories = [f"cat-{i}" for i in range(a.categories)]
+        self.write("profiles/repo_name", "gentoo\n")
+        self.write("profiles/categories", "".join(f"{c}\n" for c in categories))
+        self.write("profiles/arch.list", "amd64\n")
+        self.write("profiles/profiles.desc", "amd64 default/linux/amd64 stable\n")
+        self.write("profiles/eapi", "8\n")
+        self.write(
+            "profiles/use.desc",
+            "".join(f"{f} - Synthetic flag {f}\n" for f in USE_FLAGS),
+        )
+        self.write("profiles/default/linux/amd64/eapi", "8\n")
+        self.write(
+            "profiles/default/linux/amd64/make.defaults",
+            'ARCH="amd64"\nACCEPT_KEYWORDS="amd64"\nELIBC="glibc"\n'
+            'KERNEL="linux"\nUSERLAND="GNU"\n',
+        )
+        self.write(
+            "metadata/layout.conf",
+            "masters =\nthin-manifests = true\nsign-manifests = false\n"
+            "cache-formats = md5-dict\n",
+        )
+        self.write("licenses/MIT", "MIT license\n")
+
+        for chain in range(max(1, a.eclasses // a.eclass_depth)):
+            for depth in range(a.eclass_depth):
+                name = f"bench{chain}-d{depth}"
+                self.eclasses.append(name)
+                self.write_eclass(name)
+
+        for cat in categories:
+            for i in range(a.packages):
+                self.packages[f"{cat}/pkg-{i}"] = []
+        for pkg in sorted(self.packages):
+            for i in range(a.versions):
+                version = self.new_version(self.packages[pkg])
+                self.packages[pkg].append(version)
+                self.write_ebuild(pkg, version)
+            self.write_metadata(pkg)
+
+        self.git("init", "-q", "-b", "master")
+        self.commit("Initial commit", ["."])
+
+    def replay(self):
+        ops, weights = zip(*OPERATIONS)
+        for n in range(1, self.args.commits + 1):
+            op = self.rng.choices(ops, weights)[0]
+            pkg = self.rng.choice(sorted(self.packages))
+            versions = self.packages[pkg]
+
+            if n == self.args.break_at:
+                version = self.new_version(versions)
+                versions.append(version)
+                paths = [self.write_ebuild(pkg, version, broken=True)]
+                msg = f"{pkg}: add {version}"
+            elif op == "bump" or (op == "drop" and len(versions) < 2):
+                version = self.new_version(versions)
+                versions.append(version)
+                paths = [self.write_ebuild(pkg, version)]
+                msg = f"{pkg}: add {version}"
+            elif op == "drop":
+                version = versions.pop(0)
+                path = f"{pkg}/{pkg.split('/')[1]}-{version}.ebuild"
+                os.unlink(os.path.join(self.path, path))
+                paths = [path]
+                msg = f"{pkg}: drop {version}"
+            elif op == "metadata":
+                paths = [self.write_metadata(pkg)]
+                msg = f"{pkg}: update metadata"
+            elif op == "new":
+                cat = pkg.split("/")[0]
+                pkg = f"{cat}/new-pkg-{n}"
+                self.packages[pkg] = ["1.0"]
+                paths = [self.write_ebuild(pkg, "1.0"), self.write_metadata(pkg)]
+                msg = f"{pkg}: new package, add 1.0"
+            else:
+                name = self.rng.choice(self.eclasses)
+                paths = [self.write_eclass(name)]
+                msg = f"{name}.eclass: update"
+
+            self.commit(msg, paths)
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--categories", type=int, default=10)
+    argp.add_argument("--packages", type=int, default=10, help="per category")
+    argp.add_argument("--versions", type=int, default=2, help="per package")
+    argp.add_argument("--eclasses", type=int, default=8)
+    argp.add_argument("--eclass-depth", type=int, default=3)
+    argp.add_argument("--commits", type=int, default=50, help="history length")
+    argp.add_argument("--break-at", type=int, help="commit introducing breakage")
+    argp.add_argument("--seed", type=int, default=0)
+    argp.add_argument("directory")
+    args = argp.parse_args()
+
+    if os.path.exists(args.directory) and os.listdir(args.directory):
+        print(f"{args.directory} exists and is not empty", file=sys.stderr)
+        return 1
+    os.makedirs(args.directory, exist_ok=True)
+
+    gen = Generator(args.directory, args)
+    gen.initial()
+    gen.replay()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,8 @@
 
 set -e -x
 
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
 trap 'exit 255' EXIT
 
 dir=${1}
@@ -34,16 +36,31 @@ git checkout -q "${current_commit}"
 # re-checking the same commits in next bisect
 # however, we only return result for the first one
 
-sudo -u "${WORKER_USER}" SYNC_DIR="${SYNC_DIR}" MIRROR_DIR="${MIRROR_DIR}" \
-	GLSA_DIR="${MIRROR_DIR}"/gentoo/metadata/glsa \
-	bwrap --bind / / --dev /dev --proc /proc --unshare-all \
-	--uid $(id -u "${WORKER_USER}") --gid $(id -g "${WORKER_USER}") \
-	${DATA_DIR}/pkgcheck-wrapper "${CONFIG_ROOT_GENTOO_CI}/etc/portage" \
-	"${dir}" "${dir}"/gentoo \
-	pkgcheck --config "${CONFIG_DIR}" scan --reporter XmlReporter "${@}" \
-	--glsa-dir "${MIRROR_DIR}"/gentoo/metadata/glsa \
-	${PKGCHECK_BISECT_OPTIONS} \
-	> "${BISECT_TMP}/.bisect.tmp.xml"
+pkgcheck_args=(
+	pkgcheck --config "${CONFIG_DIR}" scan --reporter XmlReporter "${@}"
+	--glsa-dir "${MIRROR_DIR}"/gentoo/metadata/glsa
+	${PKGCHECK_BISECT_OPTIONS}
+)
+
+if [[ -n ${PKGCORE_WORKER_SOCK} && -S ${PKGCORE_WORKER_SOCK} ]]; then
+	# use the warm worker started by borked-state.py (only its user may
+	# connect to it)
+	trace_span bisect-probe commit="${current_commit}" worker=1 -- \
+		sudo -u "${WORKER_USER}" \
+		"${SCRIPT_DIR}"/gentoo-ci/pkgcore-worker.py run "${PKGCORE_WORKER_SOCK}" -- \
+		"${pkgcheck_args[@]}" \
+		> "${BISECT_TMP}/.bisect.tmp.xml"
+else
+	trace_span bisect-probe commit="${current_commit}" -- \
+		sudo -u "${WORKER_USER}" SYNC_DIR="${SYNC_DIR}" MIRROR_DIR="${MIRROR_DIR}" \
+		GLSA_DIR="${MIRROR_DIR}"/gentoo/metadata/glsa \
+		bwrap --bind / / --dev /dev --proc /proc --unshare-all \
+		--uid $(id -u "${WORKER_USER}") --gid $(id -g "${WORKER_USER}") \
+		${DATA_DIR}/pkgcheck-wrapper "${CONFIG_ROOT_GENTOO_CI}/etc/portage" \
+		"${dir}" "${dir}"/gentoo \
+		"${pkgcheck_args[@]}" \
+		> "${BISECT_TMP}/.bisect.tmp.xml"
+fi
 
 "${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
 	-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
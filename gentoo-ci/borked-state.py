@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# Compare the current gentoo-ci results against the previous run, bisect
+# new breakages, update the blame store and write the mail and IRC
+# payloads for report-borked.bash.
+#
+# usage: borked-state.py <previous-commit> <next-commit> <output-dir>
+#
+# Output (only if there is anything to report):
+# - mail: the complete mail, with headers
+# - mail.rcpt: envelope recipients, one per line
+# - irc: IRC messages, one per line
+
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# how long to wait for pkgcore-worker.py to start (seconds)
+WORKER_START_TIMEOUT = 60
+
+CROAKER = "I am croaker, the herald of doom! ( https://wiki.gentoo.org/wiki/Project:Repository_mirror_and_CI#Croaker_Q.26A )"
+
+
+def read_list(path):
+    try:
+        with open(path) as f:
+            return [l.strip() for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def diff_lists(last_path, current_path):
+    """Return (fixed, old, new) lists, in the order diff would."""
+    last = read_list(last_path)
+    current = read_list(current_path)
+    last_set = set(last)
+    current_set = set(current)
+    fixed = [l for l in last if l not in current_set]
+    old = [l for l in current if l in last_set]
+    new = [l for l in current if l not in last_set]
+    return fixed, old, new
+
+
+class BlameStore:
+    """
+    Package -> commit mapping stored as "<pkg> <commit>" lines,
+    in blame.e (errors) and blame.w (warnings).
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.blame = {}
+        for flag in ("e", "w"):
+            self.blame[flag] = {}
+            for l in read_list(f"{prefix}.{flag}"):
+                pkg, commit = l.split()
+                self.blame[flag].setdefault(pkg, commit)
+        self.dirty = set()
+
+    def add(self, flag, pkg, commit):
+        self.blame[flag][pkg] = commit
+        self.dirty.add(flag)
+
+    def pop(self, flag, pkg):
+        commit = self.blame[flag].pop(pkg, None)
+        if commit is not None:
+            self.dirty.add(flag)
+        return commit
+
+    def save(self):
+        for flag in self.dirty:
+            path = f"{self.prefix}.{flag}"
+            with open(path + ".tmp", "w") as f:
+                for pkg, commit in self.blame[flag].items():
+                    f.write(f"{pkg} {commit}\n")
+            os.rename(path + ".tmp", path)
+
+
+def subject_and_message(new, fixed, old, wnew, wfixed, wold):
+    subject = None
+    msg = None
+
+    # first, determine the state wrt warnings
+    if wnew:
+        subject = "WARNING: new warnings for the repo!"
+        msg = "Looks like someone is doing nasty stuff!"
+    elif wfixed:
+        if wold:
+            subject = "WARNING: some warnings have been fixed"
+            msg = "That's nice but more to go!"
+        else:
+            subject = "FIXED: all warnings have been fixed"
+            msg = "No way! We're clean as a pin!"
+
+    # then determine the state wrt errors (which are considered more
+    # important and therefore overwrite warnings statuses)
+    if new:
+        if old:
+            subject = "BROKEN: new breakage found"
+            msg = "Nononononono!"
+        else:
+            subject = "BROKEN: repository became broken!"
+            msg = "Looks like someone just broke Gentoo!"
+    elif fixed:
+        if old:
+            subject = "BROKEN: repository is slightly less broken!"
+            msg = "Looks like some of the breakage has been fixed but not all!"
+        else:
+            subject = "FIXED: all failures have been fixed"
+            msg = "Everything seems nice and cool now."
+
+    return subject, msg
+
+
+class Worker:
+    """Sandboxed pkgcore-worker.py server used for bisect probes."""
+
+    def __init__(self, proc, directory):
+        self.proc = proc
+        self.directory = directory
+        self.sock = os.path.join(directory, "sock")
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        subprocess.call(
+            ["sudo", "-u", os.environ["WORKER_USER"], "rm", "-rf", self.directory]
+        )
+
+
+def start_worker():
+    """
+    Start pkgcore-worker.py in the same confinement as pkgcheck runs,
+    return a Worker or None if it failed to start.
+    """
+    WORKER_USER = os.environ["WORKER_USER"]
+    SYNC_DIR = os.environ["SYNC_DIR"]
+    MIRROR_DIR = os.environ["MIRROR_DIR"]
+    CONFIG_DIR = os.environ["CONFIG_DIR"]
+    pw = pwd.getpwnam(WORKER_USER)
+
+    # the worker needs to be able to create the socket
+    directory = subprocess.check_output(
+        ["sudo", "-u", WORKER_USER, "mktemp", "-d"], text=True
+    ).strip()
+    proc = subprocess.Popen(
+        [
+            "sudo",
+            "-u",
+            WORKER_USER,
+            f"SYNC_DIR={SYNC_DIR}",
+            f"MIRROR_DIR={MIRROR_DIR}",
+            f"GLSA_DIR={MIRROR_DIR}/gentoo/metadata/glsa",
+            f"PKGCORE_WORKER_DIR={directory}",
+            "bwrap",
+            "--bind",
+            "/",
+            "/",
+            "--dev",
+            "/dev",
+            "--proc",
+            "/proc",
+            "--unshare-all",
+            "--die-with-parent",
+            "--uid",
+            str(pw.pw_uid),
+            "--gid",
+            str(pw.pw_gid),
+            os.path.join(os.environ["DATA_DIR"], "pkgcheck-wrapper"),
+            os.path.join(os.environ["CONFIG_ROOT_GENTOO_CI"], "etc/portage"),
+            SYNC_DIR,
+            os.path.join(SYNC_DIR, "gentoo"),
+            "python3",
+            os.path.join(os.environ["SCRIPT_DIR"], "gentoo-ci/pkgcore-worker.py"),
+            "serve",
+            os.path.join(directory, "sock"),
+            CONFIG_DIR,
+            os.path.join(SYNC_DIR, "gentoo"),
+        ],
+        stdout=sys.stderr,
+    )
+    worker = Worker(proc, directory)
+
+    # wait for the socket to appear
+    for i in range(WORKER_START_TIMEOUT * 10):
+        if os.path.exists(worker.sock):
+            return worker
+        if proc.poll() is not None:
+            break
+        time.sleep(0.1)
+    print(
+        "pkgcore-worker.py failed to start, running pkgcheck directly",
+        file=sys.stderr,
+    )
+    worker.stop()
+    return None
+
+
+def bisect(new, wnew, previous_commit, next_commit, blame):
+    """
+    Bisect new breakages, record the blame and return the list
+    of breaking commits.
+    """
+    SYNC_DIR = os.environ["SYNC_DIR"]
+    DATA_DIR = os.environ["DATA_DIR"]
+    SCRIPT_DIR = os.environ["SCRIPT_DIR"]
+    gentoo = os.path.join(SYNC_DIR, "gentoo")
+
+    bisect_tmp = tempfile.mkdtemp()
+    worker = None
+    try:
+        shutil.copy(os.path.join(DATA_DIR, ".gitconfig"), bisect_tmp)
+        os.makedirs(os.path.join(bisect_tmp, ".config/pkgcore"))
+        with open(os.path.join(SCRIPT_DIR, "gentoo-ci/pkgcore.conf.in")) as f:
+            conf = f.read().replace("@path@", gentoo)
+        with open(os.path.join(bisect_tmp, ".config/pkgcore/pkgcore.conf"), "w") as f:
+            f.write(conf)
+        env = dict(os.environ, BISECT_TMP=bisect_tmp)
+        if os.environ.get("PKGCORE_WORKER"):
+            worker = start_worker()
+            if worker is not None:
+                env["PKGCORE_WORKER_SOCK"] = worker.sock
+
+        # check one commit extra to make sure the breakages were introduced
+        # in the commit set; this could happen e.g. when new checks
+        # are added on top of already-broken repo
+        pre_previous_commit = subprocess.check_output(
+            ["git", "rev-parse", f"{previous_commit}^"], cwd=gentoo, text=True
+        ).strip()
+
+        broken_commits = []
+        flag = "e"
+        args = [x.rsplit("#", 1)[-1] for x in new]
+        args += ["-WARN-"] + [x.rsplit("#", 1)[-1] for x in wnew]
+        while args:
+            if args[0] == "-WARN-":
+                flag = "w"
+                args.pop(0)
+                continue
+
+            # bisect-borked.bash checks all the remaining packages at once
+            # (and caches the results) but returns the result for the first
+            commit = subprocess.check_output(
+                [
+                    os.path.join(SCRIPT_DIR, "gentoo-ci/bisect-borked.bash"),
+                    next_commit,
+                    pre_previous_commit,
+                    flag,
+                ]
+                + args,
+                env=env,
+                text=True,
+            ).strip()
+            pkg = args.pop(0)
+
+            # skip breakages introduced before the commit set
+            if pre_previous_commit.startswith(commit):
+                continue
+
+            # record the blame!
+            blame.add(flag, pkg, commit)
+            if commit not in broken_commits:
+                broken_commits.append(commit)
+    finally:
+        if worker is not None:
+            worker.stop()
+        shutil.rmtree(bisect_tmp)
+
+    return broken_commits
+
+
+def commit_addresses(commits):
+    """
+    Get author and committer addresses for all commits using a single
+    git log call, return a dict commit -> list of addresses.  Unknown
+    commits are skipped.
+    """
+    if not commits:
+        return {}
+    gentoo = os.path.join(os.environ["SYNC_DIR"], "gentoo")
+    # resolve them first, so that one bad commit does not fail all
+    out = subprocess.run(
+        ["git", "cat-file", "--batch-check=%(objectname) %(objecttype)"],
+        cwd=gentoo,
+        input="".join(f"{c}^{{commit}}\n" for c in commits),
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    full = {}
+    for c, l in zip(commits, out.splitlines()):
+        if l.endswith(" commit"):
+            full[c] = l.split()[0]
+        else:
+            print(f"{c}: unknown commit, not mailing its authors", file=sys.stderr)
+    if not full:
+        return {}
+
+    out = subprocess.check_output(
+        ["git", "log", "--no-walk=unsorted", "--pretty=%H %ae %ce"]
+        + sorted(set(full.values())),
+        cwd=gentoo,
+        text=True,
+    )
+    by_hash = {}
+    for l in out.splitlines():
+        h, *addrs = l.split()
+        by_hash[h] = addrs
+
+    return {c: by_hash[h] for c, h in full.items() if h in by_hash}
+
+
+def make_mail(
+    subject,
+    msg,
+    mail_cc,
+    current_rev,
+    new,
+    wnew,
+    fixed,
+    wfixed,
+    old,
+    wold,
+    broken_commits,
+    previous_commit,
+    next_commit,
+):
+    uri_prefix = os.environ["GENTOO_CI_URI_PREFIX"]
+    mail_to = os.environ["GENTOO_CI_MAIL"]
+    commit_uri = os.environ["GENTOO_CI_GITWEB_COMMIT_URI"]
+    report_uri = f"{uri_prefix}/{current_rev}/output.html;pkg="
+
+    mail = f"Subject: {subject}\nTo: <{mail_to}>\n"
+    if mail_cc:
+        mail += "CC: " + ", ".join(f"<{a}>" for a in mail_cc) + "\n"
+    mail += f"Content-Type: text/plain; charset=utf8\n\n{msg}\n\n"
+
+    # need to escape for the script
+    if new:
+        mail += f"New issues ({len(new)}):\n"
+        mail += "\n".join(report_uri + x.replace("/", ":") for x in new)
+        mail += "\n\n\n"
+    if wnew:
+        mail += f"New warnings ({len(wnew)}):\n"
+        mail += "\n".join(report_uri + x.replace("/", ":") for x in wnew)
+        mail += "\n\n\n"
+    if fixed:
+        mail += f"Issues fixed since last run ({len(fixed)}):\n"
+        mail += "\n".join(fixed) + "\n\n\n"
+    if wfixed:
+        mail += f"Warnings fixed since last run ({len(wfixed)}):\n"
+        mail += "\n".join(wfixed) + "\n\n\n"
+    if broken_commits:
+        mail += "Introduced by commits:\n"
+        mail += "\n".join(commit_uri + c for c in broken_commits) + "\n\n\n"
+    mail += "Changes since last check:\n"
+    gitweb_uri = os.environ["GENTOO_CI_GITWEB_URI"]
+    mail += f"{gitweb_uri}{previous_commit}..{next_commit}\n\n\n"
+    if old:
+        mail += f"Previous issues still unfixed: {len(old)}\n"
+    if wold:
+        mail += f"Previous warnings still unfixed: {len(wold)}\n"
+    mail += f"""
+Current report:
+{uri_prefix}
+
+
+--
+Gentoo repository CI
+https://wiki.gentoo.org/wiki/Project:Repository_mirror_and_CI
+"""
+    return mail
+
+
+def make_irc(mail_cc, current_rev, new, fixed, old, broken_commits):
+    uri_prefix = os.environ["GENTOO_CI_URI_PREFIX"]
+    commit_uri = os.environ["GENTOO_CI_GITWEB_COMMIT_URI"]
+    cc = ", ".join(a.split("@")[0] for a in mail_cc)
+
+    irc = []
+    if new:
+        irc.append(CROAKER)
+        irc.append("Oh my! Gentoo has reached a state of disarray!")
+        if mail_cc:
+            irc.append(f"{cc}, you seem to have caused quite a distress!")
+        irc.append(f"The report: {uri_prefix}/{current_rev}/output.html")
+        irc.extend(commit_uri + x for x in broken_commits[:3])
+        if len(broken_commits) > 4:
+            irc.append(f"(and {len(broken_commits) - 3} more)")
+        elif len(broken_commits) > 3:
+            irc.append(commit_uri + broken_commits[3])
+    elif fixed:
+        irc.append(CROAKER)
+        if old:
+            irc.append(f"{cc}, Gentoo is still sore. Rub it some more..")
+            irc.append(f"The report: {uri_prefix}/{current_rev}/output.html")
+        else:
+            irc.append(f"{cc}, Gentoo suffers no more. Thank you!")
+    return irc
+
+
+def main(previous_commit, next_commit, output_dir):
+    repo = os.environ["GENTOO_CI_GIT"]
+
+    current_rev = subprocess.check_output(
+        ["git", "rev-parse", "--short", "HEAD"], cwd=repo, text=True
+    ).strip()
+
+    fixed, old, new = diff_lists(f"{repo}/borked.last", f"{repo}/borked.list")
+    wfixed, wold, wnew = diff_lists(f"{repo}/warning.last", f"{repo}/warning.list")
+
+    subject, msg = subject_and_message(new, fixed, old, wnew, wfixed, wold)
+    if subject is None:
+        return 0
+
+    blame = BlameStore(f"{repo}/blame")
+    broken_commits = []
+    if (new or wnew) and previous_commit and len(new) + len(wnew) < 50:
+        broken_commits = bisect(new, wnew, previous_commit, next_commit, blame)
+
+    # CC people whose breakages have been fixed
+    fixed_commits = []
+    for flag, pkgs in (("e", fixed), ("w", wfixed)):
+        for pkg in pkgs:
+            commit = blame.pop(flag, pkg.rsplit("#", 1)[-1])
+            if commit is not None:
+                fixed_commits.append(commit)
+    blame.save()
+
+    commits = list(dict.fromkeys(broken_commits + fixed_commits))
+    addresses = commit_addresses(commits)
+    mail_cc = []
+    for c in broken_commits + fixed_commits:
+        for a in addresses[c]:
+            if a not in mail_cc:
+                mail_cc.append(a)
+
+    mail = make_mail(
+        subject,
+        msg,
+        mail_cc,
+        current_rev,
+        new,
+        wnew,
+        fixed,
+        wfixed,
+        old,
+        wold,
+        broken_commits,
+        previous_commit,
+        next_commit,
+    )
+    with open(os.path.join(output_dir, "mail"), "w") as f:
+        f.write(mail)
+    with open(os.path.join(output_dir, "mail.rcpt"), "w") as f:
+        for a in [os.environ["GENTOO_CI_MAIL"]] + mail_cc:
+            f.write(f"{a}\n")
+    with open(os.path.join(output_dir, "irc"), "w") as f:
+        for l in make_irc(mail_cc, current_rev, new, fixed, old, broken_commits):
+            f.write(f"{l}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
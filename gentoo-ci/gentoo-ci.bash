@@ -2,6 +2,8 @@
 
 set -e -x
 
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
 # SANITY!
 export TZ=UTC
 
@@ -74,6 +76,11 @@ create_pkgcheck_setpriv_wrapper() {
 		\${GLSA_DIR:+--landlock-rule path-beneath:read-dir:\${GLSA_DIR}}
 		\${GLSA_DIR:+--landlock-rule path-beneath:read-file:\${GLSA_DIR}}
 
+		# pkgcore-worker.py socket (for bisect)
+		\${PKGCORE_WORKER_DIR:+--landlock-rule path-beneath:make-sock:\${PKGCORE_WORKER_DIR}}
+		\${PKGCORE_WORKER_DIR:+--landlock-rule path-beneath:remove-file:\${PKGCORE_WORKER_DIR}}
+		\${PKGCORE_WORKER_DIR:+--landlock-rule path-beneath:read-file:${SCRIPT_DIR}/gentoo-ci/pkgcore-worker.py}
+
 		# Python's multiprocessing module creates locks here
 		--landlock-rule path-beneath:read-dir:/dev/shm
 		--landlock-rule path-beneath:read-file:/dev/shm
@@ -171,7 +178,8 @@ fi
 if [[ ${PREV_COMMIT} != ${CURRENT_COMMIT} ]]; then
 	# connect early to avoid problems due to init delays
 	# note: irk doesn't send empty messages, so we need to fake something
-	irk "${IRC_TO}" - <<<$'\0'
+	# (notify-daemon keeps a persistent connection instead)
+	[[ -n ${NOTIFY_SPOOL_DIR} ]] || irk "${IRC_TO}" - <<<$'\0'
 
 	# prepare configroot
 	if [[ ! -d ${CONFIG_ROOT_GENTOO_CI} ]]; then
@@ -184,20 +192,36 @@ if [[ ${PREV_COMMIT} != ${CURRENT_COMMIT} ]]; then
 
 	create_pkgcheck_setpriv_wrapper
 
+	scan_cmd=(
+		sudo -u "${WORKER_USER}"
+		bwrap --bind / / --dev /dev --proc /proc --unshare-all
+		--uid $(id -u "${WORKER_USER}") --gid $(id -g "${WORKER_USER}")
+		time timeout -k 30s "${CI_TIMEOUT}"
+		${DATA_DIR}/pkgcheck-wrapper
+		"${CONFIG_DIR}"
+		"${MIRROR_DIR}"
+		"${MIRROR_DIR}/gentoo"
+		pkgcheck --config "${CONFIG_DIR}" scan
+		--reporter XmlReporter ${PKGCHECK_OPTIONS}
+	)
 	pushd -- "${MIRROR_DIR}"/gentoo >/dev/null
-	sudo -u "${WORKER_USER}" \
-		bwrap --bind / / --dev /dev --proc /proc --unshare-all \
-		--uid $(id -u "${WORKER_USER}") --gid $(id -g "${WORKER_USER}") \
-		time timeout -k 30s "${CI_TIMEOUT}" \
-		${DATA_DIR}/pkgcheck-wrapper \
-		"${CONFIG_DIR}" \
-		"${MIRROR_DIR}" \
-		"${MIRROR_DIR}/gentoo" \
-		pkgcheck --config "${CONFIG_DIR}" scan \
-		--reporter XmlReporter ${PKGCHECK_OPTIONS} > output.xml.tmp
+	if [[ -n ${CI_SCAN_SHARDS} ]]; then
+		trace_span scan commit="${CURRENT_COMMIT}" shards="${CI_SCAN_SHARDS}" -- \
+			"${SCRIPT_DIR}"/gentoo-ci/sharded-scan.py \
+			--shards "${CI_SCAN_SHARDS}" --hosts "${CI_SCAN_HOSTS}" \
+			--config "${CONFIG_DIR}" --wrapper "${DATA_DIR}"/pkgcheck-wrapper \
+			--jobs "${CI_THREADS:-$(nproc)}" \
+			--history "${CRONJOB_STATE_DIR}"/scan-shards.json \
+			${CI_SCAN_VERIFY:+--verify} \
+			-o output.xml.tmp -- "${scan_cmd[@]}"
+	else
+		trace_span scan commit="${CURRENT_COMMIT}" -- \
+			"${scan_cmd[@]}" --jobs "${CI_THREADS:-$(nproc)}" > output.xml.tmp
+	fi
 	popd >/dev/null
 	# Sort XML for better Git delta compression
-	cat "${MIRROR_DIR}"/gentoo/output.xml.tmp | xsltproc "${SCRIPT_DIR}"/sort-output.xsl - > output.xml
+	trace_span sort -- xsltproc "${SCRIPT_DIR}"/sort-output.xsl \
+		"${MIRROR_DIR}"/gentoo/output.xml.tmp > output.xml
 	rm "${MIRROR_DIR}"/gentoo/output.xml.tmp
 
 	"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
@@ -211,7 +235,8 @@ if [[ ${PREV_COMMIT} != ${CURRENT_COMMIT} ]]; then
 	git diff --cached --quiet --exit-code || git commit -a -m "$(date -u --date="@$(cd -- "${SYNC_DIR}"/gentoo; git log --pretty="%ct" -1)" "+%Y-%m-%d %H:%M:%S UTC")"
 	git push
 	curl "https://qa-reports-cdn-origin.gentoo.org/cgi-bin/trigger-pull.cgi?gentoo-ci" || :
-	"${SCRIPT_DIR}"/gentoo-ci/report-borked.bash "${PREV_COMMIT}" "${CURRENT_COMMIT}"
+	trace_span report-borked commit="${CURRENT_COMMIT}" -- \
+		"${SCRIPT_DIR}"/gentoo-ci/report-borked.bash "${PREV_COMMIT}" "${CURRENT_COMMIT}"
 	echo "${CURRENT_COMMIT}" > .last-commit
 
 	if [[ ! -s ${GENTOO_CI_GIT}/borked.list ]]; then
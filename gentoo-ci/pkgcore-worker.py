@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# Long-lived pkgcheck/pmaint worker, keeping the imports and pkgcore
+# configuration (profiles, eclass cache) warm between jobs.
+#
+# usage: pkgcore-worker.py serve <socket> <config-dir> <repo-dir>
+#        pkgcore-worker.py run <socket> -- pkgcheck|pmaint <args>...
+#
+# The server is meant to run inside the same sudo + bwrap + setpriv
+# confinement as regular pkgcheck runs.  Only its user may connect, so
+# the client is to be run via sudo as that user.  Every job is run in
+# a process forked from the server, with stdin/stdout/stderr passed from
+# the client over the socket.  The warm configuration is discarded
+# whenever the tree of <repo-dir> changes, as the repository objects
+# cache category and package listings.  If pkgcore's command-line does
+# not load its config via commandline.load_config, jobs load it cold.
+
+import array
+import importlib
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+
+# modules imported up front, so that jobs do not have to
+PRELOAD = (
+    "pkgcore.config",
+    "pkgcore.util.commandline",
+    "pkgcore.ebuild.domain",
+    "pkgcore.scripts",
+    "pkgcore.scripts.pmaint",
+    "pkgcheck.objects",
+    "pkgcheck.scripts",
+    "pkgcheck.scripts.pkgcheck_scan",
+)
+
+# supported commands and the modules providing their run()
+COMMANDS = {
+    "pkgcheck": "pkgcheck.scripts",
+    "pmaint": "pkgcore.scripts",
+}
+
+MAX_REQUEST = 65536
+
+
+class WarmConfig:
+    def __init__(self, config_dir, repo_dir):
+        self.config_dir = os.path.realpath(config_dir)
+        self.repo_dir = repo_dir
+        self.key = None
+        self.config = None
+
+    def tree_key(self):
+        """Return the tree id of the repo, the config caches its listings."""
+        try:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD:"],
+                cwd=self.repo_dir,
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            # not a git repository? never keep the config then
+            return None
+
+    def refresh(self):
+        key = self.tree_key()
+        if key is not None and key == self.key:
+            return
+        self.key = key
+        self.config = None
+        if key is None:
+            return
+
+        print(f"pkgcore-worker: loading config for {key.strip().decode()}")
+        try:
+            import pkgcore.config
+
+            config = pkgcore.config.load_config(location=self.config_dir)
+            # instantiate the domain, loading profiles and repositories
+            config.get_default("domain")
+        except Exception as e:
+            # let the job load (and report the errors) itself
+            print(f"pkgcore-worker: loading config failed: {e!r}", file=sys.stderr)
+            return
+        self.config = config
+
+    def install(self):
+        """Make pkgcore's command-line use the warm config, if it matches."""
+        if self.config is None:
+            return
+
+        from pkgcore.util import commandline
+
+        # pkgcore internals, load cold if they change
+        if not callable(getattr(commandline, "load_config", None)):
+            print(
+                "pkgcore-worker: commandline.load_config missing, loading cold",
+                file=sys.stderr,
+            )
+            return
+
+        orig_load_config = commandline.load_config
+        config = self.config
+        config_dir = self.config_dir
+
+        def load_config(*args, **kwargs):
+            location = kwargs.get("location")
+            if (
+                not args
+                and location is not None
+                and os.path.realpath(location) == config_dir
+                and not kwargs.get("skip_config_files")
+                and not kwargs.get("prepend_sources")
+                and not kwargs.get("append_sources")
+            ):
+                return config
+            return orig_load_config(*args, **kwargs)
+
+        commandline.load_config = load_config
+
+
+def preload():
+    for mod in PRELOAD:
+        try:
+            importlib.import_module(mod)
+        except ImportError as e:
+            print(f"pkgcore-worker: unable to preload {mod}: {e}", file=sys.stderr)
+    try:
+        from pkgcheck import objects
+
+        # load all the check modules
+        dict(objects.CHECKS)
+    except (ImportError, AttributeError):
+        pass
+
+
+def peer_uid(conn):
+    creds = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid
+
+
+def recv_request(conn):
+    fds = array.array("i")
+    data, ancdata, flags, addr = conn.recvmsg(
+        MAX_REQUEST, socket.CMSG_SPACE(3 * fds.itemsize)
+    )
+    for level, typ, cdata in ancdata:
+        if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[: len(cdata) - (len(cdata) % fds.itemsize)])
+    return json.loads(data), list(fds)
+
+
+def run_job(conn, request, fds, warm):
+    """Run the job in the forked child, never returns."""
+    status = 255
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        os.chdir(request["cwd"])
+
+        argv = request["argv"]
+        name = os.path.basename(argv[0])
+        module = importlib.import_module(COMMANDS[name])
+        warm.install()
+        sys.argv = argv
+        try:
+            module.run(name)
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+    except BaseException as e:
+        print(f"pkgcore-worker: job failed: {e!r}", file=sys.stderr)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(json.dumps({"status": status}).encode())
+        finally:
+            os._exit(status)
+
+
+def reap_jobs():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] != 0:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def serve(sock_path, config_dir, repo_dir):
+    preload()
+    warm = WarmConfig(config_dir, repo_dir)
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    # the socket is only usable by our user, the directory is only
+    # traversable so that others can see whether it is there
+    os.chmod(os.path.dirname(os.path.abspath(sock_path)), 0o711)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        umask = os.umask(0o077)
+        try:
+            sock.bind(sock_path + ".tmp")
+        finally:
+            os.umask(umask)
+        sock.listen()
+        # appear only once ready
+        os.rename(sock_path + ".tmp", sock_path)
+        try:
+            print(f"pkgcore-worker: listening on {sock_path}")
+            sys.stdout.flush()
+
+            while True:
+                conn, addr = sock.accept()
+                reap_jobs()
+                with conn:
+                    uid = peer_uid(conn)
+                    if uid != os.getuid():
+                        print(
+                            f"pkgcore-worker: refusing connection from uid {uid}",
+                            file=sys.stderr,
+                        )
+                        continue
+                    try:
+                        request, fds = recv_request(conn)
+                    except (OSError, ValueError) as e:
+                        print(f"pkgcore-worker: bad request: {e}", file=sys.stderr)
+                        continue
+                    try:
+                        if len(fds) != 3 or os.path.basename(
+                            request["argv"][0]
+                        ) not in COMMANDS:
+                            conn.sendall(json.dumps({"status": 255}).encode())
+                            continue
+                        warm.refresh()
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+                        if os.fork() == 0:
+                            sock.close()
+                            run_job(conn, request, fds, warm)
+                    finally:
+                        for fd in fds:
+                            os.close(fd)
+        finally:
+            os.unlink(sock_path)
+
+
+def run(sock_path, argv):
+    request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(sock_path)
+        sock.sendmsg(
+            [request],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [0, 1, 2]))],
+        )
+        sock.shutdown(socket.SHUT_WR)
+        reply = b""
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            reply += data
+    if not reply:
+        print("pkgcore-worker: no reply from the worker", file=sys.stderr)
+        return 255
+    return json.loads(reply)["status"]
+
+
+def main(command, sock_path, *args):
+    if command == "serve":
+        return serve(sock_path, *args)
+    elif command == "run":
+        if args[:1] == ("--",):
+            args = args[1:]
+        return run(sock_path, list(args))
+    print(f"usage: {sys.argv[0]} serve|run ...", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# Run the full-tree pkgcheck scan split into shards of categories,
+# in parallel local processes and/or on additional hosts over ssh,
+# and merge the results into a single XML.
+#
+# usage: sharded-scan.py [options] -o <output.xml> -- <pkgcheck command>...
+#
+# <pkgcheck command> is the (sandboxed) local command ending with
+# "pkgcheck ... scan <options>", run in the repository.  Every shard
+# gets "-s pkg,ver", --jobs and its categories appended; one more
+# process runs all the other scopes over the whole repository, so that
+# they are run exactly once.
+#
+# Categories are spread over the shards by their historical scan time
+# (longest first, to the least loaded shard), kept in the --history file
+# and updated after every run.  Remote hosts are given as
+# <ssh destination>:<repository path>; the repository commit is pushed
+# there, along with the pkgcore configuration (--config, pointed to
+# the remote repository) and the pkgcheck wrapper (--wrapper) into
+# <repository path>.ci/.  The shard is then scanned in the same sandbox
+# as local ones (bwrap and the wrapper), using PKGCHECK_OPTIONS.  Hosts
+# with a different pkgcheck version are not used, and remote shards that
+# fail are rerun locally.
+#
+# With --verify, a single-process scan is run as well and its results
+# compared to the merged ones.
+
+import argparse
+import heapq
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+SHARD_ARGS = ["-s", "pkg,ver"]
+# everything else (repo, cat, eclass, profile...) over the whole repository
+GLOBAL_ARGS = ["--scopes=-pkg,-ver"]
+# pseudo-category of the global (non-package scopes) job in the history
+GLOBAL = "*"
+# weight of the latest run in the historical scan times
+HISTORY_ALPHA = 0.5
+SSH = ["ssh", "-o", "BatchMode=yes"]
+
+
+def categories(repo):
+    with open(os.path.join(repo, "profiles/categories")) as f:
+        return [l.strip() for l in f if l.strip() and not l.startswith("#")]
+
+
+def initial_estimate(repo, cat):
+    """Estimate the scan time of a category never scanned before."""
+    try:
+        return float(
+            sum(
+                1
+                for pkg in os.scandir(os.path.join(repo, cat))
+                if pkg.is_dir()
+                for f in os.scandir(pkg.path)
+                if f.name.endswith(".ebuild")
+            )
+        )
+    except FileNotFoundError:
+        return 0.0
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_history(path, history):
+    with open(path + ".tmp", "w") as f:
+        json.dump(history, f, indent=0, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def plan_shards(weights, count):
+    """Assign categories to count shards, longest first to the least loaded."""
+    heap = [(0.0, i) for i in range(count)]
+    shards = [[] for i in range(count)]
+    for cat, w in sorted(weights.items(), key=lambda kv: (-kv[1], kv[0])):
+        load, i = heapq.heappop(heap)
+        shards[i].append(cat)
+        heapq.heappush(heap, (load + w, i))
+    return [sorted(s) for s in shards if s]
+
+
+class Shard:
+    def __init__(self, name, cats, output):
+        self.name = name
+        self.cats = cats
+        self.output = output
+        self.host = None
+        self.proc = None
+        self.start = None
+        self.time = None
+
+    def targets(self):
+        if self.cats == [GLOBAL]:
+            return GLOBAL_ARGS
+        return SHARD_ARGS + [f"{c}/*" for c in self.cats]
+
+    def run_local(self, cmd, jobs, repo):
+        self.host = None
+        self.spawn(cmd + [f"--jobs={jobs}"] + self.targets(), repo)
+
+    def run_remote(self, host, commit):
+        dest, path = host.rsplit(":", 1)
+        ci = f"{path}.ci"
+        pkgcheck = [
+            "bwrap",
+            "--bind",
+            "/",
+            "/",
+            "--dev",
+            "/dev",
+            "--proc",
+            "/proc",
+            "--unshare-all",
+            "timeout",
+            "-k",
+            "30s",
+            os.environ.get("CI_TIMEOUT", "2h"),
+            f"{ci}/pkgcheck-wrapper",
+            f"{ci}/portage",
+            os.path.dirname(path),
+            path,
+            "pkgcheck",
+            "--config",
+            f"{ci}/portage",
+            "scan",
+            "--reporter",
+            "XmlReporter",
+            *shlex.split(os.environ.get("PKGCHECK_OPTIONS", "")),
+            *self.targets(),
+        ]
+        script = (
+            f"cd {shlex.quote(path)} && git checkout -q -f --detach {commit} && "
+            + shlex.join(pkgcheck)
+        )
+        self.host = host
+        self.spawn(SSH + [dest, script], None)
+
+    def spawn(self, cmd, cwd):
+        print(f"{self.name}: {' '.join(cmd[:12])} ...", file=sys.stderr)
+        self.start = time.monotonic()
+        with open(self.output, "wb") as out:
+            self.proc = subprocess.Popen(cmd, cwd=cwd, stdout=out)
+
+    def wait(self):
+        ret = self.proc.wait()
+        self.time = time.monotonic() - self.start
+        where = self.host or "local"
+        print(
+            f"{self.name} ({where}, {len(self.cats)} categories): "
+            f"{self.time:.0f}s, exited with {ret}",
+            file=sys.stderr,
+        )
+        return ret
+
+
+def pkgcheck_version(ssh_dest=None):
+    cmd = ["pkgcheck", "--version"]
+    if ssh_dest is not None:
+        cmd = SSH + [ssh_dest, shlex.join(cmd)]
+    try:
+        return subprocess.run(
+            cmd, stdout=subprocess.PIPE, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_config(config_dir, wrapper, repo, remote_repo, dest):
+    """
+    Copy the pkgcore configuration and the wrapper to dest, pointing
+    the configuration to the remote repository.
+    """
+    portage = os.path.join(dest, "portage")
+    shutil.copytree(config_dir, portage, symlinks=True)
+    shutil.copy(wrapper, os.path.join(dest, "pkgcheck-wrapper"))
+    # (repos.conf locations, make.profile symlink)
+    local = re.compile(re.escape(repo) + r"(?=/|\s|$)", re.M)
+    for root, dirs, files in os.walk(portage):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                orig = os.path.join(config_dir, os.path.relpath(path, portage))
+                target = os.path.normpath(
+                    os.path.join(os.path.dirname(orig), os.readlink(path))
+                )
+                if local.match(target):
+                    os.unlink(path)
+                    os.symlink(local.sub(remote_repo, target), path)
+            elif os.path.isfile(path):
+                with open(path, errors="surrogateescape") as f:
+                    text = f.read()
+                with open(path, "w", errors="surrogateescape") as f:
+                    f.write(local.sub(remote_repo, text))
+
+
+def prepare_hosts(repo, hosts, config_dir, wrapper, tmpdir):
+    """
+    Push HEAD of repo, the configuration and the wrapper to the remote
+    hosts, return the commit and the hosts ready to be used.
+    """
+    commit = subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], cwd=repo, text=True
+    ).strip()
+    version = pkgcheck_version()
+    ok = []
+    for i, host in enumerate(hosts):
+        dest, path = host.rsplit(":", 1)
+        remote_version = pkgcheck_version(dest)
+        if remote_version is None or remote_version != version:
+            print(
+                f"{host}: pkgcheck version {remote_version} differs from local "
+                f"{version}, not using it",
+                file=sys.stderr,
+            )
+            continue
+        staged = os.path.join(tmpdir, f"config-{i}")
+        stage_config(config_dir, wrapper, repo, path, staged)
+        if subprocess.call(
+            ["git", "push", "-q", "-f", host, f"{commit}:refs/heads/ci-scan"],
+            cwd=repo,
+        ) or subprocess.call(
+            [
+                "rsync",
+                "-a",
+                "--delete",
+                "-e",
+                shlex.join(SSH),
+                f"{staged}/",
+                f"{dest}:{path}.ci/",
+            ]
+        ):
+            print(f"{host}: push failed, not using it", file=sys.stderr)
+            continue
+        ok.append(host)
+    return commit, ok
+
+
+def iter_results(path):
+    """Yield the <result> elements of a pkgcheck XML output."""
+    for event, elem in ET.iterparse(path):
+        if elem.tag == "result":
+            yield elem
+            elem.clear()
+
+
+def merge(paths, output):
+    with open(output, "wb") as out:
+        out.write(b"<checks>\n")
+        for path in paths:
+            for elem in iter_results(path):
+                elem.tail = "\n"
+                out.write(ET.tostring(elem))
+        out.write(b"</checks>\n")
+
+
+def result_key(elem):
+    return tuple((child.tag, (child.text or "").strip()) for child in elem)
+
+
+def compare(single, merged):
+    a = Counter(result_key(e) for e in iter_results(single))
+    b = Counter(result_key(e) for e in iter_results(merged))
+    if a == b:
+        print(f"verify: identical results ({sum(a.values())})", file=sys.stderr)
+        return True
+    for what, diff in (("missing", a - b), ("extra", b - a)):
+        print(
+            f"verify: {sum(diff.values())} {what} in sharded scan:", file=sys.stderr
+        )
+        for key in list(diff)[:20]:
+            print(f"  {dict(key)}", file=sys.stderr)
+    return False
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("-o", "--output", required=True, help="merged XML output")
+    argp.add_argument("--repo", default=".", help="repository (default: cwd)")
+    argp.add_argument("--shards", type=int, default=2, help="local shards")
+    argp.add_argument(
+        "--hosts", default="", help="space-separated <ssh destination>:<path>"
+    )
+    argp.add_argument("--config", help="pkgcore configuration (for --hosts)")
+    argp.add_argument("--wrapper", help="pkgcheck sandbox wrapper (for --hosts)")
+    argp.add_argument("--jobs", type=int, help="local jobs in total (default: nproc)")
+    argp.add_argument("--history", required=True, help="scan times per category")
+    argp.add_argument(
+        "--verify", action="store_true", help="compare to a single-process scan"
+    )
+    argp.add_argument("command", nargs=argparse.REMAINDER)
+    args = argp.parse_args()
+
+    cmd = args.command
+    if cmd[:1] == ["--"]:
+        cmd = cmd[1:]
+    repo = os.path.abspath(args.repo)
+    jobs = args.jobs or os.cpu_count()
+
+    history = load_history(args.history)
+    weights = {
+        cat: history.get(cat) or initial_estimate(repo, cat)
+        for cat in categories(repo)
+    }
+
+    hosts = args.hosts.split()
+    if hosts and not (args.config and args.wrapper):
+        argp.error("--hosts requires --config and --wrapper")
+
+    # (not in the repository, the global job would see it)
+    tmpdir = tempfile.mkdtemp(prefix="sharded-scan.")
+    try:
+        commit = None
+        if hosts:
+            commit, hosts = prepare_hosts(
+                repo, hosts, args.config, args.wrapper, tmpdir
+            )
+
+        plan = plan_shards(weights, max(1, args.shards + len(hosts)))
+        shards = [
+            Shard(f"shard-{i}", cats, os.path.join(tmpdir, f"shard-{i}.xml"))
+            for i, cats in enumerate(plan)
+        ]
+        shards.append(Shard("global", [GLOBAL], os.path.join(tmpdir, "global.xml")))
+
+        # the global job and the local shards share the local jobs
+        local = len(shards) - len(hosts)
+        local_jobs = max(1, jobs // local)
+        for i, shard in enumerate(shards):
+            if shard.cats != [GLOBAL] and i < len(hosts):
+                shard.run_remote(hosts[i], commit)
+            else:
+                shard.run_local(cmd, local_jobs, repo)
+
+        ret = 0
+        for shard in shards:
+            status = shard.wait()
+            if status != 0 and shard.host is not None:
+                print(f"{shard.name}: rerunning locally", file=sys.stderr)
+                shard.run_local(cmd, local_jobs, repo)
+                status = shard.wait()
+            ret = ret or status
+        if ret != 0:
+            return ret
+
+        merge([s.output for s in shards], args.output)
+
+        # spread the shard times over its categories by their weights
+        for shard in shards:
+            total = sum(weights.get(c, 0) for c in shard.cats) or 1
+            for cat in shard.cats:
+                share = shard.time * (weights.get(cat, 0) or 1) / total
+                old = history.get(cat)
+                if old is not None:
+                    share = (1 - HISTORY_ALPHA) * old + HISTORY_ALPHA * share
+                history[cat] = share
+        save_history(args.history, history)
+
+        if args.verify:
+            single = os.path.join(tmpdir, "single.xml")
+            with open(single, "wb") as out:
+                if subprocess.call(cmd + [f"--jobs={jobs}"], cwd=repo, stdout=out):
+                    return 1
+            if not compare(single, args.output):
+                return 1
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# Send notifications queued in NOTIFY_SPOOL_DIR by notify.bash.
+#
+# IRC lines are sent to IRC_TO over a persistent connection with rate
+# limiting, mail is batched and sent in a single SMTP session.  Meant to
+# be run as a service, as the same user as the cronjobs.
+#
+# Spool entries are named <kind>.<seconds>.<microseconds>.<pid>.<random>:
+# - irc.*: one message per line
+# - mail.*: envelope recipients on the first line, then the message
+#
+# Mail rejected permanently (5xx replies) is moved to the failed/
+# subdirectory of the spool instead of being retried.
+
+import collections
+import getpass
+import os
+import select
+import signal
+import smtplib
+import socket
+import ssl
+import sys
+import time
+import urllib.parse
+
+# rate limit: burst of IRC_BURST lines, then one per IRC_INTERVAL seconds
+IRC_BURST = 4
+IRC_INTERVAL = 2
+# max length of a single IRC message
+IRC_MAX_LEN = 400
+# how long to wait for more mail before sending a batch
+MAIL_DELAY = 10
+# how long to wait before reconnecting / retrying mail
+RETRY_DELAY = 60
+
+
+class IRCClient:
+    def __init__(self, uri):
+        u = urllib.parse.urlsplit(uri)
+        self.secure = u.scheme == "ircs"
+        self.host = u.hostname
+        self.port = u.port or (6697 if self.secure else 6667)
+        self.nick = u.username or "croaker"
+        self.password = u.password
+        # the channel is parsed as URI fragment
+        self.channel = "#" + u.fragment if u.fragment else u.path.lstrip("/")
+
+        self.sock = None
+        self.buf = b""
+        self.joined = False
+        self.retry_at = 0
+        self.tokens = IRC_BURST
+        self.last_refill = time.monotonic()
+
+    def connect(self):
+        print(f"irc: connecting to {self.host}:{self.port}", file=sys.stderr)
+        sock = socket.create_connection((self.host, self.port), timeout=30)
+        if self.secure:
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=self.host
+            )
+        sock.settimeout(None)
+        self.sock = sock
+        self.buf = b""
+        self.joined = False
+        if self.password:
+            self.send(f"PASS {self.password}")
+        self.send(f"NICK {self.nick}")
+        self.send(f"USER {self.nick} 0 * :{self.nick}")
+
+    def disconnect(self, reason):
+        print(f"irc: disconnected: {reason}", file=sys.stderr)
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.joined = False
+        self.retry_at = time.monotonic() + RETRY_DELAY
+
+    def send(self, line):
+        self.sock.sendall(line.encode("utf8", "replace") + b"\r\n")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle_input(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("connection closed by server")
+        self.buf += data
+        # select() does not see data already decrypted by the SSL layer
+        while self.secure and self.sock.pending():
+            self.buf += self.sock.recv(4096)
+        while b"\r\n" in self.buf:
+            line, self.buf = self.buf.split(b"\r\n", 1)
+            self.handle_line(line.decode("utf8", "replace"))
+
+    def handle_line(self, line):
+        if line.startswith("PING"):
+            self.send("PONG" + line[4:])
+            return
+        parts = line.split()
+        if len(parts) < 2:
+            return
+        if parts[1] == "001":
+            self.send(f"JOIN {self.channel}")
+        elif parts[1] == "433":
+            # nickname in use
+            self.nick += "_"
+            self.send(f"NICK {self.nick}")
+        elif parts[1] == "JOIN" and parts[0][1:].split("!")[0] == self.nick:
+            self.joined = True
+
+    def can_send(self):
+        now = time.monotonic()
+        self.tokens = min(
+            IRC_BURST, self.tokens + (now - self.last_refill) / IRC_INTERVAL
+        )
+        self.last_refill = now
+        return self.joined and self.tokens >= 1
+
+    def privmsg(self, msg):
+        self.tokens -= 1
+        self.send(f"PRIVMSG {self.channel} :{msg[:IRC_MAX_LEN]}")
+
+
+class Spool:
+    def __init__(self, path):
+        self.new = os.path.join(path, "new")
+        self.failed = os.path.join(path, "failed")
+        os.makedirs(os.path.join(path, "tmp"), exist_ok=True)
+        os.makedirs(self.new, exist_ok=True)
+        os.makedirs(self.failed, exist_ok=True)
+        # spool entries that have been loaded already
+        self.seen = set()
+
+    def scan(self):
+        """Return new entries as (kind, path) tuples, oldest first."""
+        entries = []
+        for name in os.listdir(self.new):
+            if name in self.seen:
+                continue
+            self.seen.add(name)
+            kind, sec, usec, rest = name.split(".", 3)
+            path = os.path.join(self.new, name)
+            entries.append(((int(sec), int(usec)), kind, path))
+        return [(kind, path) for ts, kind, path in sorted(entries)]
+
+    def done(self, path):
+        os.unlink(path)
+        self.seen.discard(os.path.basename(path))
+
+    def fail(self, path):
+        """Keep an entry that cannot be delivered out of the queue."""
+        os.rename(path, os.path.join(self.failed, os.path.basename(path)))
+        self.seen.discard(os.path.basename(path))
+
+
+def permanent_failure(e):
+    """Check whether an SMTP error means the message will never be accepted."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in e.recipients.values())
+    # a HELO failure is not the message's fault
+    if isinstance(e, smtplib.SMTPResponseException) and not isinstance(
+        e, smtplib.SMTPHeloError
+    ):
+        return e.smtp_code >= 500
+    return False
+
+
+def send_mail(queue, spool):
+    """
+    Send all queued mail in one SMTP session, keep the ones failed
+    temporarily queued.
+    """
+    smtp_host = os.environ.get("NOTIFY_SMTP_HOST", "localhost")
+    mail_from = os.environ.get(
+        "NOTIFY_MAIL_FROM", f"{getpass.getuser()}@{socket.getfqdn()}"
+    )
+
+    with smtplib.SMTP(smtp_host) as smtp:
+        while queue:
+            path = queue[0]
+            with open(path, "rb") as f:
+                rcpts = f.readline().decode().split()
+                msg = f.read()
+            try:
+                smtp.sendmail(mail_from, rcpts, msg)
+            except smtplib.SMTPException as e:
+                if not permanent_failure(e):
+                    raise
+                # this is not going to get any better
+                print(f"mail: {path} refused: {e}", file=sys.stderr)
+                queue.popleft()
+                spool.fail(path)
+                continue
+            queue.popleft()
+            spool.done(path)
+
+
+def main():
+    spool = Spool(os.environ["NOTIFY_SPOOL_DIR"])
+    irc = IRCClient(os.environ["IRC_TO"])
+
+    # IRC lines as (spool path, remaining lines)
+    irc_queue = collections.deque()
+    mail_queue = collections.deque()
+    mail_since = None
+    mail_retry_at = 0
+
+    def terminate(signum, frame):
+        if irc.sock is not None:
+            try:
+                irc.send("QUIT")
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    while True:
+        for kind, path in spool.scan():
+            if kind == "irc":
+                with open(path) as f:
+                    lines = collections.deque(l.rstrip("\n") for l in f)
+                irc_queue.append((path, lines))
+            elif kind == "mail":
+                mail_queue.append(path)
+                if mail_since is None:
+                    mail_since = time.monotonic()
+            else:
+                print(f"unknown spool entry {path}", file=sys.stderr)
+                spool.done(path)
+
+        now = time.monotonic()
+        if irc.sock is None and irc_queue and now >= irc.retry_at:
+            try:
+                irc.connect()
+            except OSError as e:
+                irc.disconnect(e)
+
+        try:
+            if irc.sock is not None:
+                r, w, x = select.select([irc], [], [], 1)
+                if r:
+                    irc.handle_input()
+                while irc_queue and irc.can_send():
+                    path, lines = irc_queue[0]
+                    if lines:
+                        msg = lines.popleft()
+                        if msg:
+                            irc.privmsg(msg)
+                    if not lines:
+                        irc_queue.popleft()
+                        spool.done(path)
+            else:
+                time.sleep(1)
+        except OSError as e:
+            irc.disconnect(e)
+
+        if mail_queue and now - mail_since >= MAIL_DELAY and now >= mail_retry_at:
+            try:
+                send_mail(mail_queue, spool)
+                mail_since = None
+            except (OSError, smtplib.SMTPException) as e:
+                print(f"mail: {e}", file=sys.stderr)
+                mail_retry_at = now + RETRY_DELAY
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# Helpers for sending IRC and mail notifications.
+# vim:se ft=bash :
+#
+# If NOTIFY_SPOOL_DIR is set, messages are only written to the spool
+# and notify-daemon.py sends them (over a persistent IRC connection,
+# and with all queued mail in a single SMTP session). Otherwise they
+# are sent directly via irk(1) and sendmail(1).
+
+# write stdin into the spool as a new entry of given kind
+_notify_spool() {
+	# EPOCHREALTIME uses the locale's decimal separator, while
+	# notify-daemon.py expects <kind>.<sec>.<usec>.<rest>
+	local now=${EPOCHREALTIME/[!0-9]/.}
+	local name=${1}.${now}.${BASHPID}.${RANDOM}
+
+	mkdir -p -- "${NOTIFY_SPOOL_DIR}"/{tmp,new} || return
+	cat > "${NOTIFY_SPOOL_DIR}/tmp/${name}" &&
+		mv -- "${NOTIFY_SPOOL_DIR}/tmp/${name}" "${NOTIFY_SPOOL_DIR}/new/${name}"
+}
+
+# notify_irc <message>...
+# send every argument as a separate line to IRC_TO
+notify_irc() {
+	if [[ -z ${NOTIFY_SPOOL_DIR} ]]; then
+		local m
+		for m; do
+			irk "${IRC_TO}" "${m}"
+		done
+		return
+	fi
+
+	printf '%s\n' "${@}" | _notify_spool irc
+}
+
+# notify_mail <recipient>...
+# send the mail (with headers) from stdin, like sendmail(1)
+notify_mail() {
+	if [[ -z ${NOTIFY_SPOOL_DIR} ]]; then
+		sendmail "${@}"
+		return
+	fi
+
+	{ echo "${*}"; cat; } | _notify_spool mail
+}
@@ -1,12 +1,16 @@
+import os
 import requests
 from typing import Generator
 
+DEFAULT_BASE_URL = "https://codeberg.org/api/v1"
+
 
 class CodebergAPI:
-    def __init__(self, owner: str, repo: str, token: str):
+    def __init__(self, owner: str, repo: str, token: str, base_url: str = None):
         self.owner = owner
         self.repo = repo
         self.token = token
+        self.base_url = base_url or os.environ.get("CODEBERG_API_URL", DEFAULT_BASE_URL)
 
     def __enter__(self):
         self.session = requests.Session()
@@ -26,15 +30,15 @@ class CodebergAPI:
 
     @property
     def repos_baseurl(self) -> str:
-        return f"https://codeberg.org/api/v1/repos/{self.owner}/{self.repo}"
+        return f"{self.base_url}/repos/{self.owner}/{self.repo}"
 
     @property
     def orgs_baseurl(self) -> str:
-        return "https://codeberg.org/api/v1/orgs"
+        return f"{self.base_url}/orgs"
 
     @property
     def teams_baseurl(self) -> str:
-        return "https://codeberg.org/api/v1/teams"
+        return f"{self.base_url}/teams"
 
     def _get_paginated(self, url) -> Generator[None, dict, None]:
         r = self.session.get(url, params={"limit": 100})
@@ -55,6 +59,9 @@ class CodebergAPI:
         """
         return self._get_paginated(f"{self.repos_baseurl}/pulls?state={state}")
 
+    def pull(self, pr_id: int) -> dict:
+        return self.session.get(f"{self.repos_baseurl}/pulls/{pr_id}").json()
+
     def set_pr_title(self, pr_id: int, title: str) -> None:
         self.session.patch(f"{self.repos_baseurl}/pulls/{pr_id}", json={"title": title})
 
@@ -92,13 +99,22 @@ class CodebergAPI:
     def get_comments(self, pr_id: int) -> Generator[None, dict, None]:
         return self._get_paginated(f"{self.repos_baseurl}/issues/{pr_id}/comments")
 
-    def create_comment(self, pr_id: int, comment: str) -> None:
-        self.session.post(
+    def create_comment(self, pr_id: int, comment: str) -> dict:
+        r = self.session.post(
             f"{self.repos_baseurl}/issues/{pr_id}/comments",
             json={
                 "body": comment,
             },
         )
+        return r.json()
+
+    def edit_comment(self, comment_id: int, comment: str) -> None:
+        self.session.patch(
+            f"{self.repos_baseurl}/issues/comments/{comment_id}",
+            json={
+                "body": comment,
+            },
+        )
 
     def delete_comment(self, comment_id: int) -> None:
         self.session.delete(f"{self.repos_baseurl}/issues/comments/{comment_id}")
@@ -0,0 +1,16 @@
+#!/bin/bash
+# housekeeping of the gentoo-ci report repository, see maintain-gentoo-ci.py
+
+set -e -x
+
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
+# wait for the PR job running now, and keep the next one from starting
+exec {lockfd}>> "${CRONJOB_STATE_DIR}/pull-requests.lock"
+flock -x -- "${lockfd}"
+
+full=
+# full gc once a week
+[[ $(date -u +%u) != 7 ]] || full=--full
+trace_span maintain-gentoo-ci -- \
+	"${SCRIPT_DIR}"/pull-request/maintain-gentoo-ci.py ${full}
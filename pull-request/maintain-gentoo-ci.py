@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Housekeeping of the gentoo-ci report repository: remove the report
+# branches of PRs closed for longer than the retention time (locally
+# and on origin), pack refs and repack incrementally.
+#
+# usage: maintain-gentoo-ci.py [--retention 30d] [--full] [--dry-run]
+#
+# Closed PRs are taken from PULL_REQUEST_CLOSED (written by
+# scan-pull-requests.py); their cached report comments are dropped
+# from PULL_REQUEST_COMMENT_DB along with the branches.  Meant to be run
+# with the pull-requests lock held (see maintain-gentoo-ci.bash).
+#
+# The ref count, pack size and ref advertisement (fetch) latency
+# of the repository are printed before and after.
+
+import argparse
+import errno
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# refs deleted on origin per push
+PUSH_BATCH = 200
+
+
+def parse_interval(value):
+    value = value.strip()
+    if value[-1:] in UNITS:
+        return float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
+
+
+def git(*args, **kwargs):
+    return subprocess.run(
+        ["git", *args], stdout=subprocess.PIPE, text=True, check=True, **kwargs
+    ).stdout
+
+
+def branch_to_pr(branch):
+    """
+    Map pull-<forge>-<id> to <forge>/<id>, and the legacy pull-<id>
+    (from before codeberg support) to github/<id>.
+    """
+    forge, sep, prid = branch[len("pull-") :].rpartition("-")
+    if not sep:
+        forge = "github"
+    return f"{forge}/{prid}" if forge and prid.isdigit() else None
+
+
+def metrics(repo):
+    refs = git("for-each-ref", "--format=%(refname)", cwd=repo).splitlines()
+    loose = sum(
+        len(files) for path, dirs, files in os.walk(os.path.join(repo, ".git/refs"))
+    )
+    objects = {}
+    for l in git("count-objects", "-v", cwd=repo).splitlines():
+        key, value = l.split(":", 1)
+        objects[key] = int(value)
+    start = time.monotonic()
+    git("ls-remote", repo)
+    local = time.monotonic() - start
+    start = time.monotonic()
+    try:
+        git("ls-remote", "origin", cwd=repo)
+        remote = f"{time.monotonic() - start:.2f}s"
+    except subprocess.CalledProcessError:
+        remote = "failed"
+    return (
+        f"{len(refs)} refs ({loose} loose), "
+        f"{objects['packs']} packs of {objects['size-pack'] / 1024:.1f} MiB, "
+        f"{objects['count']} loose objects, "
+        f"ls-remote {local:.2f}s local / {remote} origin"
+    )
+
+
+def load_pickle(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return {}
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument(
+        "--retention",
+        type=parse_interval,
+        default=parse_interval(os.environ.get("PULL_REQUEST_RETENTION", "30d")),
+        help="keep branches of closed PRs for that long (default: 30d)",
+    )
+    argp.add_argument(
+        "--full",
+        action="store_true",
+        help="do a full gc, eventually dropping the objects of removed branches",
+    )
+    argp.add_argument(
+        "--dry-run", action="store_true", help="only print what would be removed"
+    )
+    args = argp.parse_args()
+
+    repo = os.environ["GENTOO_CI_GIT"]
+    closed_path = os.environ["PULL_REQUEST_CLOSED"]
+    comment_db_path = os.environ["PULL_REQUEST_COMMENT_DB"]
+
+    print(f"before: {metrics(repo)}")
+
+    try:
+        with open(closed_path) as f:
+            closed = json.load(f)
+    except FileNotFoundError:
+        closed = {}
+    cutoff = time.time() - args.retention
+    expired = {pr_key for pr_key, when in closed.items() if when < cutoff}
+
+    local = [
+        b
+        for b in git(
+            "for-each-ref", "--format=%(refname:short)", "refs/heads/pull-*", cwd=repo
+        ).split()
+        if branch_to_pr(b) in expired
+    ]
+    remote = []
+    for l in git("ls-remote", "--heads", "origin", "pull-*", cwd=repo).splitlines():
+        b = l.split()[1][len("refs/heads/") :]
+        if branch_to_pr(b) in expired:
+            remote.append(b)
+    print(
+        f"{len(expired)} PRs closed for longer than the retention time, "
+        f"{len(local)} branches to remove locally, {len(remote)} on origin"
+    )
+    if args.dry_run:
+        for b in sorted(set(local) | set(remote)):
+            print(f"  {b}")
+        return 0
+
+    if local:
+        git(
+            "update-ref",
+            "--stdin",
+            input="".join(f"delete refs/heads/{b}\n" for b in local),
+            cwd=repo,
+        )
+    for i in range(0, len(remote), PUSH_BATCH):
+        git("push", "-q", "origin", "--delete", *remote[i : i + PUSH_BATCH], cwd=repo)
+
+    # forget the PRs whose branches are gone
+    comment_db = load_pickle(comment_db_path)
+    for pr_key in expired:
+        comment_db.pop(pr_key, None)
+        del closed[pr_key]
+    with open(comment_db_path + ".tmp", "wb") as f:
+        pickle.dump(comment_db, f)
+    os.rename(comment_db_path + ".tmp", comment_db_path)
+    with open(closed_path + ".tmp", "w") as f:
+        json.dump(closed, f)
+    os.rename(closed_path + ".tmp", closed_path)
+
+    threads = os.environ.get("CI_THREADS", "0")
+    git("pack-refs", "--all", "--prune", cwd=repo)
+    if args.full:
+        git("-c", f"pack.threads={threads}", "gc", "--quiet", cwd=repo)
+    else:
+        git(
+            "-c",
+            f"pack.threads={threads}",
+            "repack",
+            "-d",
+            "-q",
+            "--geometric=2",
+            "--write-midx",
+            cwd=repo,
+        )
+        git("prune", "--expire=2.weeks.ago", cwd=repo)
+    git(
+        "commit-graph",
+        "write",
+        "--reachable",
+        "--split",
+        "--size-multiple=2",
+        cwd=repo,
+    )
+
+    print(f"after:  {metrics(repo)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Batch ("merge train") support for pull request checks.
+#
+# select: pick up to K compatible PRs from the queue head (run in the sync
+#         repo, with refs/pull/* already fetched)
+# attribute: split the combined borked list into per-PR lists
+# split: give up on a batch and requeue all PRs but the first one
+
+import errno
+import json
+import os
+import pickle
+import subprocess
+import sys
+
+
+def git(*args):
+    return subprocess.check_output(("git",) + args, text=True)
+
+
+def batch_dir():
+    return os.path.join(os.environ["PULL_REQUEST_DIR"], "batch")
+
+
+def load_db():
+    try:
+        with open(os.environ["PULL_REQUEST_DB"], "rb") as f:
+            return pickle.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return {}
+
+
+def save_db(db):
+    path = os.environ["PULL_REQUEST_DB"]
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(db, f)
+    os.rename(path + ".tmp", path)
+
+
+def db_key(db, pr_key):
+    # support pr.number as implicitly a github PR, like scan-pull-requests
+    forge, prid = pr_key.split("/")
+    if forge == "github" and int(prid) in db:
+        return int(prid)
+    return pr_key
+
+
+def load_no_batch():
+    try:
+        with open(os.path.join(batch_dir(), "no-batch")) as f:
+            return set(l.strip() for l in f if l.strip())
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return set()
+
+
+def save_no_batch(no_batch):
+    path = os.path.join(batch_dir(), "no-batch")
+    with open(path + ".tmp", "w") as f:
+        for pr_key in sorted(no_batch):
+            f.write(f"{pr_key}\n")
+    os.rename(path + ".tmp", path)
+
+
+def package_set(ref, categories):
+    """
+    Return the set of packages touched by ref, relative to its merge base
+    with master, or None if it touches anything outside packages (eclasses,
+    profiles, metadata...) or too many files to be considered small.
+    """
+    max_files = int(os.environ.get("PULL_REQUEST_BATCH_MAX_FILES", "20"))
+    base = git("merge-base", "master", ref).strip()
+    files = git("diff", "--name-only", "--no-renames", base, ref).split()
+    if len(files) > max_files:
+        return None
+
+    pkgs = set()
+    for path in files:
+        parts = path.split("/")
+        if len(parts) < 3 or parts[0] not in categories:
+            return None
+        pkgs.add("/".join(parts[:2]))
+    return pkgs
+
+
+def select(candidates):
+    no_batch = load_no_batch()
+    leader = candidates[0]
+    # PRs that broke a batch before are always retried alone
+    if leader in no_batch:
+        no_batch.discard(leader)
+        save_no_batch(no_batch)
+        print(leader)
+        return 0
+
+    categories = set(git("show", "master:profiles/categories").split())
+    leader_pkgs = package_set(f"refs/pull/{leader}", categories)
+    if not leader_pkgs:
+        print(leader)
+        return 0
+
+    plan = {leader: sorted(leader_pkgs)}
+    owned = set(leader_pkgs)
+    for pr_key in candidates[1:]:
+        if pr_key in no_batch:
+            continue
+        pkgs = package_set(f"refs/pull/{pr_key}", categories)
+        if not pkgs or not owned.isdisjoint(pkgs):
+            print(f"{pr_key}: not batchable", file=sys.stderr)
+            continue
+        plan[pr_key] = sorted(pkgs)
+        owned.update(pkgs)
+
+    # mark the extra PRs as in progress, like the scanner does for the first
+    db = load_db()
+    for pr_key in list(plan)[1:]:
+        db[db_key(db, pr_key)] = git("rev-parse", f"refs/pull/{pr_key}").strip()
+    save_db(db)
+
+    with open(os.path.join(batch_dir(), "plan.json"), "w") as f:
+        json.dump(plan, f)
+    for pr_key in plan:
+        print(pr_key)
+    return 0
+
+
+def attribute(borked_path, pre_borked_path, prs):
+    """
+    Write <forge>-<id>.borked for every PR in the batch. Issues already
+    present before the merge are reported to all PRs, just like a solo
+    run would; new issues need to belong to exactly one PR.
+    """
+    with open(os.path.join(batch_dir(), "plan.json")) as f:
+        plan = json.load(f)
+    owner = {}
+    for pr_key in prs:
+        for pkg in plan[pr_key]:
+            owner[pkg] = pr_key
+
+    with open(borked_path) as f:
+        borked = [l for l in f if l.strip()]
+    pre_borked = set()
+    if borked:
+        with open(pre_borked_path) as f:
+            pre_borked = set(l.strip() for l in f)
+    if "ETOOMANY" in pre_borked:
+        print("batch: too many broken packages to attribute", file=sys.stderr)
+        return 1
+
+    per_pr = {pr_key: [] for pr_key in prs}
+    for l in borked:
+        if l.strip() in pre_borked:
+            for lines in per_pr.values():
+                lines.append(l)
+        elif l.strip() in owner:
+            per_pr[owner[l.strip()]].append(l)
+        else:
+            print(f"batch: cannot attribute {l.strip()}", file=sys.stderr)
+            return 1
+
+    for pr_key, lines in per_pr.items():
+        path = os.path.join(batch_dir(), pr_key.replace("/", "-") + ".borked")
+        with open(path, "w") as f:
+            f.writelines(lines)
+    return 0
+
+
+def split(prs):
+    db = load_db()
+    no_batch = load_no_batch()
+    for pr_key in prs[1:]:
+        db[db_key(db, pr_key)] = ""
+        no_batch.add(pr_key)
+    save_db(db)
+    save_no_batch(no_batch)
+    return 0
+
+
+def main(cmd, *args):
+    os.makedirs(batch_dir(), exist_ok=True)
+    if cmd == "select":
+        return select(list(args))
+    elif cmd == "attribute":
+        return attribute(args[0], args[1], list(args[2:]))
+    elif cmd == "split":
+        return split(list(args))
+    print(f"unknown command {cmd}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Compare pkgcheck XML results after merging a pull request against
+# the results from before the merge, and classify every result as new,
+# pre-existing or fixed.
+#
+# usage: pkgcheckdiff.py -o diff.json --post output.xml --pre .pre-merge*.xml
+#
+# Only the results that pkgcheck2borked.py (-w -e, with excludes.json)
+# counts as breakages are taken into account; it is asked which of
+# the result classes it counts by running it on one made-up result
+# per class.  The output is only written on success; without it,
+# report-pull-request.py falls back to comparing the borked lists.
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+
+def iter_results(path):
+    """
+    Stream results from a pkgcheck XmlReporter file, yielding
+    ((category, package, version, class, msg-hash), package, fields)
+    tuples, fields being the target fields the result has.
+    """
+    for event, elem in ET.iterparse(path):
+        if elem.tag != "result":
+            continue
+        r = {x.tag: x.text or "" for x in elem}
+        elem.clear()
+
+        cat = r.get("category", "")
+        pkg = r.get("package", "")
+        msg_hash = hashlib.sha1(r.get("msg", "").encode()).hexdigest()
+        key = (cat, pkg, r.get("version", ""), r.get("class", ""), msg_hash)
+        fields = tuple(x for x in ("category", "package", "version") if x in r)
+        yield key, "/".join(x for x in (cat, pkg) if x), fields
+
+
+def index_results(paths, shapes):
+    """
+    Build a result key -> package dict from the given files, recording
+    the target fields of every result class in shapes.
+    """
+    results = {}
+    for path in paths:
+        for key, pkg, fields in iter_results(path):
+            results[key] = pkg
+            shapes.setdefault(key[3], fields)
+    return results
+
+
+def counted_classes(shapes):
+    """Return the result classes that pkgcheck2borked.py counts."""
+    if not shapes:
+        return set()
+    parser_git = os.environ["PKGCHECK_RESULT_PARSER_GIT"]
+    classes = sorted(shapes)
+    values = {"package": "probe", "version": "0"}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        xml = os.path.join(tmpdir, "probe.xml")
+        out = os.path.join(tmpdir, "probe.borked")
+        with open(xml, "w") as f:
+            f.write("<checks>\n")
+            for i, cls in enumerate(classes):
+                # every class gets its own category (results without
+                # one are made category-level)
+                f.write(f"<result><category>probe-{i}</category>")
+                for field in shapes[cls]:
+                    if field in values:
+                        f.write(f"<{field}>{values[field]}</{field}>")
+                f.write(f"<class>{escape(cls)}</class><msg>probe</msg></result>\n")
+            f.write("</checks>\n")
+        subprocess.run(
+            [
+                os.path.join(parser_git, "pkgcheck2borked.py"),
+                "-x",
+                os.path.join(parser_git, "excludes.json"),
+                "-w",
+                "-e",
+                "-o",
+                out,
+                xml,
+            ],
+            check=True,
+        )
+        with open(out) as f:
+            borked = {l.strip().split("/")[0] for l in f if l.strip()}
+    return {cls for i, cls in enumerate(classes) if f"probe-{i}" in borked}
+
+
+def diff_results(post_paths, pre_paths):
+    """
+    Return a dict mapping packages ("cat/pn", "cat" or "" for repo-level
+    results) to counts of new, pre-existing and fixed results.
+    """
+    shapes = {}
+    pre = index_results(pre_paths, shapes)
+    post = index_results(post_paths, shapes)
+    counted = counted_classes(shapes)
+    packages = {}
+
+    def counts(pkg):
+        if pkg not in packages:
+            packages[pkg] = {"new": 0, "preexisting": 0, "fixed": 0}
+        return packages[pkg]
+
+    for key, pkg in post.items():
+        if key[3] in counted:
+            counts(pkg)["new" if key not in pre else "preexisting"] += 1
+
+    for key, pkg in pre.items():
+        if key not in post and key[3] in counted:
+            counts(pkg)["fixed"] += 1
+
+    return packages
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("-o", "--output", required=True, help="JSON output file")
+    argp.add_argument("--post", nargs="+", required=True, help="post-merge XML")
+    argp.add_argument("--pre", nargs="+", required=True, help="pre-merge XML")
+    args = argp.parse_args()
+
+    packages = diff_results(args.post, args.pre)
+    with open(args.output + ".tmp", "w") as f:
+        json.dump({"packages": packages}, f)
+    os.rename(args.output + ".tmp", args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
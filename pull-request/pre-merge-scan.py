@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Run the package-level pre-merge scans of a PR alongside the post-merge
+# scan, for the packages found broken so far.
+#
+# usage: pre-merge-scan.py watch --post <output.xml.tmp> --done <file>
+#                          --dir <dir> --jobs N -- <pkgcheck command>...
+#        pre-merge-scan.py finish --dir <dir> --jobs N -o <.pre-merge.xml>
+#                          --borked <borked.list> -- <pkgcheck command>...
+#
+# <pkgcheck command> is "pkgcheck ... scan <options>" run in the pre-merge
+# worktree; the packages to scan and --jobs are appended.
+#
+# "watch" follows the post-merge XML while it is being written, runs
+# pkgcheck2borked.py on the new results every now and then and scans the
+# newly broken packages in batches (one at a time), storing the results
+# in <dir>.  It stops starting new batches once <file> exists and exits
+# after the running one is finished.
+#
+# "finish" is given the final list of broken packages, scans the ones
+# that were not scanned yet and writes the results of all of them into
+# a single XML, so that it matches a scan of all the packages at once.
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+# how often to check the post-merge output for new results (seconds)
+POLL = 2
+# how often to run pkgcheck2borked.py on new results (seconds)
+BORKED_INTERVAL = 10
+
+# running scans, terminated if we are
+children = []
+
+
+def log(msg):
+    print(f"pre-merge-scan: {msg}", file=sys.stderr, flush=True)
+
+
+def borked_packages(results, tmpdir):
+    """Run pkgcheck2borked.py on the given <result> elements (as bytes)."""
+    parser_git = os.environ["PKGCHECK_RESULT_PARSER_GIT"]
+    xml = os.path.join(tmpdir, "snapshot.xml")
+    out = os.path.join(tmpdir, "snapshot.borked")
+    with open(xml, "wb") as f:
+        f.write(b"<checks>\n" + b"".join(results) + b"</checks>\n")
+    subprocess.run(
+        [
+            os.path.join(parser_git, "pkgcheck2borked.py"),
+            "-x",
+            os.path.join(parser_git, "excludes.json"),
+            "-w",
+            "-e",
+            "-o",
+            out,
+            xml,
+        ],
+        check=True,
+    )
+    with open(out) as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+class Batches:
+    """Package-level scans stored in a directory, with the list of done ones."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.scanned_path = os.path.join(path, "scanned")
+
+    def scanned(self):
+        try:
+            with open(self.scanned_path) as f:
+                return {l.strip() for l in f if l.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def outputs(self):
+        return sorted(
+            os.path.join(self.path, f)
+            for f in os.listdir(self.path)
+            if f.endswith(".xml")
+        )
+
+    def start(self, cmd, jobs, pkgs):
+        output = os.path.join(self.path, f"batch-{len(self.outputs())}.xml")
+        log(f"scanning {len(pkgs)} packages: {' '.join(pkgs[:10])} ...")
+        with open(output, "wb") as out:
+            proc = subprocess.Popen(cmd + pkgs + [f"--jobs={jobs}"], stdout=out)
+        children.append(proc)
+        return proc, output, pkgs
+
+    def finished(self, batch):
+        proc, output, pkgs = batch
+        proc.wait()
+        children.remove(proc)
+        if proc.returncode != 0:
+            # leave them to "finish"
+            log(f"batch exited with {proc.returncode}, dropping it")
+            os.unlink(output)
+            return
+        with open(self.scanned_path, "a") as f:
+            f.writelines(f"{p}\n" for p in pkgs)
+
+
+def watch(args, cmd):
+    batches = Batches(args.dir)
+    queued = set()
+    pending = []
+    new_results = []
+    running = None
+    last_borked = time.monotonic()
+
+    parser = ET.XMLPullParser(events=("end",))
+    while not os.path.exists(args.post):
+        if os.path.exists(args.done):
+            return 0
+        time.sleep(POLL)
+
+    with open(args.post, "rb") as f, tempfile.TemporaryDirectory() as tmpdir:
+        while True:
+            done = os.path.exists(args.done)
+            data = f.read()
+            if data:
+                parser.feed(data)
+                for event, elem in parser.read_events():
+                    if elem.tag == "result":
+                        new_results.append(ET.tostring(elem))
+                        elem.clear()
+
+            if done:
+                break
+
+            if new_results and time.monotonic() - last_borked >= BORKED_INTERVAL:
+                for pkg in borked_packages(new_results, tmpdir):
+                    if pkg not in queued:
+                        queued.add(pkg)
+                        pending.append(pkg)
+                new_results = []
+                last_borked = time.monotonic()
+
+            if running is not None and running[0].poll() is not None:
+                batches.finished(running)
+                running = None
+            if running is None and pending:
+                running = batches.start(cmd, args.jobs, pending)
+                pending = []
+
+            time.sleep(POLL)
+
+    if running is not None:
+        batches.finished(running)
+    return 0
+
+
+def result_target(elem):
+    values = {x.tag: x.text or "" for x in elem}
+    return values.get("category", ""), values.get("package", "")
+
+
+def finish(args, cmd):
+    batches = Batches(args.dir)
+    with open(args.borked) as f:
+        packages = [l.strip() for l in f if l.strip()]
+    wanted = set(packages)
+    remaining = [p for p in packages if p not in batches.scanned()]
+    log(f"{len(wanted) - len(remaining)} packages already scanned")
+    if remaining:
+        batches.finished(batches.start(cmd, args.jobs, remaining))
+        missing = set(remaining) - batches.scanned()
+        if missing:
+            log(f"scanning failed for: {' '.join(sorted(missing))}")
+            return 1
+
+    # keep only the results of the packages broken in the end
+    with open(args.output + ".tmp", "wb") as out:
+        out.write(b"<checks>\n")
+        for path in batches.outputs():
+            for event, elem in ET.iterparse(path):
+                if elem.tag != "result":
+                    continue
+                cat, pkg = result_target(elem)
+                if f"{cat}/{pkg}" in wanted or cat in wanted:
+                    elem.tail = "\n"
+                    out.write(ET.tostring(elem))
+                elem.clear()
+        out.write(b"</checks>\n")
+    os.rename(args.output + ".tmp", args.output)
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    sub = argp.add_subparsers(dest="command", required=True)
+    w = sub.add_parser("watch")
+    w.add_argument("--post", required=True, help="post-merge XML being written")
+    w.add_argument("--done", required=True, help="created when it is complete")
+    f = sub.add_parser("finish")
+    f.add_argument("-o", "--output", required=True, help="merged XML output")
+    f.add_argument("--borked", required=True, help="final broken packages")
+    for p in (w, f):
+        p.add_argument("--dir", required=True, help="batch outputs")
+        p.add_argument("--jobs", type=int, default=1, help="pkgcheck jobs")
+        p.add_argument("pkgcheck", nargs=argparse.REMAINDER)
+    args = argp.parse_args()
+
+    cmd = args.pkgcheck
+    if cmd[:1] == ["--"]:
+        cmd = cmd[1:]
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        if args.command == "watch":
+            return watch(args, cmd)
+        return finish(args, cmd)
+    finally:
+        for proc in children:
+            proc.terminate()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
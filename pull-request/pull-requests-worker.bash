@@ -5,6 +5,8 @@ source "${0%/*}/../repo-mirror-ci.conf"
 
 set -e -x
 
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
 # SANITY!
 export TZ=UTC
 
@@ -13,7 +15,11 @@ sync=${SYNC_DIR}/gentoo
 mirror=${MIRROR_DIR}/gentoo
 gentooci=${GENTOO_CI_GIT}
 
-for d in "${pull}"; do
+# the pre-merge tree gets its own config (used in concurrent mode)
+for x in "${pull}:${pull}/tmp" "${pull}/pre-merge-root:${pull}/pre-merge"; do
+	d=${x%%:*}
+	repo=${x#*:}
+
 	# populate with necessary files
 	mkdir -p -- "${d}"/etc/portage
 	if [[ ! -e ${d}/etc/portage/make.profile ]]; then
@@ -29,7 +35,7 @@ for d in "${pull}"; do
 		main-repo = gentoo
 
 		[gentoo]
-		location = ${pull}/tmp
+		location = ${repo}
 	EOF
 done
 
@@ -306,48 +312,103 @@ create_pkgcheck_setpriv_wrapper() {
 create_pmaint_setpriv_wrapper
 create_pkgcheck_setpriv_wrapper
 
+# more than one PR means a merge train (batch), the first PR names
+# the branches
+prs=( "${@}" )
 pr=${1}
 forge="${pr%/*}"
 prid="${pr#*/}"
-ref=refs/pull/${pr}
 
 cd
-rm -rf -- tmp gentoo-ci
+rm -rf -- tmp gentoo-ci pre-merge
 
 git clone -s --no-checkout "${mirror}" tmp
 cd -- tmp
-git fetch "${sync}" "${ref}:${ref}"
-# start on top of last common commit, like fast-forward would do
-git branch "pull-${forge}-${prid}" "$(git merge-base "${ref}" master)"
+base=
+for p in "${prs[@]}"; do
+	ref=refs/pull/${p}
+	git fetch "${sync}" "${ref}:${ref}"
+	# start on top of last common commit, like fast-forward would do;
+	# for batches, use the newest one so that no PR drags master back
+	b=$(git merge-base "${ref}" master)
+	if [[ -z ${base} ]] || git merge-base --is-ancestor "${base}" "${b}"; then
+		base=${b}
+	fi
+done
+git branch "pull-${forge}-${prid}" "${base}"
 git checkout -q "pull-${forge}-${prid}"
 # copy existing md5-cache (TODO: try to find previous merge commit)
 rsync -rlpt --delete "${mirror}"/metadata/{dtd,glsa,md5-cache,news,xml-schema} metadata
 
-# merge the PR on top of cache
+# merge the PR(s) on top of cache
 git tag pre-merge
-git merge --quiet -m "Merge PR ${pr}" "${ref}"
+if [[ ${PULL_REQUEST_CONCURRENT_PREMERGE} ]]; then
+	# pre-merge tree for the concurrent scans, sharing the objects
+	git worktree add -q --detach "${pull}"/pre-merge pre-merge
+fi
+for p in "${prs[@]}"; do
+	git merge --quiet -m "Merge PR ${p}" "refs/pull/${p}"
+done
 
 # update cache
 CONFIG_DIR=${pull}/etc/portage
 
-if ! time timeout -k 30s "${PMAINT_TIMEOUT}" "${WORKER_DIR}"/pmaint-wrapper \
+if ! time trace_span pr-regen pr="${prs[*]}" -- \
+	timeout -k 30s "${PMAINT_TIMEOUT}" "${WORKER_DIR}"/pmaint-wrapper \
 	"${CONFIG_DIR}" "${REPOS_DIR}" "${REPOS_DIR}"/gentoo \
-	pmaint --config "${CONFIG_DIR}" regen --use-local-desc --pkg-desc-index -t "$(nproc)" gentoo ; then
+	pmaint --config "${CONFIG_DIR}" regen --use-local-desc --pkg-desc-index -t "${CI_THREADS:-$(nproc)}" gentoo ; then
 	ret=$?
 	echo ETOOMANY > .pre-merge.borked
 	exit ${ret}
 fi
 
+if [[ ${PULL_REQUEST_CONCURRENT_PREMERGE} ]]; then
+	# give the pre-merge tree the regenerated cache, like checking out
+	# pre-merge (keeping the untracked files) does in sequential mode
+	git ls-files -z --others -- metadata |
+		rsync -lpt --from0 --files-from=- . "${pull}"/pre-merge
+fi
+
 cd ..
 git clone -s "${gentooci}" gentoo-ci
 cd -- gentoo-ci
 git checkout -b "pull-${forge}-${prid}"
 
+threads=${CI_THREADS:-$(nproc)}
+scan_jobs=${threads}
+if [[ ${PULL_REQUEST_CONCURRENT_PREMERGE} ]]; then
+	# start the pre-merge scans right away: the repo/cat one
+	# speculatively, the pkg/ver one for the packages found broken
+	# by the post-merge scan as it goes; a quarter of threads for each
+	PRE_CONFIG_DIR=${pull}/pre-merge-root/etc/portage
+	pre_jobs=$(( threads / 4 > 0 ? threads / 4 : 1 ))
+	scan_jobs=$(( threads - 2 * pre_jobs > 0 ? threads - 2 * pre_jobs : 1 ))
+	pre_scan=(
+		pkgcheck --config "${PRE_CONFIG_DIR}"
+		scan --reporter XmlReporter ${PKGCHECK_PR_OPTIONS}
+	)
+	rm -f -- "${pull}"/tmp/.post-merge-done
+
+	pushd -- "${pull}"/pre-merge >/dev/null
+	"${pre_scan[@]}" --jobs "${pre_jobs}" "*/*" -s repo,cat \
+		> "${pull}"/tmp/.pre-merge-g.xml &
+	pre_global=${!}
+	"${SCRIPT_DIR}"/pull-request/pre-merge-scan.py watch \
+		--post "${pull}"/tmp/output.xml.tmp --done "${pull}"/tmp/.post-merge-done \
+		--dir "${pull}"/tmp/.pre-merge-batches --jobs "${pre_jobs}" \
+		-- "${pre_scan[@]}" -s pkg,ver &
+	pre_watch=${!}
+	popd >/dev/null
+	trap 'kill "${pre_global}" "${pre_watch}" 2>/dev/null || :' EXIT
+fi
+
 pushd -- "${pull}"/tmp >/dev/null
-HOME=${pull}/gentoo-ci time timeout -k 30s "${CI_TIMEOUT}" "${WORKER_DIR}"/pkgcheck-wrapper \
+HOME=${pull}/gentoo-ci trace_span pr-scan pr="${prs[*]}" -- \
+	time timeout -k 30s "${CI_TIMEOUT}" "${WORKER_DIR}"/pkgcheck-wrapper \
 	"${CONFIG_DIR}" "${pull}"/tmp "${pull}"/tmp \
-	pkgcheck --config "${CONFIG_DIR}" scan \
+	pkgcheck --config "${CONFIG_DIR}" scan --jobs "${scan_jobs}" \
 	--reporter XmlReporter ${PKGCHECK_PR_OPTIONS} > output.xml.tmp
+touch .post-merge-done
 popd >/dev/null
 # Sort XML for better Git delta compression
 cat "${pull}"/tmp/output.xml.tmp | xsltproc "${SCRIPT_DIR}"/sort-output.xsl - > output.xml
@@ -359,7 +420,7 @@ ts=$(cd -- "${pull}"/tmp; git log --pretty='%ct' -1)
 	-w -e -o borked.list *.xml
 
 git add -- *.xml
-git diff --cached --quiet --exit-code || git commit -a -m "PR ${pr} @ $(date -u --date="@${ts}" "+%Y-%m-%d %H:%M:%S UTC")"
+git diff --cached --quiet --exit-code || git commit -a -m "PR ${prs[*]} @ $(date -u --date="@${ts}" "+%Y-%m-%d %H:%M:%S UTC")"
 
 # if we have any breakages...
 if [[ -s ${pull}/gentoo-ci/borked.list ]]; then
@@ -370,9 +431,38 @@ if [[ -s ${pull}/gentoo-ci/borked.list ]]; then
 
 	# go back to pre-merge state and see if they were there
 	cd -- "${pull}"/tmp
-	git checkout -q pre-merge
+	[[ ${PULL_REQUEST_CONCURRENT_PREMERGE} ]] || git checkout -q pre-merge
+
+	if [[ ${PULL_REQUEST_CONCURRENT_PREMERGE} &&
+			${#pkgs[@]} -le ${PULL_REQUEST_BORKED_LIMIT} ]]; then
+		outfiles=()
 
-	if [[ ${#pkgs[@]} -le ${PULL_REQUEST_BORKED_LIMIT} ]]; then
+		# scan the packages not scanned while the post-merge scan ran,
+		# with the threads it used (if the watcher failed, all of them)
+		wait "${pre_watch}" || :
+		if [[ ${#pkgs[@]} -gt 0 ]]; then
+			pushd -- "${pull}"/pre-merge >/dev/null
+			"${SCRIPT_DIR}"/pull-request/pre-merge-scan.py finish \
+				--borked "${pull}"/gentoo-ci/borked.list \
+				--dir "${pull}"/tmp/.pre-merge-batches \
+				--jobs $(( threads - pre_jobs )) \
+				-o "${pull}"/tmp/.pre-merge.xml \
+				-- "${pre_scan[@]}" -s pkg,ver
+			popd >/dev/null
+			outfiles+=( .pre-merge.xml )
+		fi
+
+		wait "${pre_global}"
+		outfiles+=( .pre-merge-g.xml )
+
+		"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
+			-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
+			-w -e -o .pre-merge.borked "${outfiles[@]}"
+
+		"${SCRIPT_DIR}"/pull-request/pkgcheckdiff.py -o .pre-merge.diff.json \
+			--post "${pull}"/gentoo-ci/output.xml --pre "${outfiles[@]}" || :
+		premerge_used=1
+	elif [[ ${#pkgs[@]} -le ${PULL_REQUEST_BORKED_LIMIT} ]]; then
 		outfiles=()
 
 		if [[ ${#pkgs[@]} -gt 0 ]]; then
@@ -394,7 +484,22 @@ if [[ -s ${pull}/gentoo-ci/borked.list ]]; then
 		"${PKGCHECK_RESULT_PARSER_GIT}"/pkgcheck2borked.py \
 			-x "${PKGCHECK_RESULT_PARSER_GIT}"/excludes.json \
 			-w -e -o .pre-merge.borked "${outfiles[@]}"
+
+		# compare individual results too, so that new issues in already
+		# broken packages are not missed (if that fails, the report
+		# compares the borked lists only)
+		"${SCRIPT_DIR}"/pull-request/pkgcheckdiff.py -o .pre-merge.diff.json \
+			--post "${pull}"/gentoo-ci/output.xml --pre "${outfiles[@]}" || :
 	else
 		echo ETOOMANY > .pre-merge.borked
 	fi
 fi
+
+if [[ ${PULL_REQUEST_CONCURRENT_PREMERGE} ]]; then
+	# stop the speculative scans and drop their results if not needed
+	kill "${pre_global}" "${pre_watch}" 2>/dev/null || :
+	wait "${pre_global}" "${pre_watch}" || :
+	trap - EXIT
+	rm -rf -- "${pull}"/tmp/.pre-merge-batches "${pull}"/tmp/.post-merge-done
+	[[ ${premerge_used} ]] || rm -f -- "${pull}"/tmp/.pre-merge-g.xml
+fi
@@ -2,6 +2,9 @@
 
 set -e -x
 
+. "${SCRIPT_DIR}"/notify/notify.bash
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
 # SANITY!
 export TZ=UTC
 
@@ -10,27 +13,66 @@ mirror=${MIRROR_DIR}/gentoo
 gentooci=${GENTOO_CI_GIT}
 pull=${PULL_REQUEST_DIR}
 
+run_worker() {
+	local ret=0 worker watcher heads=() p
+
+	# run the worker in its own process group, so that the head watcher
+	# can abort it if any of the PRs is updated in the meantime
+	rm -f -- "${pull}"/superseded
+	setsid sudo -u "${WORKER_USER}" CI_THREADS="${CI_THREADS:-$(nproc)}" \
+		bwrap --bind / / --dev /dev --proc /proc --unshare-all --die-with-parent \
+		"${SCRIPT_DIR}"/pull-request/pull-requests-worker.bash \
+		"${@}" &
+	worker=${!}
+	for p; do
+		heads+=( "${p}=$(cd -- "${sync}"; git rev-parse "refs/pull/${p}")" )
+	done
+	"${SCRIPT_DIR}"/pull-request/watch-pull-request-head.py "${worker}" "${heads[@]}" &
+	watcher=${!}
+
+	wait "${worker}" || ret=${?}
+	# (ignored by the watcher if it aborted the worker, it then exits
+	# once the PRs are requeued)
+	kill "${watcher}" 2>/dev/null || :
+	wait "${watcher}" || :
+
+	# leave starting over to restart_if_superseded
+	[[ -s ${pull}/superseded ]] && return 0
+	return "${ret}"
+}
+
+# to be called after run_worker, outside of it (as trace_span may run it
+# in a subshell)
+restart_if_superseded() {
+	if [[ -s ${pull}/superseded ]]; then
+		# the watcher requeued the PRs at the front, start over
+		rm -f -- "${pull}"/current-pr "${pull}"/superseded
+		exec bash "${BASH_SOURCE[0]}"
+	fi
+}
+
 if [[ -s ${pull}/current-pr ]]; then
-	pr=$(<"${pull}"/current-pr)
-	forge="${pr%/*}"
-	prid="${pr#*/}"
-	cd -- "${sync}"
-	case ${forge} in
-		github) prlink="${PULL_REQUEST_REPO}/pull/${prid}";;
-		codeberg) prlink="https://codeberg.org/${CODEBERG_REPO}/pulls/${prid}";;
-		*) echo "unknown forge ${forge}"; exit 1;;
-	esac
-	"${SCRIPT_DIR}"/pull-request/set-pull-request-status.py "${pr}" error \
-		"QA checks crashed. Please rebase and check profile changes for syntax errors."
-	sendmail "${CRONJOB_ADMIN_MAIL}" <<-EOF
-		Subject: Pull request crash: ${pr}
-		To: <${CRONJOB_ADMIN_MAIL}>
-		Content-Type: text/plain; charset=utf8
-
-		It seems that pull request check for ${pr} crashed [1].
-
-		[1]:${prlink}
-	EOF
+	while read pr; do
+		forge="${pr%/*}"
+		prid="${pr#*/}"
+		cd -- "${sync}"
+		case ${forge} in
+			github) prlink="${PULL_REQUEST_REPO}/pull/${prid}";;
+			codeberg) prlink="https://codeberg.org/${CODEBERG_REPO}/pulls/${prid}";;
+			*) echo "unknown forge ${forge}"; exit 1;;
+		esac
+		"${SCRIPT_DIR}"/pull-request/set-pull-request-status.py "${pr}" error \
+			"QA checks crashed. Please rebase and check profile changes for syntax errors."
+		notify_mail "${CRONJOB_ADMIN_MAIL}" <<-EOF
+			Subject: Pull request crash: ${pr}
+			To: <${CRONJOB_ADMIN_MAIL}>
+			Content-Type: text/plain; charset=utf8
+
+			It seems that pull request check for ${pr} crashed [1].
+
+			[1]:${prlink}
+		EOF
+	done <"${pull}"/current-pr
 	rm -f -- "${pull}"/current-pr
 fi
 
@@ -38,41 +80,79 @@ cd -- "${mirror}"
 git pull
 
 # check if we have anything to process
+# (more than one PR is printed when batching is enabled)
 mkdir -p -- "${pull}"
-pr=$( "${SCRIPT_DIR}"/pull-request/scan-pull-requests.py )
-forge="${pr%/*}"
-prid="${pr#*/}"
+prs=( $( trace_span forge-scan -- "${SCRIPT_DIR}"/pull-request/scan-pull-requests.py ) )
+pr=${prs[0]}
 
 if [[ -n ${pr} ]]; then
-	echo "${pr}" > "${pull}"/current-pr
+	printf '%s\n' "${pr}" > "${pull}"/current-pr
 
 	cd -- "${sync}"
 	if ! git remote | grep -q codeberg; then
 		git remote add codeberg "https://codeberg.org/${CODEBERG_REPO}"
 	fi
-	ref=refs/pull/${pr}
-
-	case ${forge} in
-		github) remote="origin";;
-		codeberg) remote="codeberg";;
-		*) echo "unknown forge ${forge}"; exit 1;;
-	esac
-	git fetch -f "${remote}" "refs/pull/${prid}/head:${ref}"
-	hash=$(git rev-parse "${ref}")
-
-	sudo -u "${WORKER_USER}" \
-		bwrap --bind / / --dev /dev --proc /proc --unshare-all \
-		"${SCRIPT_DIR}"/pull-request/pull-requests-worker.bash \
-		"${pr}"
+
+	for p in "${prs[@]}"; do
+		case ${p%/*} in
+			github) remote="origin";;
+			codeberg) remote="codeberg";;
+			*) echo "unknown forge ${p%/*}"; exit 1;;
+		esac
+		git fetch -f "${remote}" "refs/pull/${p#*/}/head:refs/pull/${p}"
+	done
+
+	batched=
+	if [[ ${#prs[@]} -gt 1 ]]; then
+		prs=( $( "${SCRIPT_DIR}"/pull-request/merge-train.py select "${prs[@]}" ) )
+		for p in "${prs[@]:1}"; do
+			"${SCRIPT_DIR}"/pull-request/set-pull-request-status.py "${p}" pending \
+				"QA checks in progress..."
+		done
+		printf '%s\n' "${prs[@]}" > "${pull}"/current-pr
+	fi
+
+	if [[ ${#prs[@]} -gt 1 ]]; then
+		if trace_span pr-check pr="${prs[*]}" -- run_worker "${prs[@]}" &&
+			"${SCRIPT_DIR}"/pull-request/merge-train.py attribute \
+				"${WORKER_DIR}"/gentoo-ci/borked.list \
+				"${WORKER_DIR}"/tmp/.pre-merge.borked "${prs[@]}"
+		then
+			batched=1
+		fi
+		restart_if_superseded
+		if [[ ! ${batched} ]]; then
+			# the batch failed or the issues could not be attributed,
+			# retry the first PR alone and requeue the rest
+			"${SCRIPT_DIR}"/pull-request/merge-train.py split "${prs[@]}"
+			prs=( "${pr}" )
+			printf '%s\n' "${pr}" > "${pull}"/current-pr
+		fi
+	fi
+	if [[ ! ${batched} ]]; then
+		trace_span pr-check pr="${pr}" -- run_worker "${pr}"
+		restart_if_superseded
+	fi
 
 	cd -- "${gentooci}"
-	git fetch "${WORKER_DIR}"/gentoo-ci "pull-${forge}-${prid}"
+	git fetch "${WORKER_DIR}"/gentoo-ci "pull-${pr%/*}-${pr#*/}"
 	pr_hash=$(git rev-parse --short FETCH_HEAD)
-	git push -f origin "FETCH_HEAD:refs/heads/pull-${forge}-${prid}"
+	refspecs=()
+	for p in "${prs[@]}"; do
+		refspecs+=( "FETCH_HEAD:refs/heads/pull-${p%/*}-${p#*/}" )
+	done
+	git push -f origin "${refspecs[@]}"
 
 	curl "https://qa-reports-cdn-origin.gentoo.org/cgi-bin/trigger-pull.cgi?gentoo-ci" || :
-	"${SCRIPT_DIR}"/pull-request/report-pull-request.py "${forge}" "${prid}" "${pr_hash}" \
-		"${WORKER_DIR}"/gentoo-ci/borked.list "${WORKER_DIR}"/tmp/.pre-merge.borked "${hash}"
+	for p in "${prs[@]}"; do
+		borked=${WORKER_DIR}/gentoo-ci/borked.list
+		[[ ! ${batched} ]] || borked=${pull}/batch/${p%/*}-${p#*/}.borked
+		trace_span forge-report pr="${p}" -- \
+			"${SCRIPT_DIR}"/pull-request/report-pull-request.py "${p%/*}" "${p#*/}" "${pr_hash}" \
+			"${borked}" "${WORKER_DIR}"/tmp/.pre-merge.borked \
+			"$(cd -- "${sync}"; git rev-parse "refs/pull/${p}")" \
+			"${WORKER_DIR}"/tmp/.pre-merge.diff.json
+	done
 
 	rm -f -- "${pull}"/current-pr
 fi
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 
 import datetime
+import errno
+import json
 import os
 import os.path
+import pickle
 import sys
 
 import github
+import requests
 from codebergapi import CodebergAPI
 
 
@@ -18,9 +22,55 @@ HAD_BROKEN_SUBS = (
 )
 
 
+def report_body(
+    borked, pre_borked, too_many_borked, had_broken, report_url, commit_hash
+):
+    body = """## Pull request CI report
+
+*Report generated at*: %s
+*Newest commit scanned*: %s
+*Status*: %s
+""" % (
+        datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M UTC"),
+        commit_hash,
+        ":x: **broken**" if borked else ":white_check_mark: good",
+    )
+
+    if borked or pre_borked:
+        if borked:
+            if too_many_borked:
+                body += "\nThere are too many broken packages to determine whether the breakages were added by the pull request. If in doubt, please rebase.\n\nIssues:"
+            else:
+                body += "\nNew issues caused by PR:\n"
+            for url in borked:
+                body += url
+        if pre_borked:
+            body += (
+                "\nThere are existing issues already. Please look into the report to make sure none of them affect the packages in question:\n%s\n"
+                % report_url
+            )
+    elif had_broken:
+        body += "\nAll QA issues have been fixed!\n"
+    else:
+        body += "\nNo issues found\n"
+
+    return body
+
+
 def report_codeberg_pr(
-    prid, prhash, borked, pre_borked, too_many_borked, report_uri_prefix, commit_hash
+    prid,
+    prhash,
+    borked,
+    pre_borked,
+    too_many_borked,
+    report_uri_prefix,
+    commit_hash,
+    cached_comment,
 ):
+    """
+    Post or update the report comment, return (comment id, had_broken)
+    for caching.
+    """
     CODEBERG_USERNAME = os.environ["CODEBERG_USERNAME"]
     CODEBERG_TOKEN_FILE = os.environ["CODEBERG_TOKEN_FILE"]
     (owner, repo) = os.environ["CODEBERG_REPO"].split("/")
@@ -28,48 +78,45 @@ def report_codeberg_pr(
     with open(CODEBERG_TOKEN_FILE) as f:
         token = f.read().strip()
 
-    with CodebergAPI(owner, repo, token) as cb:
-        # delete old results
-        had_broken = False
-        old_comments = []
-        # note: technically we could have multiple leftover comments
-        for co in cb.get_comments(prid):
-            if co["user"]["login"] == CODEBERG_USERNAME:
-                # skip comments that don't look like CI results
-                if not co["body"].startswith("## Pull request CI report"):
-                    continue
-                old_comments.append(co["id"])
-                had_broken = had_broken or any(
-                    sub in co["body"] for sub in HAD_BROKEN_SUBS
-                )
-
-        for co_id in old_comments:
-            cb.delete_comment(co_id)
-
-        report_url = report_uri_prefix + "/" + prhash + "/output.html"
-        body = f"""## Pull request CI report
-
-*Report generated at*: {datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M UTC")}
-*Newest commit scanned*: {commit_hash}
-*Status*: {":x: **broken**" if borked else ":white_check_mark: good"}
-"""
-
-        if borked or pre_borked:
-            if borked:
-                if too_many_borked:
-                    body += "\nThere are too many broken packages to determine whether the breakages were added by the pull request. If in doubt, please rebase.\n\nIssues:"
-                else:
-                    body += "\nNew issues caused by PR:\n"
-                for url in borked:
-                    body += url
-            if pre_borked:
-                body += f"\nThere are existing issues already. Please look into the report to make sure none of them affect the packages in question:\n{report_url}\n"
-        elif had_broken:
-            body += "\nAll QA issues have been fixed!\n"
-        else:
-            body += "\nNo issues found\n"
+    report_url = report_uri_prefix + "/" + prhash + "/output.html"
 
-        cb.create_comment(prid, body)
+    with CodebergAPI(owner, repo, token) as cb:
+        comment_id = None
+        # try editing the cached comment in place first
+        if cached_comment is not None:
+            comment_id, had_broken = cached_comment
+            body = report_body(
+                borked, pre_borked, too_many_borked, had_broken, report_url, commit_hash
+            )
+            try:
+                cb.edit_comment(comment_id, body)
+            except requests.HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+                comment_id = None
+
+        if comment_id is None:
+            # delete old results
+            had_broken = False
+            old_comments = []
+            # note: technically we could have multiple leftover comments
+            for co in cb.get_comments(prid):
+                if co["user"]["login"] == CODEBERG_USERNAME:
+                    # skip comments that don't look like CI results
+                    if not co["body"].startswith("## Pull request CI report"):
+                        continue
+                    old_comments.append(co["id"])
+                    had_broken = had_broken or any(
+                        sub in co["body"] for sub in HAD_BROKEN_SUBS
+                    )
+
+            for co_id in old_comments:
+                cb.delete_comment(co_id)
+
+            body = report_body(
+                borked, pre_borked, too_many_borked, had_broken, report_url, commit_hash
+            )
+            comment_id = cb.create_comment(prid, body)["id"]
 
         if borked:
             cb.commit_set_status(
@@ -96,10 +143,23 @@ def report_codeberg_pr(
                 context="gentoo-ci",
             )
 
+    return (comment_id, any(sub in body for sub in HAD_BROKEN_SUBS))
+
 
 def report_github_pr(
-    prid, prhash, borked, pre_borked, too_many_borked, report_uri_prefix, commit_hash
+    prid,
+    prhash,
+    borked,
+    pre_borked,
+    too_many_borked,
+    report_uri_prefix,
+    commit_hash,
+    cached_comment,
 ):
+    """
+    Post or update the report comment, return (comment id, had_broken)
+    for caching.
+    """
     GITHUB_USERNAME = os.environ["GITHUB_USERNAME"]
     GITHUB_TOKEN_FILE = os.environ["GITHUB_TOKEN_FILE"]
     GITHUB_REPO = os.environ["GITHUB_REPO"]
@@ -107,56 +167,51 @@ def report_github_pr(
     with open(GITHUB_TOKEN_FILE) as f:
         token = f.read().strip()
 
-    g = github.Github(GITHUB_USERNAME, token, per_page=50)
+    g = github.Github(
+        GITHUB_USERNAME,
+        token,
+        per_page=50,
+        base_url=os.environ.get("GITHUB_API_URL", github.Consts.DEFAULT_BASE_URL),
+    )
     r = g.get_repo(GITHUB_REPO)
     pr = r.get_pull(int(prid))
     c = r.get_commit(commit_hash)
 
-    # delete old results
-    had_broken = False
-    old_comments = []
-    # note: technically we could have multiple leftover comments
-    for co in pr.get_issue_comments():
-        if co.user.login == GITHUB_USERNAME:
-            # skip comments that don't look like CI results
-            if not co.body.startswith("## Pull request CI report"):
-                continue
-            old_comments.append(co)
-            had_broken = had_broken or any(sub in co.body for sub in HAD_BROKEN_SUBS)
-    for co in old_comments:
-        co.delete()
-
     report_url = report_uri_prefix + "/" + prhash + "/output.html"
-    body = """## Pull request CI report
 
-*Report generated at*: %s
-*Newest commit scanned*: %s
-*Status*: %s
-""" % (
-        datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M UTC"),
-        commit_hash,
-        ":x: **broken**" if borked else ":white_check_mark: good",
-    )
+    comment_id = None
+    # try editing the cached comment in place first
+    if cached_comment is not None:
+        comment_id, had_broken = cached_comment
+        body = report_body(
+            borked, pre_borked, too_many_borked, had_broken, report_url, commit_hash
+        )
+        try:
+            pr.get_issue_comment(comment_id).edit(body)
+        except github.UnknownObjectException:
+            comment_id = None
 
-    if borked or pre_borked:
-        if borked:
-            if too_many_borked:
-                body += "\nThere are too many broken packages to determine whether the breakages were added by the pull request. If in doubt, please rebase.\n\nIssues:"
-            else:
-                body += "\nNew issues caused by PR:\n"
-            for url in borked:
-                body += url
-        if pre_borked:
-            body += (
-                "\nThere are existing issues already. Please look into the report to make sure none of them affect the packages in question:\n%s\n"
-                % report_url
-            )
-    elif had_broken:
-        body += "\nAll QA issues have been fixed!\n"
-    else:
-        body += "\nNo issues found\n"
+    if comment_id is None:
+        # delete old results
+        had_broken = False
+        old_comments = []
+        # note: technically we could have multiple leftover comments
+        for co in pr.get_issue_comments():
+            if co.user.login == GITHUB_USERNAME:
+                # skip comments that don't look like CI results
+                if not co.body.startswith("## Pull request CI report"):
+                    continue
+                old_comments.append(co)
+                had_broken = had_broken or any(
+                    sub in co.body for sub in HAD_BROKEN_SUBS
+                )
+        for co in old_comments:
+            co.delete()
 
-    pr.create_issue_comment(body)
+        body = report_body(
+            borked, pre_borked, too_many_borked, had_broken, report_url, commit_hash
+        )
+        comment_id = pr.create_issue_comment(body).id
 
     if borked:
         c.create_status(
@@ -180,31 +235,60 @@ def report_github_pr(
             context="gentoo-ci",
         )
 
+    return (comment_id, any(sub in body for sub in HAD_BROKEN_SUBS))
+
+
+def load_comment_db(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return {}
 
-def main(forge, prid, prhash, borked_path, pre_borked_path, commit_hash):
+
+def main(
+    forge, prid, prhash, borked_path, pre_borked_path, commit_hash, diff_path=None
+):
     REPORT_URI_PREFIX = os.environ["GENTOO_CI_URI_PREFIX"]
+    PULL_REQUEST_COMMENT_DB = os.environ["PULL_REQUEST_COMMENT_DB"]
 
-    borked = []
+    borked = {}
     with open(borked_path) as f:
         for l in f:
-            borked.append(REPORT_URI_PREFIX + "/" + prhash + "/output.html#" + l)
+            borked[l.strip()] = REPORT_URI_PREFIX + "/" + prhash + "/output.html#" + l
 
     pre_borked = []
     too_many_borked = False
     if borked:
         with open(pre_borked_path) as f:
-            for l in f:
-                if l.strip() == "ETOOMANY":
-                    too_many_borked = True
-                    break
+            pre_borked_pkgs = set(l.strip() for l in f)
+        if "ETOOMANY" in pre_borked_pkgs:
+            too_many_borked = True
+            pre_borked_pkgs = set()
+
+        # result-level diff from pkgcheckdiff.py, if available
+        diff = {}
+        if diff_path is not None and os.path.exists(diff_path):
+            with open(diff_path) as f:
+                diff = json.load(f)["packages"]
+
+        for pkg in list(borked):
+            if pkg not in pre_borked_pkgs:
+                continue
+            # packages broken already that gained new issues are still new
+            if diff.get(pkg, {}).get("new", 0) > 0:
+                continue
+            pre_borked.append(borked.pop(pkg))
+    borked = list(borked.values())
 
-                lf = REPORT_URI_PREFIX + "/" + prhash + "/output.html#" + l
-                if lf in borked:
-                    pre_borked.append(lf)
-                    borked.remove(lf)
+    # cached (comment id, had_broken) of our last report per PR
+    comment_db = load_comment_db(PULL_REQUEST_COMMENT_DB)
+    pr_key = f"{forge}/{prid}"
 
     if forge == "github":
-        report_github_pr(
+        comment_db[pr_key] = report_github_pr(
             prid,
             prhash,
             borked,
@@ -212,9 +296,10 @@ def main(forge, prid, prhash, borked_path, pre_borked_path, commit_hash):
             too_many_borked,
             REPORT_URI_PREFIX,
             commit_hash,
+            comment_db.get(pr_key),
         )
     elif forge == "codeberg":
-        report_codeberg_pr(
+        comment_db[pr_key] = report_codeberg_pr(
             prid,
             prhash,
             borked,
@@ -222,8 +307,13 @@ def main(forge, prid, prhash, borked_path, pre_borked_path, commit_hash):
             too_many_borked,
             REPORT_URI_PREFIX,
             commit_hash,
+            comment_db.get(pr_key),
         )
 
+    with open(PULL_REQUEST_COMMENT_DB + ".tmp", "wb") as f:
+        pickle.dump(comment_db, f)
+    os.rename(PULL_REQUEST_COMMENT_DB + ".tmp", PULL_REQUEST_COMMENT_DB)
+
 
 if __name__ == "__main__":
     sys.exit(main(*sys.argv[1:]))
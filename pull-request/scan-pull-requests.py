@@ -5,16 +5,18 @@
 from __future__ import print_function
 
 import errno
+import json
 import os
 import pickle
 import sys
+import time
 from datetime import datetime
 
 import github
 from codebergapi import CodebergAPI
 
 
-def scan_codeberg(db: dict):
+def scan_codeberg(db: dict, requeue: list, seen: set):
     CODEBERG_USERNAME = os.environ["CODEBERG_USERNAME"]
     CODEBERG_TOKEN_FILE = os.environ["CODEBERG_TOKEN_FILE"]
     (owner, repo) = os.environ["CODEBERG_REPO"].split("/")
@@ -27,6 +29,7 @@ def scan_codeberg(db: dict):
         for pr in cb.pulls():
             pr_key = f"codeberg/{pr['number']}"
             sha = pr["head"]["sha"]
+            seen.add(pr_key)
 
             # skip PRs marked noci
             if any(x["name"] == "noci" for x in pr["labels"]):
@@ -79,6 +82,7 @@ def scan_codeberg(db: dict):
         to_process = sorted(
             to_process,
             key=lambda x: (
+                f"codeberg/{x['number']}" not in requeue,
                 not any(x["name"] == "priority-ci" for x in pr["labels"]),
                 datetime.fromisoformat(x["updated_at"]),
             ),
@@ -101,7 +105,7 @@ def scan_codeberg(db: dict):
         return queue
 
 
-def scan_github(db: dict, queue_len: int):
+def scan_github(db: dict, requeue: list, seen: set, queue_len: int):
     """
     Given a db of knowns PRs, inspect open PRs, update commit
     statuses, and update the db accordingly. Return a list of
@@ -114,7 +118,12 @@ def scan_github(db: dict, queue_len: int):
     with open(GITHUB_TOKEN_FILE) as f:
         token = f.read().strip()
 
-    g = github.Github(GITHUB_USERNAME, token, per_page=250)
+    g = github.Github(
+        GITHUB_USERNAME,
+        token,
+        per_page=250,
+        base_url=os.environ.get("GITHUB_API_URL", github.Consts.DEFAULT_BASE_URL),
+    )
     r = g.get_repo(GITHUB_REPO)
 
     to_process = []
@@ -124,6 +133,7 @@ def scan_github(db: dict, queue_len: int):
         pr_key = f"github/{pr.number}"
         # support pr.number as implicitly a github PR, but default to pr_key
         db_key = pr.number if pr.number in db else pr_key
+        seen.add(pr_key)
         # skip PRs marked noci
         if any(x.name == "noci" for x in pr.labels):
             print(f"{pr_key}: noci", file=sys.stderr)
@@ -174,6 +184,7 @@ def scan_github(db: dict, queue_len: int):
     to_process = sorted(
         to_process,
         key=lambda x: (
+            f"github/{x.number}" not in requeue,
             not any(x.name == "priority-ci" for x in x.labels),
             x.updated_at,
         ),
@@ -201,6 +212,8 @@ def scan_github(db: dict, queue_len: int):
 
 def main():
     PULL_REQUEST_DB = os.environ["PULL_REQUEST_DB"]
+    PULL_REQUEST_REQUEUE = os.environ["PULL_REQUEST_REQUEUE"]
+    PULL_REQUEST_CLOSED = os.environ["PULL_REQUEST_CLOSED"]
 
     db = {}
     try:
@@ -210,15 +223,54 @@ def main():
         if e.errno != errno.ENOENT:
             raise
 
-    queue = scan_codeberg(db)
-    queue.extend(scan_github(db, len(queue)))
+    # PRs whose checks were superseded go to the front of the queue
+    requeue = []
+    try:
+        with open(PULL_REQUEST_REQUEUE) as f:
+            requeue = [l.strip() for l in f if l.strip()]
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    # PRs no longer open, with the time they were first found closed
+    closed = {}
+    try:
+        with open(PULL_REQUEST_CLOSED) as f:
+            closed = json.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    seen = set()
+    queue = scan_codeberg(db, requeue, seen)
+    queue.extend(scan_github(db, requeue, seen, len(queue)))
+
+    for db_key in list(db):
+        pr_key = f"github/{db_key}" if isinstance(db_key, int) else db_key
+        if pr_key not in seen:
+            print(f"{pr_key}: closed", file=sys.stderr)
+            del db[db_key]
+            closed.setdefault(pr_key, time.time())
+    # reopened ones
+    for pr_key in seen:
+        closed.pop(pr_key, None)
+
+    with open(PULL_REQUEST_CLOSED + ".tmp", "w") as f:
+        json.dump(closed, f)
+    os.rename(PULL_REQUEST_CLOSED + ".tmp", PULL_REQUEST_CLOSED)
 
     with open(PULL_REQUEST_DB + ".tmp", "wb") as f:
         pickle.dump(db, f)
     os.rename(PULL_REQUEST_DB + ".tmp", PULL_REQUEST_DB)
 
-    if queue:
-        print(queue[0])
+    if requeue:
+        with open(PULL_REQUEST_REQUEUE + ".tmp", "w") as f:
+            f.writelines(f"{pr_key}\n" for pr_key in requeue if pr_key in queue[1:])
+        os.rename(PULL_REQUEST_REQUEUE + ".tmp", PULL_REQUEST_REQUEUE)
+
+    # print more candidates if batching (merge train) is enabled
+    for pr_key in queue[: int(os.environ.get("PULL_REQUEST_BATCH_SIZE", "1"))]:
+        print(pr_key)
 
     return 0
 
@@ -29,7 +29,12 @@ def set_github_pr_status(commit_hash, stat, desc):
     with open(GITHUB_TOKEN_FILE) as f:
         token = f.read().strip()
 
-    g = github.Github(GITHUB_USERNAME, token, per_page=50)
+    g = github.Github(
+        GITHUB_USERNAME,
+        token,
+        per_page=50,
+        base_url=os.environ.get("GITHUB_API_URL", github.Consts.DEFAULT_BASE_URL),
+    )
     r = g.get_repo(GITHUB_REPO)
     c = r.get_commit(commit_hash)
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Watch the heads of pull requests being tested and abort the worker
+# if any of them is updated (force-pushed) in the meantime.
+#
+# usage: watch-pull-request-head.py <worker-pgid> <pr>=<sha>...
+
+import errno
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import time
+
+import github
+from codebergapi import CodebergAPI
+
+
+def github_heads(prids):
+    GITHUB_USERNAME = os.environ["GITHUB_USERNAME"]
+    GITHUB_TOKEN_FILE = os.environ["GITHUB_TOKEN_FILE"]
+    GITHUB_REPO = os.environ["GITHUB_REPO"]
+
+    with open(GITHUB_TOKEN_FILE) as f:
+        token = f.read().strip()
+
+    g = github.Github(
+        GITHUB_USERNAME,
+        token,
+        per_page=50,
+        base_url=os.environ.get("GITHUB_API_URL", github.Consts.DEFAULT_BASE_URL),
+    )
+    r = g.get_repo(GITHUB_REPO)
+    return {prid: r.get_pull(int(prid)).head.sha for prid in prids}
+
+
+def codeberg_heads(prids):
+    CODEBERG_TOKEN_FILE = os.environ["CODEBERG_TOKEN_FILE"]
+    (owner, repo) = os.environ["CODEBERG_REPO"].split("/")
+
+    with open(CODEBERG_TOKEN_FILE) as f:
+        token = f.read().strip()
+
+    with CodebergAPI(owner, repo, token) as cb:
+        return {prid: cb.pull(int(prid))["head"]["sha"] for prid in prids}
+
+
+def current_heads(prs):
+    heads = {}
+    for forge, get_heads in (("github", github_heads), ("codeberg", codeberg_heads)):
+        prids = [pr.split("/")[1] for pr in prs if pr.startswith(forge + "/")]
+        if prids:
+            for prid, sha in get_heads(prids).items():
+                heads[f"{forge}/{prid}"] = sha
+    return heads
+
+
+def signal_worker(pgid, sig):
+    """
+    Send a signal to the worker's process group.  The group belongs
+    to WORKER_USER (and root, for sudo), so signal it as WORKER_USER.
+    """
+    WORKER_USER = os.environ["WORKER_USER"]
+    subprocess.call(
+        ["sudo", "-u", WORKER_USER, "kill", f"-{sig.name[3:]}", "--", f"-{pgid}"]
+    )
+
+
+def worker_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # still there, just not ours
+        pass
+    return True
+
+
+def kill_worker(pgid):
+    signal_worker(pgid, signal.SIGTERM)
+    for i in range(30):
+        time.sleep(1)
+        if not worker_alive(pgid):
+            return
+    signal_worker(pgid, signal.SIGKILL)
+
+
+def requeue(superseded, prs):
+    """
+    Mark the PRs as unprocessed and put them at the front of the queue,
+    the superseded one first.
+    """
+    PULL_REQUEST_DB = os.environ["PULL_REQUEST_DB"]
+    PULL_REQUEST_REQUEUE = os.environ["PULL_REQUEST_REQUEUE"]
+
+    with open(PULL_REQUEST_DB, "rb") as f:
+        db = pickle.load(f)
+    for pr in prs:
+        prid = int(pr.split("/")[1])
+        db_key = prid if pr.startswith("github/") and prid in db else pr
+        db[db_key] = ""
+    with open(PULL_REQUEST_DB + ".tmp", "wb") as f:
+        pickle.dump(db, f)
+    os.rename(PULL_REQUEST_DB + ".tmp", PULL_REQUEST_DB)
+
+    queue = [superseded] + [pr for pr in prs if pr != superseded]
+    try:
+        with open(PULL_REQUEST_REQUEUE) as f:
+            queue.extend(l.strip() for l in f if l.strip() not in queue)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    with open(PULL_REQUEST_REQUEUE + ".tmp", "w") as f:
+        f.writelines(f"{pr}\n" for pr in queue if pr)
+    os.rename(PULL_REQUEST_REQUEUE + ".tmp", PULL_REQUEST_REQUEUE)
+
+
+def main(pgid, *pr_heads):
+    PULL_REQUEST_DIR = os.environ["PULL_REQUEST_DIR"]
+    interval = int(os.environ.get("PULL_REQUEST_WATCH_INTERVAL", "120"))
+
+    expected = dict(x.split("=", 1) for x in pr_heads)
+    while True:
+        time.sleep(interval)
+        try:
+            heads = current_heads(list(expected))
+        except Exception as e:
+            # the forge being flaky must not kill the check
+            print(f"head watcher: {e}", file=sys.stderr)
+            continue
+
+        for pr, sha in expected.items():
+            if heads.get(pr, sha) != sha:
+                break
+        else:
+            continue
+
+        print(f"{pr}: head moved {sha} -> {heads[pr]}, aborting", file=sys.stderr)
+        # pull-requests.bash kills us once the worker is gone, but waits
+        # for us to finish, so requeue the PRs no matter what
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            kill_worker(int(pgid))
+        except OSError as e:
+            print(f"head watcher: unable to kill the worker: {e}", file=sys.stderr)
+        # set-pull-request-status.py takes the hash from the db, so
+        # report before requeueing
+        subprocess.call(
+            [
+                os.path.join(os.path.dirname(__file__), "set-pull-request-status.py"),
+                pr,
+                "error",
+                "QA checks superseded by a newer commit",
+            ]
+        )
+        requeue(pr, list(expected))
+        with open(os.path.join(PULL_REQUEST_DIR, "superseded"), "w") as f:
+            f.write(f"{pr}\n")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Push the master branch of mirror repositories to all their push URLs
+# concurrently.
+#
+# usage: push-mirrors.py [-j JOBS] [--retries N] <repository>...
+#
+# Every (repository, push URL) pair is pushed on its own, in a bounded
+# pool, so that one slow mirror does not hold up the others.  The push
+# URLs are remote.origin.pushurl (or remote.origin.url).  Before pushing,
+# the remote being pushed to is asked for its master (and only that
+# remote is contacted); if it is already up to date, the push is skipped.
+# Failed pushes are retried with a growing delay.  Once all the URLs of
+# a repository are pushed, origin/master is updated to match, as plain
+# "git push" to origin would do.
+#
+# ssh connections are shared via a ControlMaster for the duration
+# of the run, unless GIT_SSH_COMMAND is already set.
+
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BRANCH = "master"
+# delay before the first retry, doubled for every next one (seconds)
+RETRY_DELAY = 10
+
+print_lock = threading.Lock()
+
+
+def log(msg):
+    with print_lock:
+        print(msg, file=sys.stderr, flush=True)
+
+
+def git(repo, *args, timeout=None):
+    return subprocess.run(
+        ["git", *args],
+        cwd=repo,
+        stdout=subprocess.PIPE,
+        text=True,
+        timeout=timeout,
+        check=True,
+    ).stdout
+
+
+def git_config_all(repo, key):
+    try:
+        return git(repo, "config", "--get-all", key).split()
+    except subprocess.CalledProcessError:
+        return []
+
+
+def push_urls(repo):
+    return git_config_all(repo, "remote.origin.pushurl") or git_config_all(
+        repo, "remote.origin.url"
+    )
+
+
+def ssh_destination(url):
+    """Return the ssh host of a git URL, or None if it is not ssh."""
+    if url.startswith("ssh://"):
+        return url[len("ssh://") :].split("/", 1)[0].rsplit(":", 1)[0]
+    if "://" not in url and ":" in url.split("/", 1)[0]:
+        return url.split(":", 1)[0]
+    return None
+
+
+def push_one(repo, url, retries, timeout):
+    """Push repo to url, return True on success (or if up to date)."""
+    name = os.path.basename(repo)
+    local = git(repo, "rev-parse", BRANCH).strip()
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            delay = RETRY_DELAY * 2 ** (attempt - 1)
+            log(f"{name} -> {url}: retrying in {delay}s")
+            time.sleep(delay)
+        try:
+            remote = git(
+                repo, "ls-remote", url, f"refs/heads/{BRANCH}", timeout=timeout
+            ).split()
+            if remote[:1] == [local]:
+                log(f"{name} -> {url}: up to date")
+                return True
+            start = time.monotonic()
+            git(repo, "push", "-q", url, f"{BRANCH}:{BRANCH}", timeout=timeout)
+            log(f"{name} -> {url}: pushed in {time.monotonic() - start:.1f}s")
+            return True
+        except subprocess.CalledProcessError as e:
+            log(f"{name} -> {url}: {e.cmd[1]} failed with {e.returncode}")
+        except subprocess.TimeoutExpired as e:
+            log(f"{name} -> {url}: {e.cmd[1]} timed out")
+    return False
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument(
+        "-j", "--jobs", type=int, default=4, help="concurrent pushes (default: 4)"
+    )
+    argp.add_argument(
+        "--retries", type=int, default=2, help="retries per remote (default: 2)"
+    )
+    argp.add_argument(
+        "--timeout",
+        type=float,
+        default=600,
+        help="timeout of a single git command (seconds, default: 600)",
+    )
+    argp.add_argument("repos", nargs="*", help="repositories to push")
+    args = argp.parse_args()
+
+    pairs = [(repo, url) for repo in args.repos for url in push_urls(repo)]
+    if not pairs:
+        return 0
+
+    control_dir = None
+    if "GIT_SSH_COMMAND" not in os.environ:
+        control_dir = tempfile.mkdtemp(prefix="push-mirrors.")
+        os.environ["GIT_SSH_COMMAND"] = shlex.join(
+            [
+                "ssh",
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={control_dir}/%C",
+                "-o",
+                "ControlPersist=60",
+            ]
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(
+                pool.map(
+                    lambda pair: push_one(*pair, args.retries, args.timeout), pairs
+                )
+            )
+    finally:
+        if control_dir is not None:
+            for host in {ssh_destination(url) for repo, url in pairs} - {None}:
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={control_dir}/%C", "-O", "exit", host],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+    failed = []
+    for repo in args.repos:
+        ok = [res for (r, url), res in zip(pairs, results) if r == repo]
+        if all(ok):
+            git(repo, "update-ref", f"refs/remotes/origin/{BRANCH}", BRANCH)
+        else:
+            failed.append(os.path.basename(repo))
+    if failed:
+        log(f"pushing failed for: {' '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# Keep ebuilds that are known to fail metadata regeneration out of
+# pmaint regen, as long as neither they nor the eclasses they inherit
+# change.
+#
+# usage: regen-quarantine.py hide <ledger> <repos-dir> <repo>
+#        regen-quarantine.py restore <ledger> <repos-dir> <repo>
+#        regen-quarantine.py update <ledger> <repos-dir> <repo>
+#
+# The ledger is a JSON file listing, per repository, the ebuilds that
+# failed regen (got no up-to-date md5-cache entry) along with the hash of the ebuild
+# and the hashes of all eclasses it inherits (directly or indirectly),
+# as found at the time of the failure.  It is meant to be read by other
+# tools too (utils/file-bugs.py --regen-ledger).
+#
+# "hide" renames the ebuilds whose entry still matches (and is younger
+# than REGEN_QUARANTINE_TTL) to *.ebuild.quarantined, so that regen does
+# not source them again; "restore" renames them back (it is safe to run
+# more than once, e.g. from a trap).  "update" restores the hidden
+# ebuilds, records the new failures and drops the entries of ebuilds
+# that got an up-to-date cache entry or were removed.
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+
+HIDDEN_SUFFIX = ".quarantined"
+# top-level directories that are not categories
+NON_CATEGORIES = {"eclass", "licenses", "metadata", "profiles"}
+INHERIT_RE = re.compile(r"^\s*(?:.*&&\s*)?inherit\s+([^;&|#\n]*)", re.M)
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_ttl(value):
+    value = value.strip()
+    if value[-1:] in UNITS:
+        return float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def file_hash(path, algo=hashlib.sha256):
+    with open(path, "rb") as f:
+        return algo(f.read()).hexdigest()
+
+
+def load_ledger(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"repos": {}}
+
+
+def save_ledger(path, ledger):
+    with open(path + ".tmp", "w") as f:
+        json.dump(ledger, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.rename(path + ".tmp", path)
+
+
+class Repo:
+    def __init__(self, repos_dir, name):
+        self.name = name
+        self.path = os.path.join(repos_dir, name)
+        masters = []
+        try:
+            with open(os.path.join(self.path, "metadata/layout.conf")) as f:
+                for l in f:
+                    key, sep, value = l.partition("=")
+                    if sep and key.strip() == "masters":
+                        masters = value.split()
+        except FileNotFoundError:
+            pass
+        # the repository's own eclasses override the masters' ones
+        self.eclass_dirs = [os.path.join(self.path, "eclass")] + [
+            os.path.join(repos_dir, m, "eclass") for m in reversed(masters)
+        ]
+        self.eclass_cache = {}
+        self.eclass_md5s = {}
+
+    def ebuilds(self, suffix=".ebuild"):
+        """Yield (cpv, path) of all the ebuilds in the repository."""
+        for cat in os.scandir(self.path):
+            if (
+                not cat.is_dir()
+                or cat.name.startswith(".")
+                or cat.name in NON_CATEGORIES
+            ):
+                continue
+            for pkg in os.scandir(cat.path):
+                if not pkg.is_dir():
+                    continue
+                for f in os.scandir(pkg.path):
+                    if f.name.endswith(suffix):
+                        yield f"{cat.name}/{f.name[:-len(suffix)]}", f.path
+
+    def has_cache(self, cpv, path):
+        """
+        Check whether the ebuild has an up-to-date md5-cache entry, i.e.
+        one matching the ebuild and the eclasses it inherited.
+        """
+        try:
+            with open(os.path.join(self.path, "metadata/md5-cache", cpv)) as f:
+                entry = dict(l.rstrip("\n").split("=", 1) for l in f if "=" in l)
+        except FileNotFoundError:
+            return False
+        if entry.get("_md5_") != file_hash(path, hashlib.md5):
+            return False
+        eclasses = entry.get("_eclasses_", "").split()
+        return all(
+            self.eclass_md5(name) == digest
+            for name, digest in zip(eclasses[::2], eclasses[1::2])
+        )
+
+    def eclass_md5(self, name):
+        if name not in self.eclass_md5s:
+            for d in self.eclass_dirs:
+                path = os.path.join(d, f"{name}.eclass")
+                if os.path.exists(path):
+                    self.eclass_md5s[name] = file_hash(path, hashlib.md5)
+                    break
+            else:
+                self.eclass_md5s[name] = None
+        return self.eclass_md5s[name]
+
+    def eclass(self, name):
+        """Return (hash or None if missing, inherited eclasses) of an eclass."""
+        if name not in self.eclass_cache:
+            for d in self.eclass_dirs:
+                path = os.path.join(d, f"{name}.eclass")
+                if os.path.exists(path):
+                    self.eclass_cache[name] = (file_hash(path), inherits(path))
+                    break
+            else:
+                self.eclass_cache[name] = (None, [])
+        return self.eclass_cache[name]
+
+    def inputs(self, path):
+        """Return the hashes of the ebuild and all the eclasses it inherits."""
+        eclasses = {}
+        todo = inherits(path)
+        while todo:
+            name = todo.pop()
+            if name in eclasses:
+                continue
+            digest, more = self.eclass(name)
+            eclasses[name] = digest
+            todo.extend(more)
+        return {"ebuild": file_hash(path), "eclasses": eclasses}
+
+
+def inherits(path):
+    with open(path, errors="replace") as f:
+        text = f.read().replace("\\\n", " ")
+    return [
+        e for m in INHERIT_RE.finditer(text) for e in m.group(1).split() if "$" not in e
+    ]
+
+
+def hide(ledger, repo, ttl):
+    entries = ledger["repos"].get(repo.name, {})
+    cutoff = now() - datetime.timedelta(seconds=ttl)
+    hidden = 0
+    for cpv, path in repo.ebuilds():
+        entry = entries.get(cpv)
+        if entry is None:
+            continue
+        if datetime.datetime.fromisoformat(entry["checked"]) < cutoff:
+            continue
+        # any change in the inputs invalidates the entry
+        inputs = repo.inputs(path)
+        if any(inputs[k] != entry[k] for k in ("ebuild", "eclasses")):
+            continue
+        os.rename(path, path + HIDDEN_SUFFIX)
+        hidden += 1
+    print(f"{repo.name}: {hidden} ebuilds kept out of regen", file=sys.stderr)
+
+
+def restore(repo):
+    """Restore the hidden ebuilds, return their cpvs."""
+    restored = set()
+    for cpv, path in repo.ebuilds(".ebuild" + HIDDEN_SUFFIX):
+        os.rename(path, path[: -len(HIDDEN_SUFFIX)])
+        restored.add(cpv)
+    return restored
+
+
+def update(ledger, repo):
+    hidden = restore(repo)
+    old = ledger["repos"].get(repo.name, {})
+    entries = {}
+    stamp = now().isoformat(timespec="seconds")
+    new = 0
+    for cpv, path in repo.ebuilds():
+        if cpv in hidden and cpv in old:
+            # not retried, keep as is
+            entries[cpv] = old[cpv]
+        elif not repo.has_cache(cpv, path):
+            entry = repo.inputs(path)
+            entry["checked"] = stamp
+            entry["since"] = old.get(cpv, {}).get("since", stamp)
+            entries[cpv] = entry
+            new += cpv not in old
+    if entries:
+        ledger["repos"][repo.name] = entries
+    else:
+        ledger["repos"].pop(repo.name, None)
+    print(
+        f"{repo.name}: {len(entries)} ebuilds failing regen ({new} new)",
+        file=sys.stderr,
+    )
+
+
+def main(command, ledger_path, repos_dir, name):
+    repo = Repo(repos_dir, name)
+    if command == "restore":
+        restore(repo)
+        return 0
+
+    ledger = load_ledger(ledger_path)
+    if command == "hide":
+        hide(ledger, repo, parse_ttl(os.environ.get("REGEN_QUARANTINE_TTL", "7d")))
+    elif command == "update":
+        update(ledger, repo)
+        save_ledger(ledger_path, ledger)
+    else:
+        print(f"unknown command: {command}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
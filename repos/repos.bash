@@ -3,6 +3,8 @@
 set -e -x
 ulimit -t 800
 
+. "${SCRIPT_DIR}"/tracing/tracing.bash
+
 # SANITY!
 export TZ=UTC
 
@@ -223,7 +225,8 @@ create_pmaint_setpriv_wrapper
 for r in ${REPOS}; do
 	name=${r%%:*}
 
-	${DATA_DIR}/pmaint-sync-wrapper \
+	trace_span sync repo="${name}" -- \
+		${DATA_DIR}/pmaint-sync-wrapper \
 		"${CONFIG_ROOT_SYNC}/etc/portage" \
 		"${SYNC_DIR}" \
 		"${SYNC_DIR}/${name}" \
@@ -238,7 +241,7 @@ for r in ${SIGNED_REPOS}; do
 done
 
 # rsync repos to main dir
-rsync --recursive --links --times --delete \
+trace_span rsync -- rsync --recursive --links --times --delete \
 	'--exclude=.*/' \
 	'--exclude=*/metadata/md5-cache' \
 	'--exclude=*/profiles/use.local.desc' \
@@ -256,30 +259,69 @@ setfacl -d -R -m u:${USER}:rwx "${REPOS_DIR}" ||:
 # entries.
 setfacl -d -R -m g:${USER}:rwx "${REPOS_DIR}" ||:
 
+# restore the ebuilds kept out of regen and push the mirrors prepared
+# so far, also if we fail or time out half-way
+push_repos=()
+quarantined=
+pushed=
+finish() {
+	if [[ -n ${quarantined} ]]; then
+		"${SCRIPT_DIR}"/repos/regen-quarantine.py restore \
+			"${REGEN_QUARANTINE_LEDGER}" "${REPOS_DIR}" "${quarantined}" || :
+		quarantined=
+	fi
+
+	# push to all the mirrors concurrently, skipping the up-to-date ones
+	if [[ -z ${pushed} && ${#push_repos[@]} -gt 0 ]]; then
+		pushed=1
+		trace_span push repos="${#push_repos[@]}" -- \
+			"${SCRIPT_DIR}"/repos/push-mirrors.py -j "${MIRROR_PUSH_JOBS}" \
+			"${push_repos[@]}"
+	fi
+}
+trap finish EXIT
+
 # prepare mirrors
 for r in ${REPOS}; do
 	name=${r%%:*}
 
+	# keep the ebuilds known to fail regen out of it, as long as they
+	# and their eclasses are unchanged
+	if [[ -n ${REGEN_QUARANTINE_LEDGER} ]]; then
+		quarantined=${name}
+		"${SCRIPT_DIR}"/repos/regen-quarantine.py hide \
+			"${REGEN_QUARANTINE_LEDGER}" "${REPOS_DIR}" "${name}"
+	fi
+
 	# regen caches
-	sudo -u "${WORKER_USER}" \
+	trace_span regen repo="${name}" -- sudo -u "${WORKER_USER}" \
 		bwrap --bind / / --dev /dev --proc /proc --unshare-all \
 		--uid $(id -u "${WORKER_USER}") --gid $(id -g "${WORKER_USER}") \
 		${DATA_DIR}/pmaint-wrapper \
 		"${CONFIG_ROOT}/etc/portage" "${REPOS_DIR}" "${REPOS_DIR}/${name}" \
 		pmaint --config "${CONFIG_ROOT}/etc/portage" regen \
-		--use-local-desc --pkg-desc-index -t "$(nproc)" "${name}"
+		--use-local-desc --pkg-desc-index -t "${CI_THREADS:-$(nproc)}" "${name}"
+
+	# restore them and record the new failures
+	if [[ -n ${REGEN_QUARANTINE_LEDGER} ]]; then
+		"${SCRIPT_DIR}"/repos/regen-quarantine.py update \
+			"${REGEN_QUARANTINE_LEDGER}" "${REPOS_DIR}" "${name}"
+		quarantined=
+	fi
 
 	if [[ ! -e ${MIRROR_DIR}/${name} ]]; then
 		git clone "git@github.com:gentoo-mirror/${name}" \
 			"${MIRROR_DIR}/${name}"
 	fi
 
-	"${SCRIPT_DIR}"/repos/smart-merge.bash "${SYNC_DIR}/${name}" \
+	trace_span smart-merge repo="${name}" -- \
+		"${SCRIPT_DIR}"/repos/smart-merge.bash "${SYNC_DIR}/${name}" \
 		"${MIRROR_DIR}/${name}" master
 
 	# Calls bash hooks that may need network access
 	# e.g. gentoo needs glsa, news
-	"${SCRIPT_DIR}/repos/repo-postmerge/${name}" "${MIRROR_DIR}/${name}"
+	trace_span postmerge repo="${name}" -- \
+		"${SCRIPT_DIR}/repos/repo-postmerge/${name}" "${MIRROR_DIR}/${name}"
 
 	# Verification step to make sure smart-merge didn't go wrong
 	# TODO: Is this really needed anymore?
@@ -301,11 +343,14 @@ for r in ${REPOS}; do
 			git add -f metadata/timestamp.chk
 			git commit --quiet -m "$(date -u '+%F %T UTC')"
 		fi
-		out=$(git rev-list origin/master..master)
-		ret=$?
-		if [[ -n "${out}" || "${ret}" -ne 0 ]]; then
-			git fetch --all
-			git push
-		fi
 	)
+
+	# repos with new commits are pushed all at once at the end
+	if ! out=$(cd "${MIRROR_DIR}/${name}" && git rev-list origin/master..master) ||
+			[[ -n ${out} ]]; then
+		push_repos+=( "${MIRROR_DIR}/${name}" )
+	fi
 done
+
+finish
+trap - EXIT
@@ -0,0 +1,72 @@
+#!/bin/bash
+# Merge an upstream repository into a subdirectory of the current
+# repository, alike 'git subtree add/pull' but without walking
+# the history to find the previous merge.
+#
+# usage: subtree-sync.bash <url> <prefix> [<branch>]
+#
+# The upstream commit and tree merged last are cached in
+# .git/subtree-sync/, and the upstream is only fetched if ls-remote
+# reports a different commit.  The prefix is replaced with the upstream
+# tree as a whole, so local changes to it are not preserved.
+set -e -x
+
+url=${1}
+prefix=${2%/}
+branch=${3:-master}
+
+[[ ${url} && ${prefix} ]]
+
+cache_dir=$(git rev-parse --git-dir)/subtree-sync
+cache=${cache_dir}/${prefix//\//_}
+mkdir -p -- "${cache_dir}"
+
+read -r cached_commit cached_tree < "${cache}" || :
+current_tree=$(git rev-parse -q --verify "HEAD:${prefix}") || :
+
+remote=$(git ls-remote -- "${url}" "refs/heads/${branch}")
+remote=${remote%%[[:space:]]*}
+[[ ${remote} ]]
+
+if [[ ${remote} == ${cached_commit} && ${current_tree} == ${cached_tree} ]]; then
+	# nothing changed upstream and the merged tree is still there
+	exit 0
+fi
+
+if ! git cat-file -e "${remote}^{commit}" 2>/dev/null; then
+	git fetch -q --no-tags -- "${url}" "refs/heads/${branch}"
+fi
+upstream_tree=$(git rev-parse "${remote}^{tree}")
+
+if [[ ${current_tree} != ${upstream_tree} ]]; then
+	old=$(git rev-parse HEAD)
+	index=${cache_dir}/index
+	rm -f -- "${index}"
+
+	# replace the prefix with the upstream tree in a temporary index
+	GIT_INDEX_FILE=${index} git read-tree "${old}"
+	GIT_INDEX_FILE=${index} git rm -r -q --cached --ignore-unmatch -- "${prefix}"
+	GIT_INDEX_FILE=${index} git read-tree --prefix="${prefix}/" "${remote}"
+	tree=$(GIT_INDEX_FILE=${index} git write-tree)
+	rm -f -- "${index}"
+
+	if [[ -n ${current_tree} ]]; then
+		msg="Merge commit '${remote}'"
+	else
+		msg="Add '${prefix}/' from commit '${remote}'"
+	fi
+	sign=
+	if [[ $(git config --bool commit.gpgsign || :) == true ]]; then
+		sign=-S
+	fi
+	new=$(git commit-tree ${sign} "${tree}" -p "${old}" -p "${remote}" -m "${msg}")
+
+	# update the working tree first, so that we do not move HEAD
+	# if it fails
+	git read-tree -m -u "${old}" "${new}"
+	git update-ref -m "subtree-sync: ${prefix}" HEAD "${new}" "${old}"
+	current_tree=${upstream_tree}
+fi
+
+echo "${remote} ${current_tree}" > "${cache}.tmp"
+mv -- "${cache}.tmp" "${cache}"
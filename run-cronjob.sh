@@ -1,6 +1,8 @@
 #!/bin/bash
 
 . "$(dirname "${0}")"/repo-mirror-ci.conf
+. "${SCRIPT_DIR}"/notify/notify.bash
+. "${SCRIPT_DIR}"/tracing/tracing.bash
 
 script=${1}
 basename=${1##*/}
@@ -13,7 +15,8 @@ exec &> "${CRONJOB_STATE_DIR}/${basename}.log"
 
 start=$(date -u "+%Y-%m-%dT%H:%M:%SZ")
 echo "Start: ${start}"
-bash "${script}"
+export TRACE_ID=${basename}-${start}
+trace_span "${basename}" -- bash "${script}"
 ret=${?}
 stop=$(date -u "+%Y-%m-%dT%H:%M:%SZ")
 echo "Stop: ${stop} (exited with ${ret})"
@@ -28,7 +31,7 @@ if [[ ${ret} -ne 0 ]]; then
 	cp -- "${CRONJOB_STATE_DIR}/${basename}.log" \
 	       "${CRONJOB_STATE_DIR}/${basename}.log.${start}"
 
-	sendmail "${CRONJOB_ADMIN_MAIL}" <<-EOF
+	notify_mail "${CRONJOB_ADMIN_MAIL}" <<-EOF
 		Subject: ${basename} cronjob failure
 		To: <${CRONJOB_ADMIN_MAIL}>
 		Content-Type: text/plain; charset=utf8
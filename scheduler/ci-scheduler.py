@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# Run the cronjobs as soon as the resources they need are available,
+# instead of starting them from cron at fixed times.
+#
+# usage: ci-scheduler.py [<jobs.ini>]
+#
+# Meant to be run as a service, as the same user as the cronjobs, with
+# repo-mirror-ci.conf sourced.  Jobs are described in scheduler/jobs.ini
+# (see the comments there): their interval, priority, thread budget,
+# the trees they use (exclusively or shared) and whether they need
+# the network.  Every job is started via run-cronjob.sh, so logs, times
+# and failure mails stay the same, with its thread budget in CI_THREADS.
+#
+# The last start of every job is taken from its .times file, so that
+# restarting the scheduler does not rerun everything.  SIGHUP reloads
+# the jobs; SIGTERM stops starting new jobs and exits once the running
+# ones are finished (a second SIGTERM exits immediately).
+
+import configparser
+import os
+import select
+import signal
+import sys
+import time
+from datetime import datetime, timezone
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_interval(value):
+    value = value.strip()
+    if value[-1:] in UNITS:
+        return float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
+
+
+def parse_threads(value, total):
+    """Parse N, N%, all or MIN-MAX of these into (min, max)."""
+
+    def one(v):
+        v = v.strip()
+        if v == "all":
+            return total
+        if v.endswith("%"):
+            return max(1, total * int(v[:-1]) // 100)
+        return min(total, int(v))
+
+    lo, sep, hi = value.partition("-")
+    lo = one(lo)
+    hi = one(hi) if sep else lo
+    if lo > hi:
+        raise ValueError(f"invalid thread range: {value}")
+    return lo, hi
+
+
+def trees_conflict(a, b):
+    """Whether trees a and b overlap (one contains the other)."""
+    return a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+
+class Job:
+    def __init__(self, name, section, total_threads, script_dir):
+        self.name = name
+        self.script = os.path.join(script_dir, section["script"])
+        self.interval = parse_interval(section.get("interval", "1h"))
+        self.priority = section.getint("priority", 0)
+        self.min_threads, self.max_threads = parse_threads(
+            section.get("threads", "1"), total_threads
+        )
+        self.exclusive = section.get("exclusive", "").split()
+        self.shared = section.get("shared", "").split()
+        self.network = section.getboolean("network", False)
+        max_wait = section.get("max_wait")
+        self.max_wait = parse_interval(max_wait) if max_wait else None
+        self.last_start = 0
+        self.last_finish = 0
+        # pid and thread budget while running
+        self.pid = None
+        self.threads = 0
+
+    @property
+    def basename(self):
+        return os.path.splitext(os.path.basename(self.script))[0]
+
+    def due_since(self):
+        return max(self.last_start + self.interval, self.last_finish)
+
+    def due(self, now):
+        return self.pid is None and now >= self.due_since()
+
+    def starving(self, now):
+        return self.max_wait is not None and now - self.due_since() >= self.max_wait
+
+
+class Scheduler:
+    def __init__(self, path):
+        self.path = path
+        self.script_dir = os.environ["SCRIPT_DIR"]
+        self.state_dir = os.path.expanduser(
+            os.environ.get("CRONJOB_STATE_DIR", "~")
+        )
+        self.jobs = {}
+        self.load()
+
+    def load(self):
+        config = configparser.ConfigParser(interpolation=None)
+        with open(self.path) as f:
+            config.read_file(f)
+        sched = config["scheduler"] if config.has_section("scheduler") else {}
+        threads = sched.get("threads", "all")
+        cpus = os.cpu_count() or 1
+        self.total_threads = cpus if threads == "all" else int(threads)
+        self.network_slots = int(sched.get("network", "1"))
+        self.poll = float(sched.get("poll", "10"))
+
+        jobs = {}
+        for name in config.sections():
+            if name == "scheduler":
+                continue
+            job = Job(name, config[name], self.total_threads, self.script_dir)
+            old = self.jobs.get(name)
+            if old is not None:
+                # keep the state of the running job
+                job.last_start, job.last_finish = old.last_start, old.last_finish
+                job.pid, job.threads = old.pid, old.threads
+            else:
+                job.last_start = self.last_start(job)
+            jobs[name] = job
+        # removed jobs that are still running are kept until they finish
+        for name, old in self.jobs.items():
+            if name not in jobs and old.pid is not None:
+                old.interval = float("inf")
+                jobs[name] = old
+        self.jobs = jobs
+
+    def last_start(self, job):
+        """Read the last start time from the job's .times file."""
+        try:
+            with open(os.path.join(self.state_dir, f"{job.basename}.times")) as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return 0
+        for l in reversed(lines):
+            if l.strip():
+                start = datetime.strptime(l.split()[0], "%Y-%m-%dT%H:%M:%SZ")
+                return start.replace(tzinfo=timezone.utc).timestamp()
+        return 0
+
+    def running(self):
+        return [j for j in self.jobs.values() if j.pid is not None]
+
+    def log(self, msg):
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {msg}", flush=True)
+
+    def start(self, job, threads):
+        env = dict(os.environ, CI_THREADS=str(threads))
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setsid()
+                run_cronjob = os.path.join(self.script_dir, "run-cronjob.sh")
+                os.execve("/bin/bash", ["bash", run_cronjob, job.script], env)
+            finally:
+                os._exit(127)
+        job.pid = pid
+        job.threads = threads
+        job.last_start = time.time()
+        self.log(f"{job.name}: started (pid {pid}, {threads} threads)")
+
+    def reap(self):
+        while True:
+            try:
+                pid, wstatus = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for job in self.jobs.values():
+                if job.pid == pid:
+                    job.pid = None
+                    job.threads = 0
+                    job.last_finish = time.time()
+                    status = os.waitstatus_to_exitcode(wstatus)
+                    self.log(f"{job.name}: finished (exited with {status})")
+
+    def schedule(self):
+        now = time.time()
+        running = self.running()
+        free_threads = self.total_threads - sum(j.threads for j in running)
+        free_network = self.network_slots - sum(1 for j in running if j.network)
+        held_exclusive = [t for j in running for t in j.exclusive]
+        held_shared = [t for j in running for t in j.shared]
+
+        # threads and trees kept for due jobs of higher priority
+        reserved_threads = 0
+        reserved_exclusive = []
+        reserved_shared = []
+
+        # jobs waiting for too long go first, then by priority
+        due = sorted(
+            (j for j in self.jobs.values() if j.due(now)),
+            key=lambda j: (not j.starving(now), j.priority, j.due_since()),
+        )
+        for job in due:
+            blocked_for_exclusive = held_exclusive + held_shared
+            blocked_for_exclusive += reserved_exclusive + reserved_shared
+            blocked_for_shared = held_exclusive + reserved_exclusive
+            trees_free = not any(
+                trees_conflict(t, b)
+                for t in job.exclusive
+                for b in blocked_for_exclusive
+            ) and not any(
+                trees_conflict(t, b) for t in job.shared for b in blocked_for_shared
+            )
+            if not (
+                trees_free
+                and free_threads - reserved_threads >= job.min_threads
+                and (not job.network or free_network > 0)
+            ):
+                # (the jobs holding its trees free their threads too)
+                if trees_free:
+                    reserved_threads += job.min_threads
+                reserved_exclusive += job.exclusive
+                reserved_shared += job.shared
+                continue
+
+            # leave the minimum to the other jobs that could run alongside
+            others = sum(
+                j.min_threads
+                for j in self.jobs.values()
+                if j is not job and j.pid is None and not self.conflict(job, j)
+            )
+            threads = max(
+                job.min_threads,
+                min(job.max_threads, free_threads - reserved_threads - others),
+            )
+            self.start(job, threads)
+            free_threads -= threads
+            if job.network:
+                free_network -= 1
+            held_exclusive += job.exclusive
+            held_shared += job.shared
+
+    @staticmethod
+    def conflict(a, b):
+        """Whether jobs a and b cannot run at the same time."""
+        return any(
+            trees_conflict(x, y)
+            for x in a.exclusive
+            for y in b.exclusive + b.shared
+        ) or any(trees_conflict(x, y) for x in a.shared for y in b.exclusive)
+
+    def next_due(self):
+        """Return seconds until the next job is due."""
+        now = time.time()
+        waits = [
+            j.due_since() - now
+            for j in self.jobs.values()
+            if j.pid is None
+        ]
+        return max(0, min(waits, default=self.poll))
+
+
+def main(path=None):
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.ini")
+    sched = Scheduler(path)
+    stopping = False
+    reload = False
+
+    def terminate(signum, frame):
+        nonlocal stopping
+        if stopping:
+            sys.exit(0)
+        stopping = True
+
+    def hangup(signum, frame):
+        nonlocal reload
+        reload = True
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, hangup)
+    # wake up when a job finishes or on other signals
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+
+    sched.log(
+        f"scheduling {', '.join(sorted(sched.jobs))} "
+        f"with {sched.total_threads} threads"
+    )
+    while True:
+        sched.reap()
+        if reload:
+            reload = False
+            try:
+                sched.load()
+                sched.log("reloaded jobs")
+            except (OSError, ValueError, KeyError, configparser.Error) as e:
+                sched.log(f"reloading jobs failed, keeping the old ones: {e!r}")
+        if stopping:
+            if not sched.running():
+                return 0
+        else:
+            sched.schedule()
+        select.select([wakeup_r], [], [], min(sched.poll, sched.next_due() + 1))
+        try:
+            os.read(wakeup_r, 4096)
+        except BlockingIOError:
+            pass
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,42 @@
+# Helpers for recording pipeline stages via tracing/tracing.py.
+# vim:se ft=bash :
+#
+# Spans are only recorded if TRACE_FILE is set.
+
+# trace_span <name> [<key>=<value>...] -- <command>...
+# run the command (or shell function) as a span and return its exit status
+#
+# When tracing, shell functions run in a subshell, so that set -e keeps
+# applying inside them; they cannot change the caller's variables or exec.
+trace_span() {
+	local name=${1} attrs=() id start ret=0
+	shift
+	while [[ ${#} -gt 0 && ${1} != -- ]]; do
+		attrs+=( "${1}" )
+		shift
+	done
+	shift
+
+	if [[ -z ${TRACE_FILE} ]]; then
+		"${@}"
+		return
+	fi
+
+	id=$(printf '%04x' "${RANDOM}" "${RANDOM}" "${RANDOM}" "${RANDOM}")
+	if ! declare -F "${1}" >/dev/null; then
+		# external command, tracing.py gets its resource usage
+		python3 "${SCRIPT_DIR}"/tracing/tracing.py exec --id "${id}" \
+			"${name}" "${attrs[@]}" -- "${@}"
+		return
+	fi
+
+	# shell function, time it here (run asynchronously, as set -e would
+	# be ignored within it in a || list, even in a subshell)
+	start=${EPOCHREALTIME}
+	TRACE_PARENT=${id} "${@}" <&0 &
+	wait "${!}" || ret=${?}
+	python3 "${SCRIPT_DIR}"/tracing/tracing.py record --id "${id}" \
+		--start "${start}" --end "${EPOCHREALTIME}" --status "${ret}" \
+		"${name}" "${attrs[@]}" || :
+	return "${ret}"
+}
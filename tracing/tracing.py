@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# Record nested pipeline stages (spans) into a JSONL trace file,
+# and report on them.
+#
+# usage: tracing.py exec [--id ID] <name> [<key>=<value>...] -- <command>...
+#        tracing.py record --id ID --start T --end T --status N <name> [<k>=<v>...]
+#        tracing.py report [--days N] [--slowest N] [--stage NAME] [<file>...]
+#
+# The trace file is taken from TRACE_FILE; if it is unset, nothing
+# is recorded.  The sandboxed PR worker writes to its own file, which
+# can be passed to report together with the main one.  Spans started
+# from within another span have its id in TRACE_PARENT.  Failing
+# to write a span never fails the traced command.
+#
+# From Python, use:
+#
+#   with tracing.span("stage", repo="gentoo") as s:
+#       ...
+#       s["attrs"]["foo"] = "bar"
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import resource
+import secrets
+import signal
+import sys
+import time
+
+
+def new_id():
+    return secrets.token_hex(8)
+
+
+def write_span(record):
+    """Append a span to TRACE_FILE, ignoring all errors."""
+    path = os.environ.get("TRACE_FILE")
+    if not path:
+        return
+    try:
+        line = json.dumps(record, sort_keys=True) + "\n"
+        # a single O_APPEND write, so concurrent writers do not interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"tracing: unable to record span: {e}", file=sys.stderr)
+
+
+def make_span(name, attrs, span_id=None):
+    return {
+        "trace": os.environ.get("TRACE_ID"),
+        "span": span_id or new_id(),
+        "parent": os.environ.get("TRACE_PARENT") or None,
+        "name": name,
+        "attrs": attrs,
+        "start": time.time(),
+    }
+
+
+def finish_span(record, status, rusage=None):
+    record["end"] = time.time()
+    record["duration"] = record["end"] - record["start"]
+    record["status"] = status
+    if rusage is not None:
+        record["utime"] = rusage.ru_utime
+        record["stime"] = rusage.ru_stime
+        record["maxrss_kb"] = rusage.ru_maxrss
+        # block counts are in 512-byte units
+        record["read_bytes"] = rusage.ru_inblock * 512
+        record["write_bytes"] = rusage.ru_oublock * 512
+    write_span(record)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Trace the enclosed block as a span, nested in the current one."""
+    record = make_span(name, attrs)
+    old_parent = os.environ.get("TRACE_PARENT")
+    os.environ["TRACE_PARENT"] = record["span"]
+    status = 0
+    try:
+        yield record
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        if old_parent is None:
+            del os.environ["TRACE_PARENT"]
+        else:
+            os.environ["TRACE_PARENT"] = old_parent
+        # (peak RSS of this process so far)
+        record["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        finish_span(record, status)
+
+
+def parse_attrs(args):
+    attrs = {}
+    for a in args:
+        key, sep, value = a.partition("=")
+        if not sep:
+            raise ValueError(f"invalid attribute (expected key=value): {a}")
+        attrs[key] = value
+    return attrs
+
+
+def cmd_exec(args):
+    name, *rest = args.args
+    if "--" not in rest:
+        print("tracing: missing -- before the command", file=sys.stderr)
+        return 127
+    split = rest.index("--")
+    attrs = parse_attrs(rest[:split])
+    cmd = rest[split + 1 :]
+
+    record = make_span(name, attrs, args.id)
+    pid = os.fork()
+    if pid == 0:
+        os.environ["TRACE_PARENT"] = record["span"]
+        try:
+            os.execvp(cmd[0], cmd)
+        except OSError as e:
+            print(f"tracing: {cmd[0]}: {e}", file=sys.stderr)
+            os._exit(127)
+
+    # let the child handle (or die of) the signals
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: os.kill(pid, signum))
+    while True:
+        try:
+            _, wstatus, rusage = os.wait4(pid, 0)
+            break
+        except InterruptedError:
+            pass
+    status = os.waitstatus_to_exitcode(wstatus)
+    if status < 0:
+        status = 128 - status
+    finish_span(record, status, rusage)
+    return status
+
+
+def cmd_record(args):
+    name, *rest = args.args
+    record = make_span(name, parse_attrs(rest), args.id)
+    record["start"] = args.start
+    record["end"] = args.end
+    record["duration"] = args.end - args.start
+    record["status"] = args.status
+    write_span(record)
+    return 0
+
+
+def load_spans(path, since):
+    spans = []
+    with open(path) as f:
+        for l in f:
+            try:
+                s = json.loads(l)
+            except ValueError:
+                # partially written line
+                continue
+            if s.get("start", 0) >= since and "duration" in s:
+                spans.append(s)
+    return spans
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    k = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(k)]
+
+
+def fmt_time(t):
+    dt = datetime.datetime.fromtimestamp(t, datetime.UTC)
+    return dt.strftime("%Y-%m-%d %H:%M")
+
+
+def fmt_attrs(attrs):
+    return " ".join(f"{k}={v}" for k, v in sorted(attrs.items()))
+
+
+def cmd_report(args):
+    paths = args.files or [os.environ.get("TRACE_FILE")]
+    if not all(paths):
+        print("TRACE_FILE not set", file=sys.stderr)
+        return 1
+    since = time.time() - args.days * 86400
+    spans = []
+    for path in paths:
+        spans.extend(load_spans(path, since))
+    if args.stage:
+        spans = [s for s in spans if s["name"] == args.stage]
+
+    stages = {}
+    for s in spans:
+        stages.setdefault(s["name"], []).append(s)
+
+    print(f"== Stages (last {args.days} days) ==")
+    print(
+        f"{'stage':24} {'runs':>5} {'fail':>4} {'p50':>8} {'p90':>8} "
+        f"{'p99':>8} {'max':>8} {'total':>9} {'maxrss':>8}"
+    )
+    for name, ss in sorted(
+        stages.items(), key=lambda kv: -sum(s["duration"] for s in kv[1])
+    ):
+        d = sorted(s["duration"] for s in ss)
+        rss = max((s.get("maxrss_kb", 0) for s in ss), default=0)
+        fails = sum(1 for s in ss if s.get("status"))
+        print(
+            f"{name:24} {len(d):5} {fails:4} {percentile(d, 50):8.1f} "
+            f"{percentile(d, 90):8.1f} {percentile(d, 99):8.1f} {d[-1]:8.1f} "
+            f"{sum(d):9.0f} {rss // 1024:6}MB"
+        )
+
+    if args.stage:
+        print()
+        print(f"== {args.stage} by day ==")
+        by_day = {}
+        for s in spans:
+            by_day.setdefault(fmt_time(s["start"])[:10], []).append(s["duration"])
+        for day, d in sorted(by_day.items()):
+            d.sort()
+            print(f"{day} {len(d):5} {percentile(d, 50):8.1f} {d[-1]:8.1f}")
+
+    print()
+    print(f"== {args.slowest} slowest runs ==")
+    for s in sorted(spans, key=lambda s: -s["duration"])[: args.slowest]:
+        print(
+            f"{s['duration']:8.1f} {fmt_time(s['start'])} {s['name']:24} "
+            f"[{s.get('status')}] {fmt_attrs(s.get('attrs', {}))}"
+        )
+    return 0
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    subp = argp.add_subparsers(dest="command", required=True)
+
+    p = subp.add_parser("exec", help="run a command as a span")
+    p.add_argument("--id", help="span id (generated if not specified)")
+    p.add_argument("args", nargs=argparse.REMAINDER)
+
+    p = subp.add_parser("record", help="record a finished span")
+    p.add_argument("--id", required=True)
+    p.add_argument("--start", type=float, required=True)
+    p.add_argument("--end", type=float, required=True)
+    p.add_argument("--status", type=int, required=True)
+    p.add_argument("args", nargs=argparse.REMAINDER)
+
+    p = subp.add_parser("report", help="print statistics")
+    p.add_argument("--days", type=int, default=30, help="time range (days)")
+    p.add_argument("--slowest", type=int, default=20, help="slowest runs to list")
+    p.add_argument("--stage", help="limit to one stage, with a per-day summary")
+    p.add_argument("files", nargs="*", help="trace files (default: TRACE_FILE)")
+
+    args = argp.parse_args()
+    if args.command == "exec":
+        return cmd_exec(args)
+    elif args.command == "record":
+        return cmd_record(args)
+    return cmd_report(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
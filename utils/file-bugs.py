@@ -2,6 +2,7 @@
 #  vim:se fileencoding=utf8
 # (c) 2017 Michał Górny
 
+import argparse
 import bugzilla
 import configparser
 import json
@@ -13,6 +14,7 @@ import textwrap
 
 
 REFERENCE_LOG_URL = 'https://qa-reports.gentoo.org/output/repos'
+BUGZILLA_URL = os.environ.get('BUGZILLA_URL', 'https://bugs.gentoo.org')
 
 
 class BugDesc(object):
@@ -34,6 +36,10 @@ class StateHandlers(object):
 
     def BAD_CACHE(self, repo, data):
         summary = '[%s] Ebuild failures occuring in global scope' % repo
+        failures = ''
+        if data.get('x-regen-failures'):
+            failures = ('\n\nThe following ebuilds are currently failing: %s.'
+                    % ', '.join(data['x-regen-failures']))
         msg = ('''
 Our automated repository checks [1] have detected that the '%s'
 repository contains ebuilds that trigger fatal errors during the cache
@@ -58,14 +64,14 @@ The error log for the repository can be found at:
 
   %s/%s.html
 
-In particular, please look for highlighted error messages.
+In particular, please look for highlighted error messages.%s
 
 Please fix the issue ASAP, possibly via removing unmaintained, old
 ebuilds. We reserve the right to remove the repository from our list if
 we do not receive any reply within 4 weeks.
 
 [1]:https://wiki.gentoo.org/wiki/Project:Repository_mirror_and_CI
-''' % (repo, REFERENCE_LOG_URL, repo)).strip()
+''' % (repo, REFERENCE_LOG_URL, repo, failures)).strip()
 
         return BugDesc(summary, msg)
 
@@ -214,7 +220,198 @@ do not receive any reply within 2 weeks.
         return BugDesc(summary, msg)
 
 
-def main(bug_db_path, summary_path):
+def save_bug_db(bug_db_path, bug_db):
+    with open(bug_db_path + '.new', 'w') as f:
+        json.dump(bug_db, f)
+    os.rename(bug_db_path + '.new', bug_db_path)
+
+
+def replay_journal(bug_db_path, bug_db):
+    """
+    Apply changes journaled by an interrupted batch run, and write
+    the updated bug_db.
+    """
+    journal_path = bug_db_path + '.journal'
+    if not os.path.exists(journal_path):
+        return
+
+    with open(journal_path) as f:
+        for l in f:
+            try:
+                op = json.loads(l)
+            except ValueError:
+                # incomplete last line
+                break
+            if op['op'] == 'set':
+                bug_db.setdefault(op['repo'], {})[op['issue']] = op['bug']
+            elif op['op'] == 'del':
+                bug_db.pop(op['repo'], None)
+    print('Replayed journal from interrupted run: %s' % journal_path)
+    save_bug_db(bug_db_path, bug_db)
+    os.unlink(journal_path)
+
+
+def bug_params(r, v, w):
+    owners = [o['email'] for o in v['owner']]
+    return owners, {
+        'product': 'Gentoo Linux',
+        'component': 'Overlays',
+        'version': 'unspecified',
+        'summary': w.summary,
+        'description': w.msg,
+        'url': '%s/%s.html' % (REFERENCE_LOG_URL, r),
+        'assigned_to': owners[0],
+        'cc': ', '.join(owners[1:]),
+        'blocks': ['repository-qa-issues'],
+    }
+
+
+def file_bug(bz, owners, params):
+    createinfo = bz.build_createbug(**params)
+    try:
+        return bz.createbug(createinfo)
+    except Exception as e:
+        for o in owners:
+            if o in e.faultString:
+                print('Owner not on Bugzie, reassigning...')
+
+                params['description'] = ('''
+== == == == == == == == == == == == == == == == == == == == == == == ==
+The repository owner is not registered on Bugzilla
+Owner: %s
+== == == == == == == == == == == == == == == == == == == == == == == ==
+
+''' % owners) + params['description']
+                params['assigned_to'] = 'overlays@gentoo.org'
+                params['cc'] = []
+                params['blocks'].append('repository-qa-bugzie')
+                createinfo = bz.build_createbug(**params)
+                return bz.createbug(createinfo)
+        raise
+
+
+def close_params(issue):
+    params = {}
+    params['status'] = 'RESOLVED'
+    if issue == 'REMOVED':
+        params['resolution'] = 'OBSOLETE'
+        params['comment'] = 'The repository has been removed, rendering this bug obsolete.'
+    else:
+        params['resolution'] = 'FIXED'
+        params['comment'] = 'The bug seems to be fixed in the repository. Closing.'
+    return params
+
+
+def warn_resolved(expected_open_bugs, bugs):
+    for b in bugs:
+        if b is None:
+            print('Warning: getting some bugs failed')
+            continue
+        # warn about bugs that were resolved (incorrectly?)
+        if b.resolution:
+            print('Warning: #%d (%s) %s/%s'
+                    % (b.id, ': '.join(expected_open_bugs[b.id]),
+                        b.status, b.resolution))
+
+
+def run_batch(bz, bug_db_path, bug_db, summary, dry_run):
+    """
+    Plan all changes up front, fetching all referenced bugs in one
+    request, then file the new bugs, close the fixed ones in one request
+    per resolution and write bug_db once.
+    """
+
+    sth = StateHandlers()
+
+    # compute the plan offline
+    to_file = []
+    to_close = []
+    expected_open_bugs = {}
+    for r, v in sorted(summary.items()):
+        issue = v['x-state']
+        current_bugs = bug_db.get(r, {})
+
+        if issue in current_bugs:
+            expected_open_bugs[current_bugs[issue]] = (r, issue)
+            continue
+
+        w = getattr(sth, issue)(r, v)
+        if w is not None:
+            owners, params = bug_params(r, v, w)
+            to_file.append((r, issue, owners, params))
+        elif current_bugs:
+            to_close.append((r, issue, list(current_bugs.values())))
+
+    # fetch all referenced bugs at once
+    bug_ids = list(expected_open_bugs)
+    for r, issue, ids in to_close:
+        bug_ids.extend(ids)
+    bugs = {}
+    if bug_ids:
+        for i, b in zip(bug_ids, bz.getbugs(bug_ids)):
+            bugs[i] = b
+
+    # group the bugs to close by resolution, skipping resolved bugs
+    close_groups = {}
+    for r, issue, ids in to_close:
+        params = close_params(issue)
+        key = (params['resolution'], params['comment'])
+        for i in ids:
+            if bugs.get(i) is None:
+                print('Warning: getting #%d failed' % i)
+            elif not bugs[i].resolution:
+                close_groups.setdefault(key, []).append((i, r))
+
+    # print the plan
+    for r, issue, owners, params in to_file:
+        print('File: %s: %s (%s)' % (r, params['summary'], ', '.join(owners)))
+    for (resolution, comment), bl in sorted(close_groups.items()):
+        print('Close as RESOLVED/%s: %s'
+                % (resolution, ', '.join('#%d (%s)' % x for x in bl)))
+    for r, issue, ids in to_close:
+        print('Forget: %s (%s)' % (r, issue))
+    warn_resolved(expected_open_bugs,
+                  [bugs.get(i) for i in expected_open_bugs])
+    print()
+    print('%d bugs to file, %d to close, %d repositories to forget'
+            % (len(to_file), sum(len(x) for x in close_groups.values()),
+                len(to_close)))
+
+    if dry_run:
+        return 0
+
+    # journal every change, so that an interrupted run does not lose
+    # the numbers of filed bugs
+    with open(bug_db_path + '.journal', 'a') as journal:
+        def record(**op):
+            journal.write(json.dumps(op) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        for r, issue, owners, params in to_file:
+            ret = file_bug(bz, owners, params)
+            print('Bug filed as #%d (%s)' % (ret.id, r))
+            record(op='set', repo=r, issue=issue, bug=ret.id)
+            bug_db.setdefault(r, {})[issue] = ret.id
+
+        for (resolution, comment), bl in sorted(close_groups.items()):
+            updateinfo = bz.build_update(status='RESOLVED',
+                                         resolution=resolution,
+                                         comment=comment)
+            ret = bz.update_bugs([i for i, r in bl], updateinfo)
+            print('Updated bugs %s' % [b['id'] for b in ret['bugs']])
+
+        for r, issue, ids in to_close:
+            record(op='del', repo=r)
+            del bug_db[r]
+
+    save_bug_db(bug_db_path, bug_db)
+    os.unlink(bug_db_path + '.journal')
+    return 0
+
+
+def main(bug_db_path, summary_path, batch=False, dry_run=False,
+         regen_ledger_path=None):
     if not os.path.exists(bug_db_path):
         print('Refusing to proceed with non-existing bug-db.')
         print('Please initialize new bug-db with:')
@@ -234,15 +431,32 @@ def main(bug_db_path, summary_path):
         print('Put bugzilla API key into ~/.bugz_token')
         return 1
 
-    bz = bugzilla.Bugzilla('https://bugs.gentoo.org',
-                           api_key=token)
+    bz = bugzilla.Bugzilla(BUGZILLA_URL, api_key=token)
 
-    sth = StateHandlers()
+    if not dry_run:
+        replay_journal(bug_db_path, bug_db)
+
+    if regen_ledger_path is not None:
+        # failing ebuilds recorded by repos/regen-quarantine.py
+        with open(regen_ledger_path) as f:
+            ledger = json.load(f)
+        for r, ebuilds in ledger['repos'].items():
+            if r not in summary or not ebuilds:
+                continue
+            # quarantined ebuilds no longer show up in the regen logs
+            if summary[r]['x-state'] == 'GOOD':
+                summary[r]['x-state'] = 'BAD_CACHE'
+            summary[r]['x-regen-failures'] = sorted(ebuilds)
 
     for r, v in bug_db.items():
         if r not in summary:
             summary[r] = {'x-state': 'REMOVED'}
 
+    if batch or dry_run:
+        return run_batch(bz, bug_db_path, bug_db, summary, dry_run)
+
+    sth = StateHandlers()
+
     expected_open_bugs = {}
     for r, v in sorted(summary.items()):
         issue = v['x-state']
@@ -256,22 +470,7 @@ def main(bug_db_path, summary_path):
 
         w = getattr(sth, issue)(r, v)
         if w is not None:
-            if issue in current_bugs:
-                continue
-
-            owners = [o['email'] for o in v['owner']]
-            params = {
-                'product': 'Gentoo Linux',
-                'component': 'Overlays',
-                'version': 'unspecified',
-                'summary': w.summary,
-                'description': w.msg,
-                'url': '%s/%s.html' % (REFERENCE_LOG_URL, r),
-                'assigned_to': owners[0],
-                'cc': ', '.join(owners[1:]),
-                'blocks': ['repository-qa-issues'],
-            }
-            createinfo = bz.build_createbug(**params)
+            owners, params = bug_params(r, v, w)
 
             # print the bug and ask for confirmation
             print('Owners: %s' % owners)
@@ -282,29 +481,7 @@ def main(bug_db_path, summary_path):
             print()
             resp = input('File the bug? [Y/n]')
             if resp.lower() in ('', 'y', 'yes'):
-                try:
-                    ret = bz.createbug(createinfo)
-                except Exception as e:
-                    for o in owners:
-                        if o in e.faultString:
-                            print('Owner not on Bugzie, reassigning...')
-
-                            params['description'] = ('''
-== == == == == == == == == == == == == == == == == == == == == == == ==
-The repository owner is not registered on Bugzilla
-Owner: %s
-== == == == == == == == == == == == == == == == == == == == == == == ==
-
-''' % owners) + params['description']
-                            params['assigned_to'] = 'overlays@gentoo.org'
-                            params['cc'] = []
-                            params['blocks'].append('repository-qa-bugzie')
-                            createinfo = bz.build_createbug(**params)
-                            ret = bz.createbug(createinfo)
-
-                            break
-                    else:
-                        raise
+                ret = file_bug(bz, owners, params)
                 print('Bug filed as #%d' % ret.id)
                 print()
 
@@ -312,9 +489,7 @@ Owner: %s
                     bug_db[r] = {}
                 bug_db[r][issue] = ret.id
 
-                with open(bug_db_path + '.new', 'w') as f:
-                    json.dump(bug_db, f)
-                os.rename(bug_db_path + '.new', bug_db_path)
+                save_bug_db(bug_db_path, bug_db)
         elif current_bugs: # update existing bugs
             bug_ids = list(current_bugs.values())
             ret = bz.getbugs(bug_ids)
@@ -327,15 +502,7 @@ Owner: %s
                     del bug_ids[i]
 
             if bug_ids:
-                params = {}
-                params['status'] = 'RESOLVED'
-                if issue == 'REMOVED':
-                    params['resolution'] = 'OBSOLETE'
-                    params['comment'] = 'The repository has been removed, rendering this bug obsolete.'
-                else:
-                    params['resolution'] = 'FIXED'
-                    params['comment'] = 'The bug seems to be fixed in the repository. Closing.'
-
+                params = close_params(issue)
                 updateinfo = bz.build_update(**params)
 
                 print('Bugs: %s' % bug_ids)
@@ -351,25 +518,29 @@ Owner: %s
 
             del bug_db[r]
 
-            with open(bug_db_path + '.new', 'w') as f:
-                json.dump(bug_db, f)
-            os.rename(bug_db_path + '.new', bug_db_path)
+            save_bug_db(bug_db_path, bug_db)
 
     bug_ids = list(expected_open_bugs)
     if bug_ids:
-        ret = bz.getbugs(bug_ids)
-        for b in ret:
-            if b is None:
-                print('Warning: getting some bugs failed')
-                continue
-            # warn about bugs that were resolved (incorrectly?)
-            if b.resolution:
-                print('Warning: #%d (%s) %s/%s'
-                        % (b.id, ': '.join(expected_open_bugs[b.id]),
-                            b.status, b.resolution))
+        warn_resolved(expected_open_bugs, bz.getbugs(bug_ids))
 
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(*sys.argv[1:]))
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--batch', action='store_true',
+                      help='plan all changes up front and apply them '
+                           'without asking')
+    argp.add_argument('--dry-run', action='store_true',
+                      help='print the batch plan without changing anything')
+    argp.add_argument('--regen-ledger',
+                      help='regen failure ledger (JSON) from '
+                           'repos/regen-quarantine.py, to list the failing '
+                           'ebuilds')
+    argp.add_argument('bug_db', help='bug database (JSON)')
+    argp.add_argument('summary', help='repository summary (JSON)')
+    args = argp.parse_args()
+    sys.exit(main(args.bug_db, args.summary,
+                  batch=args.batch, dry_run=args.dry_run,
+                  regen_ledger_path=args.regen_ledger))
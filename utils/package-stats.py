@@ -1,60 +1,247 @@
 #!/usr/bin/env python
+# Statistics of packages in ::gentoo and overlays.
+#
+# The (repo, category, package) rows are kept in a sqlite catalog, and
+# only repositories whose HEAD changed since the last update are
+# enumerated again (in parallel).  A snapshot of the counts is recorded
+# on every update, to be used for trends.
+#
+# usage: package-stats.py [--db PATH] [-n N] [report|update|new|forks|overlap|trends]
 
-import pkgcore.config
+import argparse
+import datetime
+import heapq
+import multiprocessing
+import os
+import os.path
+import sqlite3
+import subprocess
 
 
-def iter_pkgs(repo):
-    for cat, pns in repo.packages.items():
-        if not cat:
-            continue
-        for pn in pns:
-            yield '/'.join((cat, pn))
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS repos (
+    name TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    head TEXT,
+    has_masters INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packages (
+    repo TEXT NOT NULL,
+    category TEXT NOT NULL,
+    package TEXT NOT NULL,
+    PRIMARY KEY (repo, category, package)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS packages_by_name
+    ON packages (category, package);
+CREATE TABLE IF NOT EXISTS snapshots (
+    date TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    category TEXT NOT NULL,
+    package TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (date, kind, category, package)
+) WITHOUT ROWID;
+'''
 
+# packages in slave repos, with the number of repos having them
+# and whether ::gentoo has them too
+COUNTS_QUERY = '''
+SELECT p.category, p.package, COUNT(*),
+    EXISTS (SELECT 1 FROM packages g
+            WHERE g.repo = 'gentoo'
+                AND g.category = p.category
+                AND g.package = p.package)
+FROM packages p JOIN repos r ON r.name = p.repo
+WHERE r.has_masters
+GROUP BY p.category, p.package
+'''
 
-def print_results(rdict):
-    num_print = 25
 
-    for k, v in sorted(rdict.items(), key=lambda kv: kv[1], reverse=True)[:num_print]:
-        # ::gentoo forks may have 0
-        if v == 0:
-            break
-        print('%3d %s' % (v, k))
+def repo_head(location):
+    """Return the git HEAD of the repository, or None if not a git repo."""
+    if not os.path.isdir(os.path.join(location, '.git')):
+        return None
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=location).decode().strip()
 
 
-def main():
-    c = pkgcore.config.load_config()
-    d = c.get_default('domain')
+def scan_category(args):
+    """Return (repo, category, package) rows for a single category."""
+    name, location, cat = args
+    try:
+        entries = os.scandir(os.path.join(location, cat))
+    except FileNotFoundError:
+        return []
+    with entries:
+        return [(name, cat, e.name) for e in entries
+                if e.is_dir() and not e.name.startswith('.')]
 
-    new_stats = {}
-    gentoo_fork_stats = {}
 
-    # collect list of ::gentoo packages
-    for pkg in iter_pkgs(d.repos_raw['gentoo']):
-        gentoo_fork_stats[pkg] = 0
+def update(db, jobs=None):
+    """Update the catalog from the repositories in pkgcore config."""
+    import pkgcore.config
 
-    # collect list of slave repo packages
+    c = pkgcore.config.load_config()
+    d = c.get_default('domain')
+
+    repos = {}
+    gentoo = d.repos_raw['gentoo']
+    repos[gentoo.repo_id] = (gentoo, False)
     for r in d.ebuild_repos_raw:
         rr = r.raw_repo
-        # skip non-slave repos to avoid counting ::gentoo and ::gentoo forks
-        if not rr.masters:
-            continue
-
-        for pkg in iter_pkgs(rr):
-            if pkg in gentoo_fork_stats:
-                # packages in ::gentoo are counted as forks
-                gentoo_fork_stats[pkg] += 1
-            else:
-                # other packages are counted as new
-                if pkg not in new_stats:
-                    new_stats[pkg] = 0
-                new_stats[pkg] += 1
-
-    # print results
+        if rr.repo_id not in repos:
+            repos[rr.repo_id] = (rr, bool(rr.masters))
+
+    known = dict(db.execute('SELECT name, head FROM repos'))
+    tasks = []
+    with db:
+        # drop repositories that are gone
+        for name in set(known) - set(repos):
+            db.execute('DELETE FROM packages WHERE repo = ?', (name,))
+            db.execute('DELETE FROM repos WHERE name = ?', (name,))
+
+        for name, (rr, has_masters) in repos.items():
+            head = repo_head(rr.location)
+            if head is not None and known.get(name) == head:
+                continue
+            db.execute('DELETE FROM packages WHERE repo = ?', (name,))
+            db.execute('INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)',
+                       (name, rr.location, head, has_masters))
+            for cat in rr.categories:
+                tasks.append((name, rr.location, cat))
+
+        if tasks:
+            with multiprocessing.Pool(jobs) as pool:
+                for rows in pool.imap_unordered(scan_category, tasks,
+                                                chunksize=32):
+                    db.executemany('INSERT OR IGNORE INTO packages VALUES (?, ?, ?)',
+                                   rows)
+
+        # record today's snapshot for trends
+        today = datetime.date.today().isoformat()
+        db.execute('DELETE FROM snapshots WHERE date = ?', (today,))
+        db.executemany('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)',
+                       ((today, 'fork' if in_gentoo else 'new', cat, pn, count)
+                        for cat, pn, count, in_gentoo
+                        in db.execute(COUNTS_QUERY).fetchall()))
+
+
+def top_packages(db, kind, num):
+    """Return num (count, 'cat/pn') tuples with the highest counts."""
+    want_gentoo = kind == 'fork'
+    return heapq.nlargest(
+        num,
+        ((count, '/'.join((cat, pn)))
+         for cat, pn, count, in_gentoo in db.execute(COUNTS_QUERY)
+         if bool(in_gentoo) == want_gentoo),
+        key=lambda x: x[0])
+
+
+def print_results(results):
+    for count, pkg in results:
+        print('%3d %s' % (count, pkg))
+
+
+def cmd_new(db, args):
     print('== Most common new packages ==')
-    print_results(new_stats)
-    print()
+    print_results(top_packages(db, 'new', args.num))
+
+
+def cmd_forks(db, args):
     print('== Most common ::gentoo forked packages ==')
-    print_results(gentoo_fork_stats)
+    print_results(top_packages(db, 'fork', args.num))
+
+
+def cmd_report(db, args):
+    update(db, args.jobs)
+    cmd_new(db, args)
+    print()
+    cmd_forks(db, args)
+
+
+def cmd_update(db, args):
+    update(db, args.jobs)
+
+
+def cmd_overlap(db, args):
+    rows = db.execute('''
+        SELECT p.repo, COUNT(*), COUNT(g.package)
+        FROM packages p JOIN repos r ON r.name = p.repo
+        LEFT JOIN packages g
+            ON g.repo = 'gentoo'
+                AND g.category = p.category
+                AND g.package = p.package
+        WHERE r.has_masters
+        GROUP BY p.repo''')
+
+    print('== Repositories forking most ::gentoo packages ==')
+    print('total forks      repo')
+    for total, forks, repo in heapq.nlargest(
+            args.num, ((total, forks, repo) for repo, total, forks in rows),
+            key=lambda x: x[1]):
+        print('%5d %5d %3d%% %s' % (total, forks, 100 * forks // total, repo))
+
+
+def cmd_trends(db, args):
+    dates = [x for x, in db.execute(
+        'SELECT DISTINCT date FROM snapshots ORDER BY date DESC')]
+    if not dates:
+        return
+    since = (datetime.date.fromisoformat(dates[0])
+             - datetime.timedelta(days=args.days)).isoformat()
+    base = min((x for x in dates if x >= since), default=dates[0])
+
+    for kind, title in (('new', 'new packages'),
+                        ('fork', '::gentoo forked packages')):
+        rows = db.execute('''
+            SELECT c.category, c.package, c.count, COALESCE(b.count, 0)
+            FROM snapshots c
+            LEFT JOIN snapshots b
+                ON b.date = ? AND b.kind = c.kind
+                    AND b.category = c.category AND b.package = c.package
+            WHERE c.date = ? AND c.kind = ?''', (base, dates[0], kind))
+        print('== Most common %s (change since %s) ==' % (title, base))
+        for count, diff, pkg in heapq.nlargest(
+                args.num,
+                ((count, count - old, '/'.join((cat, pn)))
+                 for cat, pn, count, old in rows),
+                key=lambda x: x[0]):
+            print('%3d %+4d %s' % (count, diff, pkg))
+        print()
+
+
+COMMANDS = {
+    'report': cmd_report,
+    'update': cmd_update,
+    'new': cmd_new,
+    'forks': cmd_forks,
+    'overlap': cmd_overlap,
+    'trends': cmd_trends,
+}
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--db',
+                      default=os.environ.get('PACKAGE_STATS_DB',
+                                             'package-stats.sqlite'),
+                      help='catalog database path')
+    argp.add_argument('-n', '--num', type=int, default=25,
+                      help='number of entries to print')
+    argp.add_argument('-j', '--jobs', type=int,
+                      help='number of parallel enumeration processes')
+    argp.add_argument('--days', type=int, default=30,
+                      help='trends: compare against snapshot this old')
+    argp.add_argument('command', nargs='?', default='report',
+                      choices=sorted(COMMANDS))
+    args = argp.parse_args()
+
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+    try:
+        COMMANDS[args.command](db, args)
+    finally:
+        db.close()
 
 
 if __name__ == '__main__':